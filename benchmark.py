@@ -0,0 +1,230 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import main
+
+# FileDB benchmark suite
+# Generates tables shaped like company_employee_details and company_employees_salaries, in the flat
+# and the "_part_N" layout, then times every command path against them and writes the timings as
+# JSON. The same seed always generates the same data, so runs on different commits can be compared
+# with --compare. The result cache is turned off so every repetition runs the query; repetitions
+# after the first show the warm buffer pool.
+companies = ['Glasses', 'Cheerper', 'Pear']
+departments = ['AI', 'BigData', 'Design', 'Sales', 'SearchEngine', 'Support']  # No spaces, puts split on them
+details_header = ['id', 'company', 'department', 'employee_id', 'age', 'age_when_joined', 'years_in_company']
+salaries_header = ['id', 'salary', 'annual_bonus', 'prior_years_experience', 'full_time', 'part_time', 'contractor']
+partition_size = 1000  # Matches get_partition_file_name
+
+
+def details_row(rng, row_id):
+    age_when_joined = rng.randint(20, 55)
+    years_in_company = rng.randint(0, 10)
+    return [row_id, rng.choice(companies), rng.choice(departments), rng.randint(0, 2000),
+            age_when_joined + years_in_company, age_when_joined, years_in_company]
+
+
+def salaries_row(rng, row_id):
+    full_time = float(rng.random() < 0.6)
+    return [row_id, round(rng.uniform(30000, 150000), 5), round(rng.uniform(0, 30000), 5), rng.randint(0, 15),
+            full_time, 0.0 if full_time else round(rng.random(), 5), float(rng.random() < 0.2)]
+
+
+def generate_table(table_name, header, make_row, rows, partitioned, seed):
+    """
+    Writes a synthetic table into dbs/.
+
+    :param table_name: Name of the table.
+    :param header: Column names.
+    :param make_row: Function (random generator, id) -> list of values.
+    :param rows: Number of rows.
+    :param partitioned: Write "<table>_part_N.csv" files of partition_size ids instead of one file.
+    :param seed: Seed of the random generator.
+    """
+    rng = random.Random(seed)
+    file = None
+    for row_id in range(rows):
+        if file is None or (partitioned and row_id % partition_size == 0):
+            if file:
+                file.close()
+            file_name = f"dbs/{table_name}_part_{row_id // partition_size}.csv" if partitioned \
+                else f"dbs/{table_name}.csv"
+            file = open(file_name, 'w')
+            file.write(','.join(header) + '\n')
+        file.write(','.join(str(value) for value in make_row(rng, row_id)) + '\n')
+    if file:
+        file.close()
+
+
+def workload(details, salaries, rows, partitioned):
+    # (command path, query) pairs, reads first so they all see the generated data
+    p = '_p' if partitioned else ''
+    reads = [
+        (f'give{p}', f"give{p} id,company,age from table {details} where age >= 60"),
+        (f'give{p}', f"give{p} id,company from table {details} where id = {rows // 2}"),
+        (f'order{p}', f"order{p} {salaries} by salary desc limit 100"),
+        (f'order{p}', f"order{p} {details} by age asc"),
+        ('aggregate', f"aggregate sum(salary),avg(salary),count(id) from {salaries} by full_time"),
+        (f'group{p}', f"group{p} company from {details} print id age"),
+        ('join', f"join {details} and {salaries} id print {details}.company,{salaries}.salary"),
+        ('complex', f"complex {details}.company,{salaries}.salary from table {details} join {salaries} "
+                    f"where years_in_company > 5 order by salary desc"),
+    ]
+    if not partitioned:
+        reads.append(('aggregate_p', f"aggregate_p avg from {salaries} by salary"))
+        reads.append(('group', f"group department from {details} where age >= 60 print id"))
+    writes = [
+        (f'remove{p}', f"remove{p} of {details} where years_in_company = 10"),
+        (f'renew{p}', f"renew{p} {details} put age=30 where employee_id = 5"),
+    ]
+    return reads, writes
+
+
+class LineCounter:
+    # Discards the output of a query, counting its lines
+    def __init__(self):
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def time_query(query, repeat):
+    seconds, output_lines = [], 0
+    for _ in range(repeat):
+        output = LineCounter()
+        start = time.perf_counter()
+        with main.captured_output(output):
+            main.parse_and_execute(query)
+        seconds.append(time.perf_counter() - start)
+        output_lines = output.lines
+    return seconds, output_lines
+
+
+def table_rows(table_name):
+    return sum(1 for data_file in main.table_data_files(table_name) for _ in main.live_rows(data_file))
+
+
+def time_puts(table_name, command, first_id, count):
+    # count put / put_p commands of new ids, including the flush that commits the last group
+    rng = random.Random(first_id)
+    rows_before = table_rows(table_name)
+    start = time.perf_counter()
+    with main.captured_output(io.StringIO()):
+        for row_id in range(first_id, first_id + count):
+            main.parse_and_execute(f"{command} {table_name} " + ' '.join(str(value) for value in details_row(rng, row_id)))
+        main.flush_all_buffers()
+    seconds = time.perf_counter() - start
+    written = table_rows(table_name) - rows_before
+    assert written == count, f"{count - written} of {count} puts to {table_name} were not written"
+    return seconds
+
+
+def result(rows, layout, command, query, seconds, output_lines=None, operations=1):
+    return {'rows': rows, 'layout': layout, 'command': command, 'query': query, 'seconds': seconds,
+            'first': seconds[0], 'min': min(seconds), 'median': statistics.median(seconds),
+            'output_lines': output_lines, 'operations': operations}
+
+
+def run_benchmarks(row_counts, repeat, puts, seed):
+    results = []
+    for rows in row_counts:
+        for layout in ('flat', 'partitioned'):
+            partitioned = layout == 'partitioned'
+            details, salaries = f"bench_details_{layout}_{rows}", f"bench_salaries_{layout}_{rows}"
+            print(f"Generating {rows} rows ({layout})", file=sys.stderr)
+            generate_table(details, details_header, details_row, rows, partitioned, seed)
+            generate_table(salaries, salaries_header, salaries_row, rows, partitioned, seed + 1)
+
+            reads, writes = workload(details, salaries, rows, partitioned)
+            for command, query in reads + writes:
+                print(f"  {query}", file=sys.stderr)
+                seconds, output_lines = time_query(query, repeat)
+                results.append(result(rows, layout, command, query, seconds, output_lines))
+            command = 'put_p' if partitioned else 'put'
+            seconds = time_puts(details, command, rows, puts)
+            results.append(result(rows, layout, command, f"{puts} x {command} {details}", [seconds], operations=puts))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline_file):
+    # Prints the median time of every query relative to a previous run
+    with open(baseline_file, 'r') as file:
+        baseline = {(r['rows'], r['layout'], r['query']): r for r in json.load(file)['results']}
+    print(f"{'rows':>10} {'layout':<12} {'baseline':>10} {'now':>10} {'change':>8}  query")
+    for r in results:
+        previous = baseline.get((r['rows'], r['layout'], r['query']))
+        if previous:
+            change = r['median'] / previous['median'] - 1 if previous['median'] else 0.0
+            print(f"{r['rows']:>10} {r['layout']:<12} {previous['median']:>10.4f} {r['median']:>10.4f} "
+                  f"{change:>+8.1%}  {r['query']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time FileDB commands on generated tables.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000],
+                        help='Table sizes to generate, e.g. 10000 100000 1000000 10000000')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every query')
+    parser.add_argument('--puts', type=int, default=1000, help='put / put_p commands to time per table')
+    parser.add_argument('--seed', type=int, default=551)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--dir', help='Directory to generate the tables in, kept afterwards (default: a temporary one)')
+    arguments = parser.parse_args()
+
+    output_file = os.path.abspath(arguments.output)
+    baseline_file = os.path.abspath(arguments.compare) if arguments.compare else None
+    work_dir = os.path.abspath(arguments.dir) if arguments.dir else tempfile.mkdtemp(prefix='filedb-bench-')
+    os.makedirs(os.path.join(work_dir, 'dbs'), exist_ok=True)
+    os.chdir(work_dir)  # The engine works on ./dbs
+    main.result_cache_size = 0
+
+    started = time.time()
+    try:
+        results = run_benchmarks(arguments.rows, arguments.repeat, arguments.puts, arguments.seed)
+    finally:
+        main.shutdown_worker_pool()
+        if not arguments.dir:
+            shutil.rmtree(work_dir)
+
+    report = {
+        'meta': {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': arguments.seed,
+            'repeat': arguments.repeat,
+            'settings': {'workers': main.parallel_workers, 'buffer_limit': main.buffer_limit,
+                         'buffer_pool': main.buffer_pool_limit, 'sort_memory': main.sort_memory_limit,
+                         'join_memory': main.join_memory_limit, 'compact_after': main.compaction_threshold},
+        },
+        'results': results,
+    }
+    with open(output_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {len(results)} timings to {output_file}", file=sys.stderr)
+    if baseline_file:
+        compare(results, baseline_file)
@@ -0,0 +1,52 @@
+import os
+import sys
+import asyncio
+import argparse
+
+from server import END_OF_RESULT
+
+
+# FileDB network client
+# Sends queries to a running server.py and prints the result lines as they arrive. Queries come
+# from the command line, or from an interactive prompt when none are given.
+async def send_query(reader, writer, query):
+    writer.write(f"{query}\n".encode())
+    await writer.drain()
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Server closed the connection")
+        line = line.decode()
+        if line.rstrip('\n') == END_OF_RESULT:
+            return
+        sys.stdout.write(line)
+
+
+async def run_client(host, port, queries):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if queries:
+            for query in queries:
+                await send_query(reader, writer, query)
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            query = await loop.run_in_executor(None, input, 'FileDB > ')
+            if query.strip().lower() == 'exit':
+                break
+            if query.strip():
+                await send_query(reader, writer, query)
+    except EOFError:
+        pass  # End of input at the prompt
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send queries to a FileDB server.')
+    parser.add_argument('queries', nargs='*', help='Queries to run, one per argument')
+    parser.add_argument('--host', default=os.environ.get('FILEDB_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('FILEDB_PORT', 5511)))
+    arguments = parser.parse_args()
+    asyncio.run(run_client(arguments.host, arguments.port, arguments.queries))
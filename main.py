@@ -1,7 +1,33 @@
 import os
+import io
+import sys
+import atexit
+import re
 import cmd
-import csv
-from collections import defaultdict
+import bisect
+import heapq
+import json
+import math
+import time
+import random
+import hashlib
+import mmap
+import shutil
+import tempfile
+import inspect
+import functools
+import tracemalloc
+import threading
+import contextlib
+import multiprocessing
+import zlib
+import lzma
+import struct
+from array import array
+from itertools import chain, accumulate
+from operator import eq, gt, lt, ge, le
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 
 def ensure_db_directory():
@@ -9,77 +35,2088 @@ def ensure_db_directory():
         os.makedirs('dbs')
 
 
+# Concurrency control
+# A table has one writer at a time: every command that changes it holds table_write_lock(table).
+# Writers never change bytes a reader may be looking at. Appends land past the end a reader has
+# seen, remove / renew add records to the mutation log, and rewrites build a new file that replaces
+# the old one through os.replace, while open readers keep the old file. publish_lock is held only
+# while a writer makes a change visible and while a reader takes its snapshot, so a reader sees
+# a change either whole or not at all and is never held up by the rest of a write.
+# Splits and rebalancing write their partitions under new file names and publish them with the
+# manifest that lists them. The partitions they replace are retired: every query pins the epoch it
+# started in, and a file retired in an epoch is removed once no query pinned at or before it runs,
+# so a query holding an older manifest still reads every file it lists.
+publish_lock = threading.RLock()
+table_write_locks = {}
+cache_lock = threading.RLock()  # Guards the plan, buffer pool and result caches shared by reader threads
+partition_epoch = 0  # Bumped whenever partition files are retired
+pinned_epochs = defaultdict(int)  # epoch -> queries running since it
+retired_files = []  # (epoch, data file) of the partitions waiting for the queries that may read them
+
+
+def table_write_lock(table_name):
+    return table_write_locks.setdefault(table_name, threading.RLock())
+
+
+def temporary_file_name(path):
+    # Private to this process and thread, so concurrent writers of the same file do not collide
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+@contextlib.contextmanager
+def pinned_partitions():
+    # Keeps the partition files a query may read from being removed until it ends
+    with publish_lock:
+        epoch = partition_epoch
+        pinned_epochs[epoch] += 1
+    try:
+        yield
+    finally:
+        with publish_lock:
+            pinned_epochs[epoch] -= 1
+            if not pinned_epochs[epoch]:
+                del pinned_epochs[epoch]
+            remove_retired_files()
+
+
+def retire_partition_files(file_paths):
+    # Called under publish_lock once a manifest without the files is published
+    global partition_epoch
+    retired_files.extend((partition_epoch, file_path) for file_path in file_paths)
+    partition_epoch += 1
+    remove_retired_files()
+
+
+def remove_retired_files():
+    oldest = min(pinned_epochs, default=partition_epoch)
+    for epoch, file_path in [entry for entry in retired_files if entry[0] < oldest]:
+        retired_files.remove((epoch, file_path))
+        remove_data_file(file_path)
+
+
+def open_snapshot(data_file):
+    """
+    Opens a data file together with the mutation log that belongs to its current contents.
+
+    :return: Tuple of (binary file, size of the base file, mutations). Rows past the size are not part of the snapshot.
+    """
+    count('files_opened')
+    with publish_lock:
+        file = open_data_file(data_file)
+        size = file.size if isinstance(file, BlockReader) else os.fstat(file.fileno()).st_size
+        return file, size, load_mutation_log(data_file)
+
+
+# Query statistics
+# "explain <query>" describes how a query would run without running it. "profile <query>" runs it
+# and reports the wall time of every stage (stages nest, so their times overlap), the rows scanned
+# and returned, bytes read, files and partitions opened and peak memory. Reads are timed in one run
+# and traced with tracemalloc in a second; writes run once, traced, so their times include its
+# overhead. The storage functions add to the stats of the query running on their thread through
+# count() and timed_stage, which cost a single lookup when no stats are collected. Work done in worker processes is not counted.
+# With FILEDB_STATS_LOG set, the stats of every query are appended to that file as a JSON line.
+stats_log_file = os.environ.get('FILEDB_STATS_LOG')
+stats_log_lock = threading.Lock()
+stats_state = threading.local()
+
+
+def query_stats(query):
+    return {'query': query, 'command': None, 'stages': {}, 'counters': {}}
+
+
+def current_stats():
+    return getattr(stats_state, 'stats', None)
+
+
+def count(name, amount=1):
+    stats = current_stats()
+    if stats is not None:
+        stats['counters'][name] = stats['counters'].get(name, 0) + amount
+
+
+@contextlib.contextmanager
+def stage(name):
+    stats = current_stats()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats['stages'][name] = stats['stages'].get(name, 0.0) + time.perf_counter() - start
+
+
+def timed_stage(name):
+    # Decorator timing every call of a function as the named stage
+    def decorate(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def timed_generator(*args, **kwargs):
+                with stage(name):
+                    yield from function(*args, **kwargs)
+            return timed_generator
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return timed
+    return decorate
+
+
+@contextlib.contextmanager
+def collecting_stats(stats):
+    # Collects the stats of the queries run on this thread into stats, or nothing when stats is None
+    previous = current_stats()
+    stats_state.stats = stats
+    try:
+        with stage('total'):
+            yield
+    finally:
+        stats_state.stats = previous
+
+
 def get_partition_file_name(table_name, id_value, partition_size=1000):
     partition_index = id_value // partition_size
     return f"dbs/{table_name}_part_{partition_index}.csv"
 
 
-def create_table_partition(table_name, headers):
+def list_partition_files(table_name):
+    # Match the whole "<table>_part_<N>.csv" name so sidecar files and other tables
+    # sharing the prefix are not picked up.
+    pattern = re.compile(rf"^{re.escape(table_name)}_part_(-?\d+)\.csv$")
+    matches = [(int(m.group(1)), f"dbs/{m.group(0)}") for m in map(pattern.match, os.listdir('dbs')) if m]
+    return [file_path for _, file_path in sorted(matches)]
+
+
+def partition_number(file_path):
+    return int(re.search(r"_part_(-?\d+)\.csv$", file_path).group(1))
+
+
+def partition_files(table_name):
+    return sorted(load_manifest(table_name), key=partition_number)
+
+
+# Partition catalog
+# "dbs/<table>.manifest" lists the files of a partitioned table with their row count and the
+# min/max of every numeric column (zone maps), so conditioned commands skip partitions that
+# cannot match. Bounds only widen on insert and update and are recomputed when the manifest is
+# rebuilt, so they may be loose but never exclude a matching row.
+def manifest_file_name(table_name):
+    return f"dbs/{table_name}.manifest"
+
+
+def empty_partition_stats():
+    return {'rows': 0, 'min': {}, 'max': {}, 'unbounded': []}
+
+
+def widen_partition_stats(stats, header, values):
+    for column_name, value in zip(header, values):
+        if column_name in stats['unbounded']:
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            stats['unbounded'].append(column_name)  # Text columns are never pruned on
+            stats['min'].pop(column_name, None)
+            stats['max'].pop(column_name, None)
+            continue
+        stats['min'][column_name] = min(value, stats['min'].get(column_name, value))
+        stats['max'][column_name] = max(value, stats['max'].get(column_name, value))
+
+
+def partition_stats(file_path):
+    header = read_header(file_path)
+    stats = empty_partition_stats()
+    for _, line in live_rows(file_path):
+        stats['rows'] += 1
+        widen_partition_stats(stats, header, line.strip().split(','))
+    return stats
+
+
+def save_manifest(table_name, manifest):
+    tmp_file = temporary_file_name(manifest_file_name(table_name))
+    with open(tmp_file, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_file, manifest_file_name(table_name))
+
+
+def load_manifest(table_name):
+    """
+    Loads the partition catalog of a table, building it from the partition files if it is missing.
+
+    :return: Dict mapping each partition file to its stats, empty if the table is not partitioned.
+    """
+    try:
+        with open(manifest_file_name(table_name), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        manifest = {file_path: partition_stats(file_path) for file_path in list_partition_files(table_name)}
+        if manifest:
+            save_manifest(table_name, manifest)
+        return manifest
+
+
+def partition_may_match(stats, condition):
+    if stats['rows'] == 0:
+        return False
+    if not condition:
+        return True
+    column_name, operator, condition_value = condition
+    if column_name not in stats['min']:
+        return True
+    try:
+        condition_value = float(condition_value)
+    except ValueError:
+        return True
+    minimum, maximum = stats['min'][column_name], stats['max'][column_name]
+    if operator == '=':
+        return minimum <= condition_value <= maximum
+    elif operator == '>':
+        return maximum > condition_value
+    elif operator == '>=':
+        return maximum >= condition_value
+    elif operator == '<':
+        return minimum < condition_value
+    elif operator == '<=':
+        return minimum <= condition_value
+    return True
+
+
+def pruned_partition_files(table_name, condition=None):
+    # Partitions whose zone map, and Bloom filter for an equality condition, allow a row meeting the condition
+    manifest = load_manifest(table_name)
+    file_paths = sorted((file_path for file_path, stats in manifest.items() if partition_may_match(stats, condition)),
+                        key=partition_number)
+    count('partitions_pruned', len(manifest) - len(file_paths))
+    file_paths = bloom_pruned_files(file_paths, condition)
+    count('partitions', len(file_paths))
+    return file_paths
+
+
+# Partitioning schemes
+# "new_p table <name> <columns> partition by range <column> [size <rows>]" or "... partition by hash
+# <column> [count <n>] [size <rows>]" keeps the scheme of a table in "dbs/<table>.partitioning".
+# A range partition holds the rows whose column value lies from its lower bound up to the next one,
+# numbers ordered by value before text ordered by its characters (range_key), and the table starts as
+# a single partition. A hash partition holds the rows whose crc32
+# of the column value leaves its remainder modulo its modulus, and the table starts with <count>
+# partitions. A partition that grows past <size> rows (partition_split_rows by default) is replaced
+# by two new ones: a range partition split at the median of its values, a hash partition into the
+# two remainders of twice its modulus. "rebalance <table>" redistributes all rows into new, evenly
+# filled partitions. New partitions are numbered past every partition file on disk.
+# Tables without a scheme keep ranges of 1000 ids on the first column (get_partition_file_name).
+partition_split_rows = int(os.environ.get('FILEDB_PARTITION_ROWS', 100000))
+partition_methods = ('range', 'hash')
+
+
+def partitioning_file_name(table_name):
+    return f"dbs/{table_name}.partitioning"
+
+
+def load_partitioning(table_name):
+    # The scheme of a table, None for tables partitioned on id ranges of get_partition_file_name
+    try:
+        with open(partitioning_file_name(table_name), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_partitioning(table_name, scheme):
+    tmp_file = temporary_file_name(partitioning_file_name(table_name))
+    with open(tmp_file, 'w') as file:
+        json.dump(scheme, file)
+    os.replace(tmp_file, partitioning_file_name(table_name))
+    row_shapes.pop((table_name, True), None)  # put_p checks the value of the scheme's column
+
+
+def new_partitioning(table_name, method, column_name, size=None, partition_count=None):
+    scheme = {'method': method, 'column': column_name, 'size': size or partition_split_rows}
+    if method == 'range':
+        scheme['bounds'] = [[None, f"dbs/{table_name}_part_0.csv"]]
+    else:
+        scheme['count'] = partition_count or 1
+        scheme['buckets'] = {f"{scheme['count']},{r}": f"dbs/{table_name}_part_{r}.csv"
+                             for r in range(scheme['count'])}
+    return scheme
+
+
+def range_key(value):
+    # Order of a value of a range partitioned column, or of a bound, which is kept as a float or as text
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return 1, value
+        return (0, number) if number == number else (1, value)  # NaN orders nowhere, it is placed by its text
+    return 0, value
+
+
+def hash_value(value):
+    return zlib.crc32(value.encode())  # Stable across processes, unlike hash()
+
+
+def scheme_partition_file(scheme, value):
+    # File of the partition holding a row with the given value of the partitioning column
+    if scheme['method'] == 'range':
+        bounds = scheme['bounds']
+        return bounds[bisect.bisect_right([range_key(lower) for lower, _ in bounds[1:]], range_key(value))][1]
+    h = hash_value(value)
+    modulus = scheme['count']
+    while f"{modulus},{h % modulus}" not in scheme['buckets']:
+        modulus *= 2  # The bucket was split
+    return scheme['buckets'][f"{modulus},{h % modulus}"]
+
+
+def scheme_files(scheme):
+    return [file_path for _, file_path in scheme['bounds']] if scheme['method'] == 'range' \
+        else list(scheme['buckets'].values())
+
+
+def rows_stats(header, lines):
+    stats = empty_partition_stats()
+    for line in lines:
+        stats['rows'] += 1
+        widen_partition_stats(stats, header, line.strip().split(','))
+    return stats
+
+
+def next_partition_files(table_name, count):
+    # Names for new partitions, numbered past every partition file on disk, retired ones included
+    first = max(map(partition_number, list_partition_files(table_name)), default=-1) + 1
+    return [f"dbs/{table_name}_part_{number}.csv" for number in range(first, first + count)]
+
+
+def write_partition(file_path, header, lines):
+    with open(file_path, 'w') as file:
+        file.write(','.join(header) + '\n')
+    build_bloom_filter(file_path, 2 * len(lines))
+    if lines:
+        append_rows(file_path, [line.strip() for line in lines])  # Not listed in the manifest yet, so not read
+
+
+def remove_data_file(data_file):
+    # Removes a retired partition with its sidecars
+    for column_name, _ in data_file_indexes(data_file, read_header(data_file)):
+        drop_index(data_file, column_name)
+    with publish_lock:
+        clear_mutation_log(data_file)
+    if os.path.exists(bloom_file_name(data_file)):
+        os.remove(bloom_file_name(data_file))
+    drop_sketch(data_file)
+    os.remove(data_file)
+
+
+def split_partition(table_name, scheme, file_path):
+    """
+    Replaces a partition by two new partitions, one holding the rows that move, and records the split in the scheme.
+
+    :return: Paths of the two new partitions, or None if the rows can not be split.
+    """
+    header = read_header(file_path)
+    position = header.index(scheme['column'])
+    lines = list(live_lines(file_path))
+    if scheme['method'] == 'range':
+        values = sorted(range_key(line.strip().split(',')[position]) for line in lines)
+        if not values or values[0] == values[-1]:
+            return None
+        bound = values[len(values) // 2]
+        if bound == values[0]:
+            bound = values[bisect.bisect_right(values, bound)]
+        moves = lambda value: range_key(value) >= bound
+    else:
+        key = next(key for key, bucket_file in scheme['buckets'].items() if bucket_file == file_path)
+        modulus, remainder = (int(number) for number in key.split(','))
+        moves = lambda value: hash_value(value) % (2 * modulus) == remainder + modulus
+    moved, kept = [], []
+    for line in lines:
+        (moved if moves(line.strip().split(',')[position]) else kept).append(line)
+    if not moved or not kept:
+        return None
+
+    kept_file, new_file = next_partition_files(table_name, 2)
+    write_partition(kept_file, header, kept)
+    write_partition(new_file, header, moved)
+    if scheme['method'] == 'range':
+        scheme['bounds'] = [[lower, kept_file if bound_file == file_path else bound_file]
+                            for lower, bound_file in scheme['bounds']]
+        scheme['bounds'].append([bound[1], new_file])
+        scheme['bounds'].sort(key=lambda entry: (-1,) if entry[0] is None else range_key(entry[0]))
+    else:
+        del scheme['buckets'][key]
+        scheme['buckets'][f"{2 * modulus},{remainder}"] = kept_file
+        scheme['buckets'][f"{2 * modulus},{remainder + modulus}"] = new_file
+    manifest = load_manifest(table_name)
+    del manifest[file_path]
+    manifest[kept_file] = rows_stats(header, kept)
+    manifest[new_file] = rows_stats(header, moved)
+    with publish_lock:
+        save_partitioning(table_name, scheme)
+        save_manifest(table_name, manifest)
+        retire_partition_files([file_path])
+    return [kept_file, new_file]
+
+
+def split_full_partitions(table_name, file_paths):
+    # Splits the given partitions, and the partitions split off them, until all are within the scheme's size
+    scheme = load_partitioning(table_name)
+    manifest = load_manifest(table_name)
+    pending = [file_path for file_path in file_paths if manifest[file_path]['rows'] > scheme['size']]
+    while pending:
+        new_files = split_partition(table_name, scheme, pending.pop())
+        if new_files:
+            manifest = load_manifest(table_name)
+            pending += [path for path in new_files if manifest[path]['rows'] > scheme['size']]
+
+
+def rebalance_table(table_name):
+    """
+    Rewrites a partitioned table into evenly filled new partitions of about half the scheme's size.
+    Tables without a scheme are given range partitioning on their first column.
+    """
+    file_paths = partition_files(table_name)
+    if not file_paths:
+        print(f"Table {table_name} does not exist.")
+        return
+    header = read_header(file_paths[0])
+    scheme = load_partitioning(table_name) or new_partitioning(table_name, 'range', header[0])
+    position = header.index(scheme['column'])
+    target = max(1, scheme['size'] // 2)
+    if scheme['method'] == 'range':
+        values = sorted(range_key(row[position]) for file_path in file_paths for row in file_rows(file_path))
+        partition_count = -(-len(values) // target)
+        bounds = sorted({values[i * len(values) // partition_count] for i in range(1, partition_count)}
+                        - {values[0]}) if values else []
+        scheme = new_partitioning(table_name, 'range', scheme['column'], scheme['size'])
+        scheme['bounds'] += [[bound[1], None] for bound in bounds]
+        for entry, new_file in zip(scheme['bounds'], next_partition_files(table_name, len(scheme['bounds']))):
+            entry[1] = new_file
+    else:
+        rows = sum(stats['rows'] for stats in load_manifest(table_name).values())
+        scheme = new_partitioning(table_name, 'hash', scheme['column'], scheme['size'],
+                                  max(scheme['count'], -(-rows // target)))
+        scheme['buckets'] = dict(zip(scheme['buckets'], next_partition_files(table_name, len(scheme['buckets']))))
+
+    codec = data_file_codec(file_paths[0])
+    new_files = sorted(scheme_files(scheme), key=partition_number)
+    outputs = {new_file: open_data_file(new_file, 'wb', codec) for new_file in new_files}
+    manifest = {new_file: empty_partition_stats() for new_file in new_files}
+    try:
+        for output in outputs.values():
+            output.write((','.join(header) + '\n').encode())
+        for file_path in file_paths:
+            for row in file_rows(file_path):
+                new_file = scheme_partition_file(scheme, row[position])
+                outputs[new_file].write((','.join(row) + '\n').encode())
+                manifest[new_file]['rows'] += 1
+                widen_partition_stats(manifest[new_file], header, row)
+    finally:
+        for output in outputs.values():
+            output.close()
+    for new_file, data in zip(new_files, map_partitions(bloom_filter_data, new_files)):
+        write_bloom_filter(new_file, data)  # Not listed in the manifest yet, so not read
+
+    with publish_lock:
+        save_partitioning(table_name, scheme)
+        save_manifest(table_name, manifest)
+        retire_partition_files(file_paths)
+    print(f"Table {table_name} rebalanced into {len(new_files)} partitions.")
+
+
+# Bloom filters
+# Every partition of a partitioned table carries "dbs/<table>_part_N.bloom": a JSON line naming its
+# filtered columns, bits per filter and row capacity, then one Bloom filter per filtered column of
+# bloom_bits_per_key bits per row of the capacity. Every column is filtered, so an equality on a
+# column without an index skips partitions too. The bits of new and renewed rows are set in place before the rows
+# are written, so a filter never lacks a row a reader can see. Growing past the capacity rebuilds
+# the filter, and so do compaction, splits and rebalancing, which also drops the values of deleted
+# rows. Partitions written before filters existed get theirs with their next insert or compaction.
+# An equality condition skips the partitions whose filter lacks its value, after the zone maps, and
+# a hash join skips the partitions of the probe side whose filter of the join column holds none of
+# the keys built.
+# Every value is hashed once, its probes derived by double hashing. Numbers are filtered by value, the
+# way conditions compare them, so "7" and "7.0" share bits; other values by their text, which the
+# equality lookups of str indexes compare.
+bloom_bits_per_key = 10  # About 1% false positives at capacity with bloom_hashes hashes
+bloom_hashes = 7
+bloom_min_capacity = 1024
+bloom_hash_mask = (1 << 64) - 1
+bloom_version = 3  # Filters written with other hashes are not read, and rebuilt with the next insert
+bloom_probe_keys = int(os.environ.get('FILEDB_BLOOM_PROBE_KEYS', 1000))  # Largest join build side probed with
+
+
+def bloom_file_name(data_file):
+    return os.path.splitext(data_file)[0] + '.bloom'
+
+
+def bloom_hash(value):
+    # A 64-bit hash of a value and the odd step between its probes. Hashes of numbers do not vary
+    # between processes; NaN, which equals nothing, is hashed by its text like any other value
+    try:
+        number = float(value)
+    except ValueError:
+        number = math.nan
+    if number == number:
+        h = hash(number) * 0x9E3779B97F4A7C15 & bloom_hash_mask
+    else:
+        h = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little')
+    h ^= h >> 29
+    h = h * 0xBF58476D1CE4E5B9 & bloom_hash_mask
+    h ^= h >> 32
+    return h, (h >> 32) * 0x94D049BB133111EB & bloom_hash_mask | 1
+
+
+def bloom_positions(hashed, bits):
+    h1, h2 = hashed
+    return [position % bits for position in range(h1, h1 + bloom_hashes * h2, h2)]
+
+
+def set_bloom_bits(buffer, starts, bits, values):
+    # Sets the bits of one row's filtered values in the filters starting at the given byte positions of buffer
+    for start, value in zip(starts, values):
+        h1, h2 = bloom_hash(value)
+        for position in range(h1, h1 + bloom_hashes * h2, h2):
+            position %= bits
+            buffer[start + (position >> 3)] |= 1 << (position & 7)
+
+
+def bloom_columns(data_file, header):
+    # Names and positions of the filtered columns of a data file
+    return [(column_name, position) for position, column_name in enumerate(header)]
+
+
+def build_bloom_filter(data_file, capacity=None):
+    # Writes the filters of a data file from its current rows, replacing the old ones
+    write_bloom_filter(data_file, bloom_filter_data(data_file, capacity))
+
+
+def bloom_filter_data(data_file, capacity=None):
+    """
+    Builds the filters of the filtered columns of a data file from its current rows.
+
+    :param data_file: Path to the data file.
+    :param capacity: Rows the filters are sized for, twice the current rows when None.
+    :return: Contents of the filter file.
+    """
+    header = read_header(data_file)
+    columns = bloom_columns(data_file, header)
+    rows = streamed_rows(data_file)
+    if capacity is None:
+        rows = list(rows)
+        capacity = 2 * len(rows)
+    capacity = max(bloom_min_capacity, capacity)
+    size = -(-capacity * bloom_bits_per_key // 8)
+    filters = bytearray(size * len(columns))
+    starts = [i * size for i in range(len(columns))]
+    for row in rows:
+        if len(row) == len(header):
+            set_bloom_bits(filters, starts, size * 8, [row[position] for _, position in columns])
+    meta = {'version': bloom_version, 'columns': [name for name, _ in columns], 'bits': size * 8, 'capacity': capacity}
+    return json.dumps(meta).encode() + b'\n' + filters
+
+
+def write_bloom_filter(data_file, data):
+    tmp_file = temporary_file_name(bloom_file_name(data_file))
+    with open(tmp_file, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_file, bloom_file_name(data_file))
+    count('bloom_filters_built')
+
+
+def read_bloom_meta(file):
+    # The header line of a filter file, None for filters written with other hashes
+    meta = json.loads(file.readline())
+    return meta if meta.get('version') == bloom_version else None
+
+
+def has_bloom_filter(data_file):
+    try:
+        with open(bloom_file_name(data_file), 'rb') as file:
+            return read_bloom_meta(file) is not None
+    except FileNotFoundError:
+        return False
+
+
+def prepare_bloom_filter(data_file, rows):
+    # Builds the filter of a partition about to hold rows rows when it has none or it would be too full
+    try:
+        with open(bloom_file_name(data_file), 'rb') as file:
+            meta = read_bloom_meta(file)
+    except FileNotFoundError:
+        meta = None
+    if rows > (meta['capacity'] if meta else 0):
+        build_bloom_filter(data_file, 2 * rows)
+
+
+def add_to_bloom_filter(data_file, rows):
+    # Sets the bits of rows (comma separated) in the filter of a data file, if it has one
+    try:
+        file = open(bloom_file_name(data_file), 'r+b')
+    except FileNotFoundError:
+        return
+    with file:
+        meta = read_bloom_meta(file)
+        if meta is not None:
+            size = meta['bits'] // 8
+            starts = [file.tell() + i * size for i in range(len(meta['columns']))]
+            header = read_header(data_file)
+            positions = [header.index(name) for name in meta['columns']]
+            with mmap.mmap(file.fileno(), 0) as buffer:
+                for data in rows:
+                    values = data.split(',')
+                    set_bloom_bits(buffer, starts, meta['bits'], [values[position] for position in positions])
+    if meta is None:
+        os.remove(bloom_file_name(data_file))  # The partition is read until its filter is rebuilt
+
+
+def bloom_may_contain(data_file, column_name, hashes):
+    # False only when the filter of the column holds none of the hashed values
+    try:
+        file = open(bloom_file_name(data_file), 'rb')
+    except FileNotFoundError:
+        return True
+    with file:
+        meta = read_bloom_meta(file)
+        if meta is None or column_name not in meta['columns']:
+            return True
+        size = meta['bits'] // 8
+        file.seek(meta['columns'].index(column_name) * size, os.SEEK_CUR)
+        column_filter = file.read(size)
+    return any(all(column_filter[position >> 3] & (1 << (position & 7)) for position in bloom_positions(hashed, meta['bits']))
+               for hashed in hashes)
+
+
+def bloom_pruned_files(file_paths, condition):
+    # The partitions an equality condition may match, by their filters
+    if not condition or condition[1] != '=':
+        return file_paths
+    hashed = [bloom_hash(condition[2])]
+    kept = [file_path for file_path in file_paths if bloom_may_contain(file_path, condition[0], hashed)]
+    count('partitions_skipped_by_bloom_filters', len(file_paths) - len(kept))
+    return kept
+
+
+# Column indexes
+# Every data file "dbs/<name>.csv" gets an index on its first (id) column, plus one for every
+# column listed in the table's "dbs/<table>.indexes" file ("new index on <table> <column>").
+# An index lives in the sidecar "dbs/<name>.<column>.idx": a line of its key type ("float" or "str")
+# and the number of entries written sorted, followed by one entry per row: a packed little-endian
+# (double key, int64 offset) record for float keys, a "key,offset" line for str keys, where offset
+# is the byte position of the row. Appends add unsorted entries at the end. A loaded index is kept
+# in memory as sorted arrays, and the entries appended since are read and merged into a copy of it,
+# so a write costs the next lookup the new entries only.
+index_cache = {}  # index file -> (inode, header line, bytes loaded, index)
+index_record = struct.Struct('<dq')
+index_insert_limit = 1024  # Appended entries inserted one by one, more are merged in one pass
+
+
+def read_header(data_file):
+    with open(data_file, 'rb') as file:  # Binary, the header line of a compressed file is followed by blocks
+        return file.readline().decode().strip().split(',')
+
+
+def table_name_of(data_file):
+    name = os.path.splitext(os.path.basename(data_file))[0]
+    return re.sub(r"_part_-?\d+$", '', name)
+
+
+def table_data_files(table_name):
+    if os.path.exists(f"dbs/{table_name}.csv"):
+        return [f"dbs/{table_name}.csv"]
+    return partition_files(table_name)
+
+
+def indexed_columns(table_name):
+    try:
+        with open(f"dbs/{table_name}.indexes", 'r') as file:
+            return [line.strip() for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def data_file_indexes(data_file, header):
+    # The id column is always indexed, the secondary indexes come from the table's index list
+    columns = [header[0]] + [name for name in indexed_columns(table_name_of(data_file)) if name != header[0]]
+    return [(name, header.index(name)) for name in columns]
+
+
+def index_file_name(data_file, column_name):
+    return f"{os.path.splitext(data_file)[0]}.{column_name}.idx"
+
+
+def parse_keys(values, key_type):
+    return [float(value) for value in values] if key_type == 'float' else list(values)
+
+
+def pack_index_entries(key_type, entries):
+    if key_type == 'float':
+        return b''.join(index_record.pack(key, offset) for key, offset in entries)
+    return ''.join(f"{key},{offset}\n" for key, offset in entries).encode()
+
+
+def unpack_index_entries(key_type, data):
+    """
+    Reads index entries from the bytes following the header line of an index.
+
+    :return: Tuple of (keys, offsets, bytes used). A partly written last entry is left out.
+    """
+    if key_type == 'float':
+        used = len(data) - len(data) % index_record.size
+        keys, offsets = array('d'), array('q')
+        keys.frombytes(data[:used])
+        offsets.frombytes(data[:used])
+        if sys.byteorder == 'big':
+            keys.byteswap()
+            offsets.byteswap()
+        return keys[0::2], offsets[1::2], used
+    used = data.rfind(b'\n') + 1
+    pairs = [line.rsplit(',', 1) for line in data[:used].decode().splitlines()]
+    return [key for key, _ in pairs], array('q', [int(offset) for _, offset in pairs]), used
+
+
+def merge_index_entries(keys, offsets, new_keys, new_offsets):
+    # Returns sorted copies of keys and offsets with the new entries merged in, leaving the originals
+    # untouched for the readers still using them
+    entries = sorted(zip(new_keys, new_offsets))
+    if len(entries) <= index_insert_limit:
+        keys, offsets = keys[:], offsets[:]
+        for key, offset in entries:
+            position = bisect.bisect_right(keys, key)
+            keys.insert(position, key)
+            offsets.insert(position, offset)
+        return keys, offsets
+    merged = list(heapq.merge(zip(keys, offsets), entries))
+    merged_keys = [key for key, _ in merged]
+    return (array('d', merged_keys) if isinstance(keys, array) else merged_keys), array('q', [o for _, o in merged])
+
+
+def stage_index(data_file, column_name, key_type, entries):
+    # Writes an index to a temporary file and returns its name, for the caller to move into place
+    tmp_file = temporary_file_name(index_file_name(data_file, column_name))
+    with open(tmp_file, 'wb') as file:
+        file.write(f"{key_type} {len(entries)}\n".encode())
+        file.write(pack_index_entries(key_type, entries))
+    return tmp_file
+
+
+def write_index(data_file, column_name, key_type, entries):
+    os.replace(stage_index(data_file, column_name, key_type, entries), index_file_name(data_file, column_name))
+
+
+def drop_index(data_file, column_name):
+    idx_file = index_file_name(data_file, column_name)
+    index_cache.pop(idx_file, None)
+    if os.path.exists(idx_file):
+        os.remove(idx_file)
+
+
+def build_index(data_file, column_name):
+    column_index = read_header(data_file).index(column_name)
+    values, offsets = [], []
+    with publish_lock:  # No append may land between the scan and the index
+        for offset, line in scan_rows(data_file):
+            values.append(line.strip().split(',')[column_index])
+            offsets.append(offset)
+        try:
+            key_type, keys = 'float', parse_keys(values, 'float')
+        except ValueError:
+            key_type, keys = 'str', values  # Non-numeric columns only answer equality lookups
+        write_index(data_file, column_name, key_type, sorted(zip(keys, offsets)))
+
+
+def refresh_index(data_file, column_name):
+    idx_file = index_file_name(data_file, column_name)
+    with publish_lock:
+        if not os.path.exists(idx_file) or os.stat(data_file).st_mtime_ns > os.stat(idx_file).st_mtime_ns:
+            build_index(data_file, column_name)  # Missing, or the data file was changed behind the index's back
+
+
+def load_index(data_file, column_name):
+    """
+    Loads a column index of a data file, building it first if it is missing or stale.
+
+    :param data_file: Path to the data file.
+    :param column_name: Indexed column.
+    :return: Tuple of (key type, sorted keys, offsets).
+    """
+    idx_file = index_file_name(data_file, column_name)
+    refresh_index(data_file, column_name)
+    with open(idx_file, 'rb') as file:
+        stat = os.fstat(file.fileno())
+        header = file.readline()
+        key_type, *sorted_count = header.decode().split()
+        cached = index_cache.get(idx_file)
+        if cached and cached[:2] == (stat.st_ino, header) and cached[2] <= stat.st_size:
+            _, _, loaded, index = cached
+            if loaded == stat.st_size:
+                return index
+            file.seek(loaded)  # Merge the entries appended since
+            keys, offsets, used = unpack_index_entries(key_type, file.read())
+            index = (key_type, *merge_index_entries(index[1], index[2], keys, offsets))
+        else:
+            if not sorted_count:
+                file.close()
+                build_index(data_file, column_name)  # Written in the old text format
+                return load_index(data_file, column_name)
+            keys, offsets, used = unpack_index_entries(key_type, file.read())
+            loaded, sorted_count = len(header), int(sorted_count[0])
+            index = (key_type, *merge_index_entries(keys[:sorted_count], offsets[:sorted_count],
+                                                    keys[sorted_count:], offsets[sorted_count:]))
+    index_cache[idx_file] = (stat.st_ino, header, loaded + used, index)
+    return index
+
+
+def scan_rows(data_file, snapshot=None):
+    # Yields (offset, line) for every row of a data file, or of the base file of a snapshot
+    file, size, _ = snapshot or open_snapshot(data_file)
+    rows = 0
+    with file:
+        offset = len(file.readline())  # Skip the header
+        try:
+            for line in file:
+                if offset >= size:
+                    break  # Appended after the snapshot was taken
+                if line.strip():
+                    rows += 1
+                    yield offset, line.decode()
+                offset += len(line)
+        finally:
+            count('rows_scanned', rows)
+            count('bytes_read', offset)
+
+
+# Mutation log
+# remove / renew do not rewrite a data file: they append records to its sidecar "dbs/<name>.log",
+# "D,<offset>" to delete the row at that offset of the base file and "U,<offset>,<line>" to replace it.
+# Readers merge the log over the base file. "compact <table>", or any mutation that grows a log past
+# compaction_threshold records, folds the log into the base file through rewrite_rows and clears it.
+compaction_threshold = int(os.environ.get('FILEDB_COMPACT_AFTER', 1000))
+mutation_log_cache = {}
+
+
+def log_file_name(data_file):
+    return os.path.splitext(data_file)[0] + '.log'
+
+
+def load_mutation_log(data_file):
+    """
+    Loads the pending mutations of a data file.
+
+    :return: Dict mapping a base file row offset to its new line, or to None for a deleted row.
+    """
+    log_file = log_file_name(data_file)
+    try:
+        stat = os.stat(log_file)
+    except FileNotFoundError:
+        return {}
+    cached = mutation_log_cache.get(log_file)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+
+    mutations = {}
+    with open(log_file, 'r') as file:
+        for record in file:
+            if not record.endswith('\n'):
+                break  # Still being written by another process
+            kind, offset, *line = record.rstrip('\n').split(',', 2)
+            mutations[int(offset)] = line[0] + '\n' if kind == 'U' else None  # Later records win
+    mutation_log_cache[log_file] = ((stat.st_mtime_ns, stat.st_size), mutations)
+    return mutations
+
+
+def append_mutations(data_file, mutations):
+    records = ''.join(f"D,{offset}\n" if line is None else f"U,{offset},{line.rstrip()}\n"
+                      for offset, line in mutations.items())
+    add_to_bloom_filter(data_file, [line.strip() for line in mutations.values() if line is not None])
+    with publish_lock:
+        with open(log_file_name(data_file), 'a') as file:
+            file.write(records)
+        invalidate_buffer_pool(data_file)
+    if len(load_mutation_log(data_file)) > compaction_threshold:
+        compact_data_file(data_file)
+
+
+def compact_data_file(data_file):
+    mutations = load_mutation_log(data_file)
+    if mutations:
+        rewrite_rows(data_file, mutations)  # Clears the log along with publishing the new base file
+        if os.path.exists(bloom_file_name(data_file)):
+            build_bloom_filter(data_file)  # Without the values of the rows deleted and overwritten
+        return
+    with publish_lock:
+        clear_mutation_log(data_file)
+
+
+def clear_mutation_log(data_file):
+    mutation_log_cache.pop(log_file_name(data_file), None)
+    if os.path.exists(log_file_name(data_file)):
+        os.remove(log_file_name(data_file))
+    invalidate_buffer_pool(data_file)
+
+
+def compact_table(table_name):
+    if is_fixed_width(table_name):
+        compact_table_fixed(table_name)
+        return
+    if os.path.exists(f"dbs/{table_name}.csv"):
+        compact_data_file(f"dbs/{table_name}.csv")
+        return
+    file_paths = partition_files(table_name)
+    for file_path in file_paths:
+        compact_data_file(file_path)  # Rewrites stay in this process, under the table lock
+    missing = [file_path for file_path in file_paths if not has_bloom_filter(file_path)]
+    for file_path, data in zip(missing, map_partitions(bloom_filter_data, missing)):
+        write_bloom_filter(file_path, data)
+    # Tighten the zone maps now that deleted and overwritten values are gone
+    save_manifest(table_name, {file_path: partition_stats(file_path) for file_path in file_paths})
+
+
+def live_rows(data_file):
+    # Yields (offset, line) for every row of a snapshot of a data file with its mutation log applied
+    snapshot = open_snapshot(data_file)
+    mutations = snapshot[2]
+    if not mutations:
+        yield from scan_rows(data_file, snapshot)
+        return
+    for offset, line in scan_rows(data_file, snapshot):
+        if offset in mutations:
+            line = mutations[offset]
+            if line is None:
+                continue
+        yield offset, line
+
+
+def live_lines(data_file):
+    # Lines of every row with the mutation log applied
+    for _, line in live_rows(data_file):
+        yield line
+
+
+# Block-compressed tables
+# "new table <name> ... using zlib" (or lzma, for new_p tables too) stores every data file of the
+# table as its plain header line followed by blocks of whole rows, each a (raw length, compressed
+# length) struct and the compressed bytes; the codec is kept in "dbs/<table>.codec". Offsets in
+# indexes and mutation logs are positions in the uncompressed file, so the engine reads and writes
+# compressed files through BlockReader / BlockWriter as it would plain ones: a scan decompresses one
+# block after the other, an index lookup only the block holding its row. Appends add new blocks,
+# compaction rewrites the file into blocks of block_size uncompressed bytes.
+codecs = {'zlib': (zlib.compress, zlib.decompress), 'lzma': (lzma.compress, lzma.decompress)}
+block_header = struct.Struct('<II')
+block_size = int(os.environ.get('FILEDB_BLOCK_SIZE', 64 * 1024))
+table_codecs = {}
+block_index_cache = {}  # data file -> (inode, mtime, file size, block index)
+
+
+def codec_file_name(table_name):
+    return f"dbs/{table_name}.codec"
+
+
+def set_table_codec(table_name, codec):
+    if codec not in codecs:
+        raise ValueError(f"Unknown codec: {codec}")
+    with open(codec_file_name(table_name), 'w') as file:
+        file.write(codec + '\n')
+    table_codecs[table_name] = codec
+
+
+def data_file_codec(data_file):
+    # Codec of the table a data file belongs to, None for plain tables
+    table_name = table_name_of(data_file)
+    if table_name not in table_codecs:
+        try:
+            with open(codec_file_name(table_name), 'r') as file:
+                table_codecs[table_name] = file.read().strip()
+        except FileNotFoundError:
+            return None
+    return table_codecs[table_name]
+
+
+def block_index(data_file, file, size):
+    """
+    Lists the complete blocks within the first size bytes of a compressed data file, walking the block headers.
+    The list is kept per file and extended when the file has grown by appends.
+
+    :return: Tuple of (uncompressed start offsets, file positions, stored lengths, uncompressed end, file end),
+             with the header line as block 0.
+    """
+    stat = os.fstat(file.fileno())
+    cached = block_index_cache.get(data_file)
+    if cached and cached[:3] == (stat.st_ino, stat.st_mtime_ns, size):
+        return cached[3]
+    if cached and cached[0] == stat.st_ino and cached[3][4] <= size and cached[3][1][-1] > 0:
+        # Same file, unless the inode was reused: the last known block header must still be in place
+        starts, positions, lengths, logical, end = cached[3]
+        file.seek(positions[-1] - block_header.size)
+        if block_header.unpack(file.read(block_header.size))[1] != lengths[-1]:
+            cached = None
+    else:
+        cached = None
+    if cached:
+        starts, positions, lengths = list(starts), list(positions), list(lengths)
+    else:
+        file.seek(0)
+        header = file.readline()
+        starts, positions, lengths, logical, end = [0], [0], [len(header)], len(header), len(header)
+    while end + block_header.size <= size:
+        file.seek(end)
+        raw_length, stored_length = block_header.unpack(file.read(block_header.size))
+        if end + block_header.size + stored_length > size:
+            break  # Cut short by a failed write
+        starts.append(logical)
+        positions.append(end + block_header.size)
+        lengths.append(stored_length)
+        logical += raw_length
+        end += block_header.size + stored_length
+    index = (starts, positions, lengths, logical, end)
+    with cache_lock:
+        block_index_cache[data_file] = (stat.st_ino, stat.st_mtime_ns, size, index)
+    return index
+
+
+class BlockReader:
+    # Read-only binary file over the uncompressed contents of a compressed data file
+    def __init__(self, data_file, file, size):
+        self.file = file
+        self.starts, self.positions, self.lengths, self.size, _ = block_index(data_file, file, size)
+        self.decompress = codecs[data_file_codec(data_file)][1]
+        self.block, self.data = None, b''
+        self.position = 0
+
+    def load(self):
+        # Decompresses the block holding the current position, returns the position within it
+        block = bisect.bisect_right(self.starts, self.position) - 1
+        if block != self.block:
+            self.file.seek(self.positions[block])
+            data = self.file.read(self.lengths[block])
+            self.block, self.data = block, (self.decompress(data) if block else data)
+        return self.position - self.starts[block]
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        parts = []
+        while self.position < end:
+            start = self.load()
+            parts.append(self.data[start:start + end - self.position])
+            self.position += len(parts[-1])
+        return b''.join(parts)
+
+    def readline(self):
+        parts = []
+        while self.position < self.size:
+            start = self.load()
+            end = self.data.find(b'\n', start) + 1 or len(self.data)
+            parts.append(self.data[start:end])
+            self.position += end - start
+            if parts[-1].endswith(b'\n'):
+                break
+        return b''.join(parts)
+
+    def __iter__(self):
+        # Blocks hold whole lines, so every line comes from a single block
+        while self.position < self.size:
+            start = self.load()
+            for line in io.BytesIO(self.data[start:self.size - self.starts[self.block]]):
+                self.position += len(line)
+                yield line
+
+    def seek(self, position, whence=0):
+        self.position = position if whence == 0 else (self.position + position if whence == 1 else self.size + position)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BlockWriter:
+    # Writes whole lines to the end of a compressed data file, cut into blocks of about block_size bytes
+    def __init__(self, file, codec, position):
+        self.file = file
+        self.compress = codecs[codec][0]
+        self.position = position  # Uncompressed end of the file
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        self.position += len(data)
+        if self.pending_size >= 2 * block_size:
+            self.flush(final=False)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self, final=True):
+        data = b''.join(self.pending)
+        start = 0
+        if self.file.tell() == 0:
+            start = data.find(b'\n') + 1  # The header line of a new file stays plain
+            self.file.write(data[:start])
+        while start < len(data):
+            if len(data) - start <= block_size:
+                if not final:
+                    break
+                cut = len(data)
+            else:
+                cut = data.rfind(b'\n', start, start + block_size) + 1 or data.find(b'\n', start + block_size) + 1
+                if not cut:
+                    if not final:
+                        break
+                    cut = len(data)
+            payload = self.compress(data[start:cut])
+            self.file.write(block_header.pack(cut - start, len(payload)) + payload)
+            start = cut
+        self.pending = [data[start:]]
+        self.pending_size = len(data) - start
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_data_file(data_file, mode='rb', codec=None):
+    """
+    Opens a data file in binary mode, through its table's codec when it has one.
+
+    :param data_file: Path to the data file.
+    :param mode: 'rb' to read, 'ab' to append whole lines, 'wb' to write a new file starting with its header line.
+    :param codec: Codec of a new file, by default the codec of the table of data_file.
+    :return: File-like object whose offsets are positions in the uncompressed file.
+    """
+    codec = codec or data_file_codec(data_file)
+    if not codec:
+        return open(data_file, mode)
+    if mode == 'rb':
+        file = open(data_file, 'rb')
+        return BlockReader(data_file, file, os.fstat(file.fileno()).st_size)
+    if mode == 'wb':
+        return BlockWriter(open(data_file, 'wb'), codec, 0)
+    file = open(data_file, 'r+b')
+    _, _, _, logical, end = block_index(data_file, file, os.fstat(file.fileno()).st_size)
+    file.seek(end)
+    file.truncate()  # Drops a block left incomplete by a failed write
+    return BlockWriter(file, codec, logical)
+
+
+# Buffer pool
+# The live rows of recently read data files stay in memory, split into values, so the commands of a
+# session do not re-read and re-split the same files. Entries are checked against the size and mtime
+# of the data file and its mutation log on every use, and dropped by the writers in this process.
+# buffer_pool_limit bounds the memory the held rows take, as measured when a file is loaded; least
+# recently used files are evicted first.
+buffer_pool_limit = int(os.environ.get('FILEDB_BUFFER_POOL', 64 * 1024 * 1024))
+buffer_pool = OrderedDict()  # data file -> (file version, bytes of memory, rows)
+buffer_pool_bytes = 0
+
+
+def file_version(data_file):
+    stat = os.stat(data_file)
+    try:
+        log_stat = os.stat(log_file_name(data_file))
+        log_version = (log_stat.st_mtime_ns, log_stat.st_size)
+    except FileNotFoundError:
+        log_version = None
+    return stat.st_mtime_ns, stat.st_size, log_version
+
+
+def invalidate_buffer_pool(data_file):
+    global buffer_pool_bytes
+    with cache_lock:
+        entry = buffer_pool.pop(data_file, None)
+        if entry:
+            buffer_pool_bytes -= entry[1]
+
+
+def set_buffer_pool(limit):
+    global buffer_pool_limit
+    if limit < 0:
+        raise ValueError("Buffer pool size can not be negative")
+    with cache_lock:
+        buffer_pool_limit = limit
+        evict_buffer_pool()
+    shutdown_worker_pool()  # Workers pick up the new budget when they are started again
+
+
+def evict_buffer_pool():
+    global buffer_pool_bytes
+    while buffer_pool_bytes > buffer_pool_limit:
+        _, (_, size, _) = buffer_pool.popitem(last=False)
+        buffer_pool_bytes -= size
+
+
+def in_buffer_pool(data_file):
+    with cache_lock:
+        entry = buffer_pool.get(data_file)
+    return bool(entry) and entry[0] == file_version(data_file)
+
+
+def scans_bytes(data_file):
+    # Whether a conditioned read scans the bytes of a data file (see "Byte scanner") rather than the
+    # buffer pool: it does unless the pool already holds the current version of the file. Loading the
+    # pool costs more than a byte scan, so conditioned reads never load it.
+    return not in_buffer_pool(data_file)
+
+
+def buffered_rows(data_file, version):
+    # The rows the buffer pool holds for a version of a data file, or None
+    with cache_lock:
+        entry = buffer_pool.get(data_file)
+        if entry and entry[0] == version:
+            buffer_pool.move_to_end(data_file)
+            count('buffer_pool_hits')
+            count('rows_scanned', len(entry[2]))
+            return entry[2]
+    return None
+
+
+def row_memory(row):
+    # Bytes a row split into values takes in memory
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+
+def pooled_rows(data_file):
+    """
+    Returns the live rows of a data file split into values, from the buffer pool when the file is unchanged.
+    Files whose rows take more memory than the whole pool are streamed instead. The rows are shared, callers
+    must not modify them.
+
+    :param data_file: Path to the data file.
+    :return: List (or iterator, for files that do not fit) of rows.
+    """
+    global buffer_pool_bytes
+    version = file_version(data_file)  # Taken before reading, so rows newer than it are never kept under it
+    rows = buffered_rows(data_file, version)
+    if rows is not None:
+        return rows
+    count('buffer_pool_misses')
+    invalidate_buffer_pool(data_file)
+    lines = live_lines(data_file)
+    if version[1] + (version[2][1] if version[2] else 0) > buffer_pool_limit:
+        return (line.strip().split(',') for line in lines)  # Rows take more memory than their bytes
+    rows, size = [], sys.getsizeof([])
+    for line in lines:
+        values = line.strip().split(',')
+        rows.append(values)
+        size += row_memory(values) + 8  # And the list's pointer to it
+        if size > buffer_pool_limit:
+            return chain(rows, (line.strip().split(',') for line in lines))
+    with cache_lock:
+        if data_file not in buffer_pool:
+            buffer_pool[data_file] = (version, size, rows)
+            buffer_pool_bytes += size
+            evict_buffer_pool()
+    return rows
+
+
+def streamed_rows(data_file):
+    """
+    Returns the live rows of a data file split into values without loading the file into the buffer pool,
+    for the commands that bound their own memory (external sort, joins, hash aggregation) and the sidecar
+    builders. A file the pool already holds is read from there.
+
+    :param data_file: Path to the data file.
+    :return: List or iterator of rows, which callers must not modify.
+    """
+    rows = buffered_rows(data_file, file_version(data_file))
+    if rows is not None:
+        return rows
+    return (line.strip().split(',') for line in live_lines(data_file))
+
+
+def append_rows(data_file, rows):
+    # Appends rows to a data file and records their offsets in every index that is current.
+    header = read_header(data_file)
+    current = []
+    for column_name, column_index in data_file_indexes(data_file, header):
+        idx_file = index_file_name(data_file, column_name)
+        if os.path.exists(idx_file) and os.stat(idx_file).st_mtime_ns >= os.stat(data_file).st_mtime_ns:
+            with open(idx_file, 'rb') as file:
+                current.append((column_name, column_index, file.readline().decode().split()[0]))
+
+    lines = [f"{data}\n".encode() for data in rows]
+    add_to_bloom_filter(data_file, rows)  # Before the rows can be read
+    index_values = []
+    for column_name, column_index, key_type in current:
+        try:
+            values = parse_keys([data.split(',')[column_index] for data in rows], key_type)
+        except ValueError:
+            values = None  # The index is dropped and rebuilt with the right key type on next use
+        index_values.append((column_name, key_type, values))
+
+    with publish_lock:
+        with open_data_file(data_file, 'ab') as file:
+            offset = file.tell()
+            file.write(b''.join(lines))
+        offsets = []
+        for line in lines:
+            offsets.append(offset)
+            offset += len(line)
+        for column_name, key_type, values in index_values:
+            if values is None:
+                drop_index(data_file, column_name)
+                continue
+            with open(index_file_name(data_file, column_name), 'ab') as file:
+                file.write(pack_index_entries(key_type, zip(values, offsets)))
+        invalidate_buffer_pool(data_file)
+
+
+def index_offsets(index, operator, condition_value):
+    # Returns offsets of the rows whose key satisfies the condition, in file order.
+    _, keys, offsets = index
+    if operator == '=':
+        low, high = bisect.bisect_left(keys, condition_value), bisect.bisect_right(keys, condition_value)
+    elif operator == '>':
+        low, high = bisect.bisect_right(keys, condition_value), len(keys)
+    elif operator == '>=':
+        low, high = bisect.bisect_left(keys, condition_value), len(keys)
+    elif operator == '<':
+        low, high = 0, bisect.bisect_left(keys, condition_value)
+    elif operator == '<=':
+        low, high = 0, bisect.bisect_right(keys, condition_value)
+    else:
+        raise ValueError(f"Unknown operator: {operator}")
+    return sorted(offsets[low:high])
+
+
+def indexed_rows(data_file, header, condition):
+    """
+    Seeks straight to the rows matching a condition on an indexed column.
+
+    :param data_file: Path to the data file.
+    :param header: Header of the data file.
+    :param condition: Tuple of (column name, operator, value).
+    :return: List of (offset, line) pairs, or None if no index can answer the condition.
+    """
+    if not condition:
+        return None
+    column_name, operator, condition_value = condition
+    if column_name not in [name for name, _ in data_file_indexes(data_file, header)]:
+        return None
+    with publish_lock:
+        index = load_index(data_file, column_name)
+        file, size, mutations = open_snapshot(data_file)
+    if index[0] == 'str' and operator != '=' or index[0] == 'float' and not is_number(condition_value):
+        file.close()
+        return None  # Scanned, comparing as text
+    condition_value = parse_keys([condition_value], index[0])[0]
+    offsets = [offset for offset in index_offsets(index, operator, condition_value) if offset < size]
+    if mutations:
+        # The index holds base file values, rows updated since the last compaction are checked again
+        offsets = sorted(set(offsets) | {offset for offset, line in mutations.items() if line is not None})
+    column_index = header.index(column_name)
+    rows = []
+    with file:
+        for offset in offsets:
+            if offset in mutations:
+                line = mutations[offset]
+                if line is None or not line_meets(line, column_index, operator, condition_value, index[0]):
+                    continue
+            else:
+                file.seek(offset)
+                line = file.readline().decode()
+                count('bytes_read', len(line))
+            rows.append((offset, line))
+    count('index_lookups')
+    count('rows_scanned', len(rows))
+    return rows
+
+
+def line_meets(line, column_index, operator, condition_value, key_type):
+    value = line.strip().split(',')[column_index]
+    if key_type == 'str':
+        return value == condition_value
+    try:
+        return is_condition_met(float(value), operator, condition_value)
+    except ValueError:
+        return False
+
+
+def matching_rows(data_file, header, condition):
+    # Rows meeting the condition, through an index when there is one
+    rows = indexed_rows(data_file, header, condition)
+    if rows is not None:
+        return rows
+    predicate = compile_condition(header, condition)
+    return [(offset, line) for offset, line in live_rows(data_file) if predicate(line.strip().split(','))]
+
+
+def copy_bytes(source, destination, length):
+    while length > 0:
+        chunk = source.read(min(length, 1 << 20))
+        if not chunk:
+            break
+        destination.write(chunk)
+        length -= len(chunk)
+
+
+def rewrite_rows(data_file, replacements):
+    """
+    Replaces or drops single rows of a data file, copying all other bytes through unparsed,
+    and shifts every index of the file to the new offsets. The new file, its indexes and the
+    cleared mutation log, whose offsets point into the old file, are published together.
+
+    :param data_file: Path to the data file.
+    :param replacements: Dict mapping a row offset to its new line, or to None to drop the row.
+    """
+    header = read_header(data_file)
+    indexes = [(column_name, column_index, load_index(data_file, column_name))
+               for column_name, column_index in data_file_indexes(data_file, header)]
+    changed, deltas, new_lines = [], [], []
+    delta = 0
+    tmp_file = temporary_file_name(data_file)
+    with open_data_file(data_file) as source, \
+            open_data_file(tmp_file, 'wb', data_file_codec(data_file)) as destination:
+        position = 0
+        for offset in sorted(replacements):
+            copy_bytes(source, destination, offset - position)
+            old_line = source.readline()
+            position = offset + len(old_line)
+            new_line = replacements[offset]
+            if new_line is not None:
+                new_lines.append((new_line.strip().split(','), offset + delta))
+                destination.write(new_line.encode())
+                delta += len(new_line.encode()) - len(old_line)
+            else:
+                delta -= len(old_line)
+            changed.append(offset)
+            deltas.append(delta)
+        shutil.copyfileobj(source, destination)
+
+    staged, dropped = [], []
+    for column_name, column_index, (key_type, keys, offsets) in indexes:
+        try:
+            entries = list(zip(parse_keys([values[column_index] for values, _ in new_lines], key_type),
+                               [offset for _, offset in new_lines]))
+        except ValueError:
+            dropped.append(column_name)
+            continue
+        for key, offset in zip(keys, offsets):
+            if offset in replacements:
+                continue
+            position = bisect.bisect_right(changed, offset)
+            entries.append((key, offset + deltas[position - 1] if position else offset))
+        entries.sort()
+        staged.append((stage_index(data_file, column_name, key_type, entries), index_file_name(data_file, column_name)))
+
+    with publish_lock:
+        os.replace(tmp_file, data_file)
+        for staged_file, idx_file in staged:
+            os.replace(staged_file, idx_file)
+        for column_name in dropped:
+            drop_index(data_file, column_name)
+        clear_mutation_log(data_file)
+
+
+def create_index(table_name, column_name):
+    data_files = table_data_files(table_name)
+    if not data_files:
+        print(f"Table {table_name} does not exist.")
+        return
+    read_header(data_files[0]).index(column_name)  # Fails on unknown columns
+    if column_name not in indexed_columns(table_name):
+        with open(f"dbs/{table_name}.indexes", 'a') as file:
+            file.write(column_name + '\n')
+    for data_file in data_files:
+        build_index(data_file, column_name)
+    print(f"Index on {table_name}.{column_name} created.")
+
+
+# Columnar tables
+# "new table <name> <column>[:<type>] ... using columnar" stores a table as the directory
+# "dbs/<name>.col" holding a "schema" file of "column:type" lines and one array file per column.
+# int and float columns are packed machine values ("<column>.int" / "<column>.float"); str columns
+# keep their UTF-8 bytes in "<column>.str" and the end offset of every value in "<column>.off".
+# Reads memory-map only the columns a command references, so no text is tokenized.
+column_typecodes = {'int': 'q', 'float': 'd'}
+
+
+class StrColumn:
+    # Sequence view over a memory-mapped str column, decoding a value only when it is accessed
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        start = self.offsets[position - 1] if position else 0
+        return self.data[start:self.offsets[position]].decode()
+
+
+def columnar_dir(table_name):
+    return f"dbs/{table_name}.col"
+
+
+def is_columnar(table_name):
+    return os.path.isdir(columnar_dir(table_name))
+
+
+def read_schema(table_name):
+    with open(f"{columnar_dir(table_name)}/schema", 'r') as file:
+        return [tuple(line.strip().split(':')) for line in file if line.strip()]
+
+
+def column_files(table_name, column_name, column_type):
+    base = f"{columnar_dir(table_name)}/{column_name}"
+    return [f"{base}.{column_type}"] if column_type in column_typecodes else [f"{base}.off", f"{base}.str"]
+
+
+def create_table_columnar(table_name, headers):
+    ensure_db_directory()
+    if is_columnar(table_name) or is_fixed_width(table_name) or os.path.exists(f"dbs/{table_name}.csv"):
+        print(f"Table {table_name} already exists.")
+        return
+    schema = [tuple(header.split(':')) if ':' in header else (header, 'str') for header in headers]
+    for column_name, column_type in schema:
+        if column_type not in ('int', 'float', 'str'):
+            raise ValueError(f"Unknown column type: {column_type}")
+    os.makedirs(columnar_dir(table_name))
+    with open(f"{columnar_dir(table_name)}/schema", 'w') as file:
+        for column_name, column_type in schema:
+            file.write(f"{column_name}:{column_type}\n")
+            for path in column_files(table_name, column_name, column_type):
+                open(path, 'wb').close()
+    print(f"Table {table_name} created.")
+
+
+def write_column(table_name, column_name, column_type, values, mode='ab'):
+    """
+    Appends values to a column, or with mode 'wb' writes the whole column to temporary files.
+
+    :return: List of (temporary file, column file) pairs for replace_columns to publish, empty when appending.
+    """
+    paths = column_files(table_name, column_name, column_type)
+    targets = paths if mode == 'ab' else [temporary_file_name(path) for path in paths]
+    if column_type in column_typecodes:
+        with open(targets[0], mode) as file:
+            array(column_typecodes[column_type], values).tofile(file)
+    else:
+        offsets_file, data_file = targets
+        end = os.path.getsize(data_file) if mode == 'ab' else 0
+        ends = array('Q')
+        with open(data_file, mode) as file:
+            for value in values:
+                encoded = value.encode()
+                file.write(encoded)
+                end += len(encoded)
+                ends.append(end)
+        with open(offsets_file, mode) as file:
+            ends.tofile(file)
+    return [] if mode == 'ab' else list(zip(targets, paths))
+
+
+def replace_columns(staged):
+    # Moves rewritten columns into place at once, readers that mapped the old files keep them
+    with publish_lock:
+        for tmp_file, path in staged:
+            os.replace(tmp_file, path)
+
+
+def insert_rows_columnar(table_name, rows):
+    schema = read_schema(table_name)
+    converted = []
+    for data in rows:
+        values = data.split(',')
+        if len(values) != len(schema):
+            raise ValueError(f"Expected {len(schema)} values, got {len(values)}")
+        converted.append([int(value) if column_type == 'int' else float(value) if column_type == 'float' else value
+                          for value, (_, column_type) in zip(values, schema)])
+    # Every value is converted before any column is written so a bad value leaves the table untouched
+    with publish_lock:
+        for position, (column_name, column_type) in enumerate(schema):
+            write_column(table_name, column_name, column_type, [values[position] for values in converted])
+
+
+def map_file(path):
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def map_column(table_name, column_name, column_type):
+    """
+    Memory-maps one column of a columnar table.
+
+    :return: Sequence of the column's native values.
+    """
+    if column_type in column_typecodes:
+        mapped = map_file(column_files(table_name, column_name, column_type)[0])
+        return memoryview(mapped).cast(column_typecodes[column_type]) if mapped else []
+    offsets_file, data_file = column_files(table_name, column_name, column_type)
+    offsets = map_file(offsets_file)
+    return StrColumn(memoryview(offsets).cast('Q') if offsets else [], map_file(data_file))
+
+
+def map_columns(table_name, schema):
+    # Maps the columns of a schema at one point in time, so all of them hold the same rows
+    with publish_lock:
+        return {column_name: map_column(table_name, column_name, column_type) for column_name, column_type in schema}
+
+
+def format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def columnar_matches(columns, schema, condition):
+    # Positions of the rows meeting the condition, comparing native column values of mapped columns
+    row_count = len(columns[schema[0][0]])
+    count('rows_scanned', row_count)
+    if not condition:
+        return range(row_count)
+    column_name, operator, condition_value = condition
+    column_type = dict(schema)[column_name]
+    column = columns[column_name]
+    if column_type == 'str' and operator == '=':
+        return [i for i in range(row_count) if column[i] == condition_value]
+    compare, condition_value = condition_operators[operator], float(condition_value)
+    if column_type == 'str':
+        return [i for i in range(row_count) if compare(float(column[i]), condition_value)]
+    return [i for i in range(row_count) if compare(column[i], condition_value)]
+
+
+@timed_stage('scan')
+def query_data_columnar(table_name, column_names, condition=None):
+    schema = read_schema(table_name)
+    mapped = map_columns(table_name, schema)
+    columns = [mapped[name] for name in column_names]
+    for i in columnar_matches(mapped, schema, condition):
+        yield ','.join(format_value(column[i]) for column in columns)
+
+
+def delete_data_columnar(table_name, condition):
+    schema = read_schema(table_name)
+    mapped = map_columns(table_name, schema)
+    deleted = set(columnar_matches(mapped, schema, condition))
+    if not deleted:
+        return
+    staged = []
+    for column_name, column_type in schema:
+        column = mapped[column_name]
+        kept = [column[i] for i in range(len(column)) if i not in deleted]
+        staged.extend(write_column(table_name, column_name, column_type, kept, 'wb'))
+    replace_columns(staged)
+
+
+def update_data_columnar(table_name, condition, updates):
+    schema = read_schema(table_name)
+    types = dict(schema)
+    mapped = map_columns(table_name, schema)
+    positions = list(columnar_matches(mapped, schema, condition))
+    if not positions:
+        return
+    staged = []
+    for column_name, new_val in updates:
+        column_type = types[column_name]
+        column = mapped[column_name]
+        if column_type in column_typecodes:
+            # Fixed-width columns are copied as a whole and patched, readers keep the old file
+            values = array(column_typecodes[column_type])
+            values.frombytes(column.tobytes())
+            new_val = int(new_val) if column_type == 'int' else float(new_val)
+            for i in positions:
+                values[i] = new_val
+        else:
+            updated = set(positions)
+            values = [new_val if i in updated else column[i] for i in range(len(column))]
+        staged.extend(write_column(table_name, column_name, column_type, values, 'wb'))
+    replace_columns(staged)
+
+
+# Fixed-width tables
+# "new table <name> <column>:<type> ..." with int, float and str<N> columns (at most N bytes of UTF-8)
+# stores a table in "dbs/<name>.rows": a "column:type,..." schema line followed by one struct-packed
+# record per row, a live flag and the values. Values are decoded once into native ints, floats and
+# strs, so conditions and sorts compare them natively. Row n sits at offset len(schema line) +
+# n * record size, so remove clears the live flag and renew overwrites records where they stand;
+# compact drops the removed records. Readers copy the records under publish_lock and writers change
+# them under it, so a reader sees all the records of a remove / renew changed or none.
+fixed_typecodes = {'int': 'q', 'float': 'd'}
+fixed_str_type = re.compile(r'str(\d+)')
+
+
+def fixed_file(table_name):
+    return f"dbs/{table_name}.rows"
+
+
+def is_fixed_width(table_name):
+    return os.path.exists(fixed_file(table_name))
+
+
+def fixed_record(schema):
+    # Struct of one record: the live flag, then every value in schema order
+    codes = [fixed_typecodes[column_type] if column_type in fixed_typecodes
+             else f"{fixed_str_type.fullmatch(column_type).group(1)}s" for _, column_type in schema]
+    return struct.Struct('<?' + ''.join(codes))
+
+
+def parse_fixed_schema(headers):
+    schema = []
+    for header in headers:
+        column_name, _, column_type = header.partition(':')
+        if column_type not in fixed_typecodes and not fixed_str_type.fullmatch(column_type):
+            raise ValueError(f"Column {column_name} needs a type: int, float or str<N>")
+        schema.append((column_name, column_type))
+    return schema
+
+
+def read_fixed_schema(table_name):
+    """
+    Reads the schema line of a fixed-width table.
+
+    :return: Tuple of (list of (column name, type), size of the schema line, record struct).
+    """
+    with open(fixed_file(table_name), 'rb') as file:
+        line = file.readline()
+    schema = [tuple(column.split(':')) for column in line.decode().strip().split(',')]
+    return schema, len(line), fixed_record(schema)
+
+
+def create_table_fixed(table_name, headers):
+    ensure_db_directory()
+    if is_fixed_width(table_name) or is_columnar(table_name) or os.path.exists(f"dbs/{table_name}.csv"):
+        print(f"Table {table_name} already exists.")
+        return
+    schema = parse_fixed_schema(headers)
+    with open(fixed_file(table_name), 'w') as file:
+        file.write(','.join(f"{column_name}:{column_type}" for column_name, column_type in schema) + '\n')
+    print(f"Table {table_name} created.")
+
+
+def native_value(value, column_type):
+    # Converts a value given in a command to the form it is packed in
+    if column_type == 'int':
+        return int(value)
+    if column_type == 'float':
+        return float(value)
+    encoded = value.encode()
+    if len(encoded) > int(column_type[3:]):
+        raise ValueError(f"Value {value} is longer than {column_type[3:]} bytes")
+    return encoded
+
+
+def insert_rows_fixed(table_name, rows):
+    schema, _, record = read_fixed_schema(table_name)
+    records = []
+    for data in rows:
+        values = data.split(',')
+        if len(values) != len(schema):
+            raise ValueError(f"Expected {len(schema)} values, got {len(values)}")
+        records.append(record.pack(True, *(native_value(value, column_type)
+                                           for value, (_, column_type) in zip(values, schema))))
+    with publish_lock:
+        with open(fixed_file(table_name), 'ab') as file:
+            file.write(b''.join(records))
+
+
+def fixed_rows(table_name):
+    """
+    Reads the live rows of a fixed-width table.
+
+    :return: Tuple of (schema, list of (row number, list of native values)).
+    """
+    schema, header_size, record = read_fixed_schema(table_name)
+    count('files_opened')
+    with publish_lock, open(fixed_file(table_name), 'rb') as file:
+        file.seek(header_size)
+        data = file.read()
+    data = memoryview(data)[:len(data) - len(data) % record.size]  # Without a record cut short by a failed write
+    count('bytes_read', len(data))
+    strs = [i for i, (_, column_type) in enumerate(schema) if column_type not in fixed_typecodes]
+    rows = []
+    for number, (live, *values) in enumerate(record.iter_unpack(data)):
+        if live:
+            for i in strs:
+                values[i] = values[i].rstrip(b'\0').decode()
+            rows.append((number, values))
+    count('rows_scanned', len(rows))
+    return schema, rows
+
+
+def fixed_matches(schema, rows, condition):
+    # Rows meeting the condition, comparing native values
+    if not condition:
+        return rows
+    column_name, operator, condition_value = condition
+    position = [name for name, _ in schema].index(column_name)
+    compare = condition_operators[operator]
+    if dict(schema)[column_name] in fixed_typecodes:
+        condition_value = float(condition_value)
+        return [row for row in rows if compare(row[1][position], condition_value)]
+    if operator == '=':
+        return [row for row in rows if row[1][position] == condition_value]
+    condition_value = float(condition_value)
+    return [row for row in rows if compare(float(row[1][position]), condition_value)]
+
+
+@timed_stage('scan')
+def query_data_fixed(table_name, column_names, condition=None):
+    schema, rows = fixed_rows(table_name)
+    positions = [[name for name, _ in schema].index(name) for name in column_names]
+    for _, values in fixed_matches(schema, rows, condition):
+        yield ','.join(format_value(values[i]) for i in positions)
+
+
+def write_records(table_name, header_size, records):
+    # Overwrites records in place, all of them while holding publish_lock
+    with publish_lock, open(fixed_file(table_name), 'r+b') as file:
+        for offset, data in records:
+            file.seek(header_size + offset)
+            file.write(data)
+
+
+def delete_data_fixed(table_name, condition):
+    schema, header_size, record = read_fixed_schema(table_name)
+    matches = fixed_matches(*fixed_rows(table_name), condition)
+    write_records(table_name, header_size, [(number * record.size, b'\0') for number, _ in matches])
+
+
+def update_data_fixed(table_name, condition, updates):
+    schema, header_size, record = read_fixed_schema(table_name)
+    names = [name for name, _ in schema]
+    types = dict(schema)
+    changes = [(names.index(column_name), native_value(new_val, types[column_name])) for column_name, new_val in updates]
+    records = []
+    for number, values in fixed_matches(*fixed_rows(table_name), condition):
+        values = [value.encode() if isinstance(value, str) else value for value in values]
+        for position, new_val in changes:
+            values[position] = new_val
+        records.append((number * record.size, record.pack(True, *values)))
+    write_records(table_name, header_size, records)
+
+
+@timed_stage('sort')
+def order_data_fixed(table_name, column_name, order='asc', limit=None):
+    schema, rows = fixed_rows(table_name)
+    position = [name for name, _ in schema].index(column_name)
+    key = lambda row: row[1][position]
+    if limit is not None:
+        select = heapq.nlargest if order.lower() == 'desc' else heapq.nsmallest
+        rows = select(limit, rows, key=key)
+    else:
+        rows.sort(key=key, reverse=(order.lower() == 'desc'))
+
+    print(','.join(name for name, _ in schema))
+    for _, values in rows:
+        print(','.join(format_value(value) for value in values))
+
+
+def compact_table_fixed(table_name):
+    # Rewrites the table without its removed records, readers keep the old file until it is replaced
+    _, header_size, record = read_fixed_schema(table_name)
+    tmp_file = temporary_file_name(fixed_file(table_name))
+    with open(fixed_file(table_name), 'rb') as source, open(tmp_file, 'wb') as destination:
+        destination.write(source.read(header_size))
+        for data in iter(functools.partial(source.read, record.size * 4096), b''):
+            destination.write(b''.join(data[start:start + record.size]
+                                       for start in range(0, len(data) - record.size + 1, record.size) if data[start]))
+    with publish_lock:
+        os.replace(tmp_file, fixed_file(table_name))
+
+
+# Parallel partition execution
+# Partitions are independent files, so per-partition work (scans, filters, partial sorts and
+# aggregates, the rows a remove / renew changes) is spread over a pool of worker processes and the
+# results are merged here. Workers only read: mutation log appends, compaction, index, filter and
+# sketch files are written by this process, under the locks that guard them. The workers are started
+# by a forkserver, so they never inherit locks or open files from the threads of this process.
+# The pool size comes from FILEDB_WORKERS or "set workers <n>"; 1 runs everything in-process.
+parallel_workers = int(os.environ.get('FILEDB_WORKERS', 1))
+worker_pool = None
+
+
+def configure_worker(directory, settings):
+    # Starts a worker in the directory and with the settings of this process, not those of the forkserver
+    os.chdir(directory)
+    globals().update(settings, parallel_workers=1)
+
+
+def set_parallel_workers(count):
+    global parallel_workers
+    if count < 1:
+        raise ValueError("Worker count must be at least 1")
+    shutdown_worker_pool()
+    parallel_workers = count
+
+
+def shutdown_worker_pool():
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.shutdown()
+        worker_pool = None
+
+
+def map_partitions(function, file_paths, *args):
+    """
+    Runs function(file_path, *args) for every partition, in worker processes when enabled.
+
+    :return: List of results in partition order.
+    """
+    global worker_pool
+    if parallel_workers > 1 and len(file_paths) > 1:
+        if worker_pool is None:
+            worker_pool = ProcessPoolExecutor(max_workers=parallel_workers,
+                                              mp_context=multiprocessing.get_context('forkserver'),
+                                              initializer=configure_worker,
+                                              initargs=(os.getcwd(), {'sort_memory_limit': sort_memory_limit,
+                                                                      'buffer_pool_limit': buffer_pool_limit}))
+        for file_path in file_paths:
+            for column_name, _ in data_file_indexes(file_path, read_header(file_path)):
+                refresh_index(file_path, column_name)  # So no worker has to build one
+        return list(worker_pool.map(function, file_paths, *[[arg] * len(file_paths) for arg in args]))
+    return [function(file_path, *args) for file_path in file_paths]
+
+
+def create_table_partition(table_name, headers, codec=None, partitioning=None):
     ensure_db_directory()
     # Create initial partion file
     file_name = f"dbs/{table_name}_part_0.csv"
-    if not os.path.exists(file_name):
+    if not list_partition_files(table_name):
+        if codec:
+            set_table_codec(table_name, codec)  # Partitions added later are compressed too
+        if partitioning:
+            save_partitioning(table_name, new_partitioning(table_name, **partitioning))
         with open(file_name, 'w') as file:
             file.write(','.join(headers) + '\n')
             print(f"Initial partition for table {table_name} created.")
+        save_manifest(table_name, {file_name: empty_partition_stats()})
     else:
         print(f"Table {table_name} already exists.")
 
 
-def insert_data_partition(table_name, data):
-    id_value = int(data.split(',')[0])  # Assuming the first value is the ID for partitioning
-    file_name = get_partition_file_name(table_name, id_value)
-    with open(file_name, 'a') as file:
-        file.write(f"{data}\n")
-        print(f"Data inserted into {file_name}.")
+def insert_rows_partition(table_name, rows):
+    # Appends rows with one write per partition and a single manifest update, returns the partitions written
+    partition_rows = defaultdict(list)
+    scheme = load_partitioning(table_name)
+    manifest = load_manifest(table_name)
+    first_file = min(manifest, key=partition_number)  # Every partition carries the header of the table
+    if scheme:
+        position = read_header(first_file).index(scheme['column'])
+    for data in rows:
+        if scheme:
+            partition_rows[scheme_partition_file(scheme, data.split(',')[position])].append(data)
+            continue
+        id_value = int(data.split(',')[0])  # Assuming the first value is the ID for partitioning
+        partition_rows[get_partition_file_name(table_name, id_value)].append(data)
+
+    deltas = view_deltas(first_file, [], rows)
+    for file_name, new_rows in partition_rows.items():
+        if not os.path.exists(file_name):
+            with open(file_name, 'w') as file:
+                file.write(','.join(read_header(first_file)) + '\n')
+            manifest[file_name] = empty_partition_stats()
+        prepare_bloom_filter(file_name, manifest[file_name]['rows'] + len(new_rows))
+        append_rows(file_name, new_rows)
+        stats = manifest[file_name]
+        header = read_header(file_name)
+        for data in new_rows:
+            stats['rows'] += 1
+            widen_partition_stats(stats, header, data.split(','))
+    save_manifest(table_name, manifest)
+    apply_view_deltas(deltas)
+    if scheme:
+        split_full_partitions(table_name, list(partition_rows))
+    return list(partition_rows)
+
+
+@timed_stage('scan')
+def query_data_partition(table_name, column_names, condition=None):
+    for rows in map_partitions(query_partition, pruned_partition_files(table_name, condition), column_names,
+                               condition):
+        for row in rows:
+            print(row)
 
 
-def query_data_partition(table_name, column_names, condition=None):
-    for file_name in os.listdir('dbs'):
-        if file_name.startswith(table_name):
-            with open(f"dbs/{file_name}", 'r') as file:
-                header = next(file).strip().split(',')
-                column_indices = [header.index(name) for name in column_names]
-
-                for line in file:
-                    values = line.strip().split(',')
-                    if condition:
-                        condition_column_name, operator, condition_value = condition
-                        condition_column_index = header.index(condition_column_name)
-                        if not is_condition_met(float(values[condition_column_index]), operator,
-                                                float(condition_value)):
-                            continue
-                    selected_values = [values[i] for i in column_indices]
-                    print(','.join(selected_values))
+def query_partition(file_path, column_names, condition=None):
+    selected_rows = []
+    header = read_header(file_path)
+    column_indices = [header.index(name) for name in column_names]
+
+    rows = indexed_rows(file_path, header, condition)
+    if rows is not None:
+        for _, line in rows:
+            values = line.strip().split(',')
+            selected_rows.append(','.join(values[i] for i in column_indices))
+        return selected_rows
+
+    if condition and scans_bytes(file_path):
+        return list(scan_selected(file_path, header, column_indices, condition))
+
+    predicate = compile_condition(header, condition) if condition else None
+    for values in pooled_rows(file_path):
+        if predicate and not predicate(values):
+            continue
+        selected_values = [values[i] for i in column_indices]
+        selected_rows.append(','.join(selected_values))
+    return selected_rows
 
 
 def delete_data_partition(table_name, condition):
     print(condition)
-    for file_name in os.listdir('dbs'):
-        if file_name.startswith(table_name):
-            updated_lines = []
-            with open(f"dbs/{file_name}", 'r') as file:
-                header = next(file).strip().split(',')  # Save the header
-                condition_column_index = header.index(condition[0])  # Convert condition column name to index
-
-                for line in file:
-                    values = line.strip().split(',')
-                    operator, condition_value = condition[1], condition[2]
-                    if is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                        continue  # Skip this line (row) as it meets the delete condition
-                    updated_lines.append(line)
-
-            with open(f"dbs/{file_name}", 'w') as file:
-                file.write(','.join(header) + '\n')  # Write the header back
-                for line in updated_lines:
-                    file.write(line)
+    file_paths = pruned_partition_files(table_name, condition)
+    results = map_partitions(row_deletions, file_paths, condition)
+    write_mutations(file_paths, results)
+    deleted = [len(mutations) for mutations, _ in results]
+    if any(deleted):
+        manifest = load_manifest(table_name)
+        for file_path, count in zip(file_paths, deleted):
+            manifest[file_path]['rows'] -= count  # Bounds stay as they are, they are still valid
+        save_manifest(table_name, manifest)
+    deltas = {}
+    for _, partial in results:
+        merge_view_deltas(deltas, partial)
+    apply_view_deltas(deltas)
+
+
+def row_deletions(data_file, condition):
+    # Returns the tombstones of the rows meeting the condition and the changes to the views of the table
+    rows = matching_rows(data_file, read_header(data_file), condition)
+    deltas = view_deltas(data_file, [line for _, line in rows], []) if rows else {}
+    return {offset: None for offset, _ in rows}, deltas
+
+
+def delete_rows(data_file, condition):
+    # Returns the number of rows deleted and the changes to the views of the table
+    mutations, deltas = row_deletions(data_file, condition)
+    write_mutations([data_file], [(mutations, deltas)])
+    return len(mutations), deltas
+
+
+def write_mutations(data_files, results):
+    # Appends the (mutations, view deltas) computed for each data file to its mutation log. Workers only
+    # compute them: every write happens in this process, under the table lock its caller holds.
+    for data_file, (mutations, _) in zip(data_files, results):
+        if mutations:
+            append_mutations(data_file, mutations)
 
 
 # For test create
-def create_table(table_name, headers):
+def create_table(table_name, headers, codec=None):
     ensure_db_directory()
     file_name = f"dbs/{table_name}.csv"
-    if not os.path.exists(file_name):
+    if not os.path.exists(file_name) and not is_columnar(table_name) and not is_fixed_width(table_name):
+        if codec:
+            set_table_codec(table_name, codec)
         with open(file_name, 'w') as file:
             file.write(','.join(headers) + '\n')
             print(f"Table {table_name} created.")
@@ -90,281 +2127,1418 @@ def create_table(table_name, headers):
 # insert into employees values 1,John,30
 # for test insert.
 def insert_data(file_name, data):
-    with open(f"dbs/{file_name}.csv", 'a') as file:
-        file.write(f"{data}\n")
-        print(f"Data inserted into {file_name}.")
+    insert_rows(file_name, [data])
+    print(f"Data inserted into {file_name}.")
 
 
-def is_condition_met(value, operator, condition_value):
-    if operator == '=':
-        return value == condition_value
-    elif operator == '>':
-        return value > condition_value
-    elif operator == '<':
-        return value < condition_value
-    elif operator == '>=':
-        return value >= condition_value
-    elif operator == '<=':
-        return value <= condition_value
+def insert_rows(file_name, rows):
+    if is_columnar(file_name):
+        insert_rows_columnar(file_name, rows)
+    elif is_fixed_width(file_name):
+        insert_rows_fixed(file_name, rows)
     else:
+        deltas = view_deltas(f"dbs/{file_name}.csv", [], rows)
+        append_rows(f"dbs/{file_name}.csv", rows)
+        apply_view_deltas(deltas)
+
+
+# Bulk loading
+# load <table> from <csv file> streams the source file into the table in batches of load_batch_size
+# rows, each written with one append per data file.
+load_batch_size = 10000
+
+
+def load_data(table_name, source_file):
+    """
+    Loads every row of a CSV file into a flat, partitioned or columnar table.
+
+    :param table_name: Target table, created with the source file's header if it does not exist.
+    :param source_file: Path to the CSV file.
+    :return: Number of rows loaded.
+    """
+    partitioned = bool(partition_files(table_name))
+    insert = insert_rows_partition if partitioned else insert_rows
+    with open(source_file, 'r') as file:
+        source_header = file.readline().strip()
+        if not partitioned and not is_columnar(table_name) and not is_fixed_width(table_name) \
+                and not os.path.exists(f"dbs/{table_name}.csv"):
+            create_table(table_name, source_header.split(','))
+        header = table_header(table_name)
+        if source_header.split(',') != header:
+            raise ValueError(f"Header of {source_file} does not match table {table_name}")
+
+        loaded = 0
+        batch = []
+        for line_number, line in enumerate(file, start=2):
+            data = line.strip()
+            if not data:
+                continue
+            if data.count(',') != len(header) - 1:
+                raise ValueError(f"Line {line_number} of {source_file} has the wrong number of values")
+            batch.append(data)
+            if len(batch) >= load_batch_size:
+                insert(table_name, batch)
+                loaded += len(batch)
+                batch = []
+        if batch:
+            insert(table_name, batch)
+            loaded += len(batch)
+    return loaded
+
+
+condition_operators = {'=': eq, '>': gt, '<': lt, '>=': ge, '<=': le}
+
+
+def is_condition_met(value, operator, condition_value):
+    if operator not in condition_operators:
         raise ValueError(f"Unknown operator: {operator}")
+    return condition_operators[operator](value, condition_value)
 
 
-def filter_data_in_chunks(file_name, filter_function, chunk_size=1024):
+def compile_condition(header, condition):
     """
-    Filters data from a file in chunks.
+    Compiles a condition into a predicate over the split values of a row.
 
-    :param file_name: Path to the file.
-    :param filter_function: Function that returns True for rows to keep.
-    :param chunk_size: Number of lines to read at once.
-    :return: Generator that yields filtered data.
+    :param header: Column names of the data file.
+    :param condition: Tuple of (column name, operator, value).
+    :return: Function taking a list of values, with column position, operator and value resolved once.
     """
-    with open(file_name, 'r') as file:
-        while True:
-            lines = [file.readline() for _ in range(chunk_size)]
-            if not lines:
-                break
+    column_name, operator, condition_value = condition
+    if operator not in condition_operators:
+        raise ValueError(f"Unknown operator: {operator}")
+    column_index = header.index(column_name)
+    if not is_number(condition_value):
+        text_value = text_condition_value(operator, condition_value)
+        return lambda values: values[column_index] == text_value
+    compare, condition_value = condition_operators[operator], float(condition_value)
+    return lambda values: compare(float(values[column_index]), condition_value)
+
+
+def is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def text_condition_value(operator, condition_value):
+    # Text is only compared for equality, the other operators order numbers
+    if operator != '=':
+        raise ValueError(f"Operator {operator} needs a number, got {condition_value}")
+    return condition_value
+
+
+# Byte scanner
+# A conditioned give / give_p of a data file the buffer pool does not hold (see scans_bytes) reads
+# the snapshot through a read-only memory map, or the BlockReader of a block-compressed file, and
+# compares the condition column on the raw bytes of every row, splitting a row only up to that
+# column. Only the selected columns of the matching rows are decoded, so a selective condition
+# allocates little beyond the rows it returns. Rows replaced in the mutation log are compared as text.
+def scan_selected(data_file, header, column_indices, condition):
+    """
+    Scans a snapshot of a data file for the live rows meeting a condition.
+
+    :param data_file: Path to the data file.
+    :param header: Column names of the data file.
+    :param column_indices: Positions of the columns to return.
+    :param condition: Tuple of (column name, operator, value).
+    :return: Generator of the selected values of every matching row, joined by commas.
+    """
+    predicate = compile_condition(header, condition)
+    column_index = header.index(condition[0])
+    if is_number(condition[2]):
+        compare, condition_value = condition_operators[condition[1]], float(condition[2])
+        parse = float
+    else:
+        compare, condition_value = eq, text_condition_value(condition[1], condition[2]).encode()
+        parse = bytes.strip
+    file, size, mutations = open_snapshot(data_file)
+    rows = decoded = offset = 0
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(file)
+        if isinstance(file, BlockReader):
+            lines = iter(file)
+        elif size:
+            memory_map = stack.enter_context(mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ))
+            lines = iter(memory_map.readline, b'')
+        else:
+            return
+        offset = len(next(lines, b''))  # Skip the header
+        try:
             for line in lines:
-                if filter_function(line):
-                    yield line
+                if offset >= size:
+                    break  # Appended after the snapshot was taken
+                start = offset
+                offset += len(line)
+                if mutations and start in mutations:
+                    rows += 1
+                    if mutations[start] is not None:
+                        values = mutations[start].strip().split(',')
+                        if predicate(values):
+                            decoded += 1
+                            yield ','.join(values[i] for i in column_indices)
+                    continue
+                try:
+                    matched = compare(parse(line.split(b',', column_index + 1)[column_index]), condition_value)
+                except (ValueError, IndexError):
+                    if not line.strip():
+                        continue
+                    matched = predicate(line.decode().strip().split(','))  # Raises the error a text scan raises
+                rows += 1
+                if matched:
+                    decoded += 1
+                    values = line.strip().split(b',')
+                    yield b','.join([values[i] for i in column_indices]).decode()
+        finally:
+            count('rows_scanned', rows)
+            count('rows_decoded', decoded)
+            count('bytes_read', offset)
 
 
 # query_data("employees.csv", [0 1 2], [2 >= 25])
 def query_data(file_name, column_names, condition=None):
-    with open(f"dbs/{file_name}", 'r') as file:
-        header = next(file).strip().split(',')
-        column_indices = [header.index(name) for name in column_names]
+    for row in query_data_lazy(file_name, column_names, condition):
+        print(row)
 
-        for line in file:
-            values = line.strip().split(',')
-            if condition:
-                condition_column_name, operator, condition_value = condition
-                condition_column_index = header.index(condition_column_name)  # Convert to index
-                if not is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                    continue
-            selected_values = [values[i] for i in column_indices]
-            print(','.join(selected_values))
-
-
-def delete_data(file_name, condition):
-    print(condition)
-    updated_lines = []
-    with open(f"dbs/{file_name}.csv", 'r') as file:
-        header = next(file).strip().split(',')  # Save the header
-        condition_column_index = header.index(condition[0])  # Convert condition column name to index
 
-        for line in file:
+# Lazy Reading for Querying Data
+# Yields the selected values of the matching rows one row at a time, through an index, the byte
+# scanner or the buffer pool, the same way give reads them.
+@timed_stage('scan')
+def query_data_lazy(file_name, column_names, condition=None):
+    table_name = os.path.splitext(file_name)[0]
+    if is_columnar(table_name):
+        yield from query_data_columnar(table_name, column_names, condition)
+        return
+    if is_fixed_width(table_name):
+        yield from query_data_fixed(table_name, column_names, condition)
+        return
+    header = read_header(f"dbs/{file_name}")
+    column_indices = [header.index(name) for name in column_names]
+
+    rows = indexed_rows(f"dbs/{file_name}", header, condition)
+    if rows is not None:
+        for _, line in rows:
             values = line.strip().split(',')
-            operator, condition_value = condition[1], condition[2]
-            if is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                continue  # Skip this line (row) as it meets the delete condition
-            updated_lines.append(line)
+            yield ','.join(values[i] for i in column_indices)
+        return
 
-    with open(f"dbs/{file_name}.csv", 'w') as file:
-        file.write(','.join(header) + '\n')  # Write the header back
-        for line in updated_lines:
-            file.write(line)
+    if condition and scans_bytes(f"dbs/{file_name}"):
+        yield from scan_selected(f"dbs/{file_name}", header, column_indices, condition)
+        return
 
+    predicate = compile_condition(header, condition) if condition else None
+    for values in pooled_rows(f"dbs/{file_name}"):
+        if predicate and not predicate(values):
+            continue
+        selected_values = [values[i] for i in column_indices]
+        yield ','.join(selected_values)
 
-# Lazy Reading for Querying Data
-# lazy reading test.
-def query_data_lazy(file_name, column_names, condition=None):
-    with open(f"dbs/{file_name}", 'r') as file:
-        header = file.readline().strip().split(',')
-        column_indices = [header.index(name) for name in column_names]
 
-        for line in file:
-            values = line.strip().split(',')
-            if condition:
-                condition_column_name, operator, condition_value = condition
-                condition_column_index = header.index(condition_column_name)
-                if not is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                    continue
-            selected_values = [values[i] for i in column_indices]
-            yield ','.join(selected_values)
+def delete_data(file_name, condition):
+    print(condition)
+    if is_columnar(file_name):
+        return delete_data_columnar(file_name, condition)
+    if is_fixed_width(file_name):
+        return delete_data_fixed(file_name, condition)
+    apply_view_deltas(delete_rows(f"dbs/{file_name}.csv", condition)[1])
 
 
-buffer_limit = 100
-data_buffer = []
+buffer_limit = int(os.environ.get('FILEDB_BUFFER_LIMIT', 100))
+data_buffers = defaultdict(list)  # (table name, partitioned) -> rows waiting to be written
+buffer_lock = threading.Lock()
 
 
 # Buffered Writing for Inserting Data
-# Buffered writing for saving memory
-def insert_data_buffered(file_name, data):
-    data_buffer.append(data)
-    if len(data_buffer) >= buffer_limit:
-        flush_buffer(file_name)
+# put / put_p collect rows per table and commit them together once buffer_limit rows are waiting.
+# Every other command flushes all buffers first, and so does exiting.
+def insert_data_buffered(file_name, data, partitioned=False):
+    # Returns whether the row was written, False while it waits in the buffer
+    with buffer_lock:
+        buffer = data_buffers[(file_name, partitioned)]
+        buffer.append(data)
+        full = len(buffer) >= buffer_limit
+    if full:
+        return flush_buffer(file_name, partitioned)
+    return False
+
+
+row_shapes = {}  # (table name, partitioned) -> (column types, position and type of an id picking the partition)
+
+
+def row_shape(table_name, partitioned):
+    if is_columnar(table_name):
+        types = [column_type for _, column_type in read_schema(table_name)]
+    elif is_fixed_width(table_name):
+        types = [column_type for _, column_type in read_fixed_schema(table_name)[0]]
+    else:
+        data_files = partition_files(table_name) if partitioned else [f"dbs/{table_name}.csv"]
+        if not data_files or not os.path.exists(data_files[0]):
+            raise ValueError(f"Table {table_name} does not exist")
+        header = read_header(data_files[0])
+        types = ['str'] * len(header)
+        if partitioned:
+            scheme = load_partitioning(table_name)
+            if not scheme:
+                return types, 0, 'int'  # The id picks the partition
+    return types, None, None
+
+
+def validate_row(table_name, data, partitioned=False):
+    # Raises ValueError for a put / put_p row its table would reject, so the put reports it and not the flush
+    if (table_name, partitioned) not in row_shapes:
+        row_shapes[(table_name, partitioned)] = row_shape(table_name, partitioned)
+    types, partition_position, partition_type = row_shapes[(table_name, partitioned)]
+    values = data.split(',')
+    if len(values) != len(types):
+        raise ValueError(f"Expected {len(types)} values, got {len(values)}")
+    for value, column_type in zip(values, types):
+        if column_type != 'str':
+            native_value(value, column_type)
+    if partition_type:
+        native_value(values[partition_position], partition_type)
+
+
+def flush_buffer(file_name, partitioned=False):
+    # Returns whether every buffered row was written
+    with buffer_lock:
+        rows = data_buffers.pop((file_name, partitioned), [])
+    return not rows or commit_rows(file_name, rows, partitioned) == len(rows)
+
+
+def requeue_rows(file_name, rows, partitioned=False):
+    # Puts rows a failed write left out back in front of the buffer, to be written by the next flush
+    with buffer_lock:
+        buffer = data_buffers[(file_name, partitioned)]
+        buffer[:0] = rows
+
+
+def commit_rows(file_name, rows, partitioned=False):
+    """
+    Inserts a group of put / put_p rows with one write. A rejected row is reported and dropped; any
+    other failure is reported and the rows not written yet go back to the buffer, so none is lost.
+
+    :return: Number of rows inserted.
+    """
+    insert = insert_rows_partition if partitioned else insert_rows
+    with table_write_lock(file_name):
+        try:
+            insert(file_name, rows)
+            return len(rows)
+        except Exception:
+            pass  # Commit the rows one by one so a single bad row does not take the rest of the group with it
+        inserted = 0
+        for position, data in enumerate(rows):
+            try:
+                insert(file_name, [data])
+                inserted += 1
+            except ValueError as e:
+                print(f"Error inserting {data} into {file_name}: {e}")
+            except Exception as e:
+                requeue_rows(file_name, rows[position:], partitioned)
+                print(f"Error inserting into {file_name}, {len(rows) - position} rows kept to retry: {e}")
+                break
+        return inserted
 
 
-def flush_buffer(file_name):
-    with open(f"dbs/{file_name}.csv", 'a') as file:
-        for data in data_buffer:
-            file.write(f"{data}\n")
-    data_buffer.clear()
+def flush_all_buffers():
+    with buffer_lock:
+        keys = list(data_buffers)
+    for file_name, partitioned in keys:
+        flush_buffer(file_name, partitioned)
 
 
 def update_data_partition(table_name, condition, updates):
-    for file_name in os.listdir('dbs'):
-        if file_name.startswith(table_name):
-            updated_lines = []
-            with open(f"dbs/{file_name}", 'r') as file:
-                header = next(file).strip().split(',')  # Save the header
-                condition_column_index = header.index(condition[0])  # Convert condition column name to index
-
-                # Convert update column names to indices
-                update_indices = [(header.index(col_name), new_val) for col_name, new_val in updates]
-
-                for line in file:
-                    values = line.strip().split(',')
-                    operator, condition_value = condition[1], condition[2]
-                    if is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                        for col_idx, new_val in update_indices:
-                            values[col_idx] = new_val
-                    updated_lines.append(','.join(values))
-
-            with open(f"dbs/{file_name}", 'w') as file:
-                file.write(','.join(header) + '\n')  # Write the header back
-                for line in updated_lines:
-                    file.write(line + '\n')
-
-
-def order_data_partition(table_name, column_name, order='asc'):
-    aggregated_data = []
-    header = None
-
-    for file_name in os.listdir('dbs'):
-        if file_name.startswith(table_name):
-            with open(f"dbs/{file_name}", 'r') as file:
-                if not header:
-                    header = next(file).strip().split(',')  # Read the header only once
-                    column_index = header.index(column_name)  # Find index of the column name
-
-                # Skip the header for subsequent files
-                next(file) if header else None
-
-                # Processing the data lines
-                data = [line.strip().split(',') for line in file.readlines()]
-                aggregated_data.extend(data)
-
-    # Sorting the aggregated data based on the specified column
-    aggregated_data.sort(
-        key=lambda row: float(row[column_index]) if row[column_index].replace('.', '', 1).isdigit() else row[
-            column_index],
-        reverse=(order.lower() == 'desc'))
+    file_paths = pruned_partition_files(table_name, condition)
+    results = map_partitions(row_updates, file_paths, condition, updates)
+    write_mutations(file_paths, results)
+    updated = [len(replacements) for replacements, _ in results]
+    if any(updated):
+        manifest = load_manifest(table_name)
+        for file_path, count in zip(file_paths, updated):
+            if count:
+                widen_partition_stats(manifest[file_path], *zip(*updates))
+        save_manifest(table_name, manifest)
+    deltas = {}
+    for _, partial in results:
+        merge_view_deltas(deltas, partial)
+    apply_view_deltas(deltas)
+
+
+def row_updates(data_file, condition, updates):
+    # Returns the new lines of the rows meeting the condition and the changes to the views of the table
+    header = read_header(data_file)
+    # Convert update column names to indices
+    update_indices = [(header.index(col_name), new_val) for col_name, new_val in updates]
+
+    replacements, old_lines = {}, []
+    for offset, line in matching_rows(data_file, header, condition):
+        values = line.strip().split(',')
+        for col_idx, new_val in update_indices:
+            values[col_idx] = new_val
+        replacements[offset] = ','.join(values) + '\n'
+        old_lines.append(line)
+    deltas = view_deltas(data_file, old_lines, replacements.values()) if replacements else {}
+    return replacements, deltas
+
+
+def update_rows(data_file, condition, updates):
+    # Returns the number of rows updated and the changes to the views of the table
+    replacements, deltas = row_updates(data_file, condition, updates)
+    write_mutations([data_file], [(replacements, deltas)])
+    return len(replacements), deltas
+
+
+def row_mutations(data_file, statements):
+    """
+    Computes what a run of remove / renew statements changes in a data file, written as one
+    mutation log append. Every row goes through the statements in order, so a row renewed by one
+    statement is seen renewed by the next, as if they had run one by one.
 
-    # Print the sorted data
-    if header:
-        print(','.join(header))  # Print the header
-        for row in aggregated_data:
-            print(','.join(row))  # Print the sorted data rows
+    :param data_file: Path to the data file.
+    :param statements: List of (condition, updates) pairs, updates None for a remove.
+    :return: Tuple of (offset -> new line or None for a deleted row, changes to the views of the table).
+    """
+    header = read_header(data_file)
+    steps = [(compile_condition(header, condition),
+              None if updates is None else [(header.index(col_name), new_val) for col_name, new_val in updates])
+             for condition, updates in statements]
+    originals, current = {}, {}  # offset -> line before the statements / values after them, None once deleted
+    indexed = [indexed_rows(data_file, header, condition) for condition, _ in statements]
+    if all(rows is not None for rows in indexed):
+        # Index lookups per statement, plus the rows an earlier statement renewed on the condition column
+        renewed = defaultdict(set)  # column position -> offsets renewed there
+        for rows, (condition, _), (predicate, updates) in zip(indexed, statements, steps):
+            lines = dict(rows)
+            for offset in set(lines) | renewed[header.index(condition[0])]:
+                values = current[offset] if offset in current else lines[offset].strip().split(',')
+                if values is None or not predicate(values):
+                    continue
+                originals.setdefault(offset, lines.get(offset))
+                if updates is None:
+                    current[offset] = None
+                    continue
+                values = list(values)
+                for col_idx, new_val in updates:
+                    values[col_idx] = new_val
+                    renewed[col_idx].add(offset)
+                current[offset] = values
+    else:
+        # One scan for the statements no index answers, the others are only tried on the rows their index
+        # matched, unless an earlier statement renewed the row on their condition column
+        matched = defaultdict(list)  # offset -> indexed statements the row met before the batch, in order
+        for number, rows in enumerate(indexed):
+            for offset, _ in rows or []:
+                matched[offset].append(number)
+        scanned = [number for number, rows in enumerate(indexed) if rows is None]
+        indexed_columns = {header.index(condition[0]) for (condition, _), rows in zip(statements, indexed)
+                           if rows is not None}
+        renews_indexed = [updates is not None and any(col_idx in indexed_columns for col_idx, _ in updates)
+                          for _, updates in steps]
+        for offset, line in live_rows(data_file):
+            values = line.strip().split(',')
+            remaining = sorted(matched[offset] + scanned) if offset in matched else scanned
+            changed = False
+            while remaining is not None:
+                numbers, remaining = remaining, None
+                for number in numbers:
+                    predicate, updates = steps[number]
+                    if not predicate(values):
+                        continue
+                    changed = True
+                    if updates is None:
+                        values = None
+                        break
+                    for col_idx, new_val in updates:
+                        values[col_idx] = new_val
+                    if renews_indexed[number]:
+                        remaining = range(number + 1, len(steps))  # Try every later statement on this row
+                        break
+            if changed:
+                originals[offset] = line
+                current[offset] = values
+
+    if not current:
+        return {}, {}
+    replacements = {offset: None if values is None else ','.join(values) + '\n' for offset, values in current.items()}
+    return replacements, view_deltas(data_file, list(originals.values()),
+                                     [line for line in replacements.values() if line])
+
+
+def mutate_data(table_name, statements, partitioned=False):
+    """
+    Runs consecutive remove / renew (or remove_p / renew_p) statements on a table in one pass per data file.
 
+    :return: Tuple of (rows deleted, rows updated).
+    """
+    if partitioned:
+        # Rows a statement may change lie in the partitions its condition allows, or were renewed there before
+        file_paths = list(dict.fromkeys(chain.from_iterable(pruned_partition_files(table_name, condition)
+                                                            for condition, _ in statements)))
+    else:
+        file_paths = [f"dbs/{table_name}.csv"]
+    results = map_partitions(row_mutations, file_paths, statements)
+    write_mutations(file_paths, results)
+    counts = []  # (rows deleted, rows updated) per data file
+    for replacements, _ in results:
+        deleted = sum(1 for line in replacements.values() if line is None)
+        counts.append((deleted, len(replacements) - deleted))
+    if partitioned and any(deleted or updated for deleted, updated in counts):
+        manifest = load_manifest(table_name)
+        for file_path, (deleted, updated) in zip(file_paths, counts):
+            manifest[file_path]['rows'] -= deleted
+            for _, updates in statements:
+                if updated and updates is not None:
+                    widen_partition_stats(manifest[file_path], *zip(*updates))
+        save_manifest(table_name, manifest)
+    deltas = {}
+    for _, partial in results:
+        merge_view_deltas(deltas, partial)
+    apply_view_deltas(deltas)
+    return sum(deleted for deleted, _ in counts), sum(updated for _, updated in counts)
+
+
+number_pattern = re.compile(r'-?(\d+\.?\d*|\.\d+)')
+
+
+def order_value(value):
+    return float(value) if number_pattern.fullmatch(value) else value
+
+
+# External sort
+# order / order_p keep at most sort_memory_limit bytes of rows in memory, measured like the rows of
+# the buffer pool plus the sort keys: full runs are sorted and spilled to temporary files, then k-way
+# merged while the output streams, in several passes when the readers of all runs would not fit.
+# With "limit <k>" only a k-row heap is kept. The budget comes from FILEDB_SORT_MEMORY or "set sort_memory <bytes>".
+sort_memory_limit = int(os.environ.get('FILEDB_SORT_MEMORY', 64 * 1024 * 1024))
+
+
+def set_sort_memory(limit):
+    global sort_memory_limit
+    if limit < 1:
+        raise ValueError("Sort memory must be at least 1 byte")
+    shutdown_worker_pool()  # Workers pick up the new budget when they are started again
+    sort_memory_limit = limit
+
+
+def file_rows(data_file):
+    yield from streamed_rows(data_file)
+
+
+def spill_run(run):
+    with tempfile.NamedTemporaryFile('w', suffix='.run', delete=False) as file:
+        for row in run:
+            file.write(','.join(row) + '\n')
+    return file.name
+
+
+def read_run(path):
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                yield line.rstrip('\n').split(',')
+    finally:
+        os.remove(path)
+
+
+sort_key_memory = 64  # Per row: the run's slot, and the key and slot list.sort allocates while sorting
+run_reader_memory = 24 * 1024  # An open run being merged: its file buffer and decoded text
+
+
+def sorted_runs(rows, key, reverse=False, spill_last=False):
+    # Returns the spilled run files and the last run, which stays in memory unless spill_last is set
+    runs, run, run_size = [], [], 0
+    for row in rows:
+        run.append(row)
+        run_size += row_memory(row) + sort_key_memory  # What the run holds, as the buffer pool counts it
+        if run_size >= sort_memory_limit:
+            run.sort(key=key, reverse=reverse)
+            runs.append(spill_run(run))
+            count('sort_runs_spilled')
+            run, run_size = [], 0
+    run.sort(key=key, reverse=reverse)
+    if spill_last and run:
+        runs.append(spill_run(run))
+        run = []
+    return runs, run
+
+
+def external_sort(rows, key, reverse=False, limit=None):
+    """
+    Sorts rows within the sort memory budget.
 
-def update_data(file_name, condition, updates):
-    updated_lines = []
-    with open(f"dbs/{file_name}.csv", 'r') as file:
-        header = next(file).strip().split(',')  # Save the header
-        condition_column_index = header.index(condition[0])  # Convert condition column name to index
+    :param rows: Iterable of rows (lists of values).
+    :param key: Sort key of a row.
+    :param reverse: Sort descending.
+    :param limit: Only the first limit rows are needed, kept in a heap instead of sorting everything.
+    :return: Iterator over the sorted rows.
+    """
+    if limit is not None:
+        return iter((heapq.nlargest if reverse else heapq.nsmallest)(limit, rows, key=key))
+    runs, run = sorted_runs(rows, key, reverse)
+    return heapq.merge(*[read_run(path) for path in merge_runs(runs, key, reverse)], run, key=key, reverse=reverse)
+
+
+def merge_runs(runs, key, reverse=False):
+    # Merges runs into longer ones until the readers of the rest fit in the sort memory budget
+    fan_in = max(2, sort_memory_limit // run_reader_memory)
+    while len(runs) > fan_in:
+        merged = heapq.merge(*[read_run(path) for path in runs[:fan_in]], key=key, reverse=reverse)
+        runs = runs[fan_in:] + [spill_run(merged)]
+        count('sort_runs_merged', fan_in)
+    return runs
+
+
+def sort_partition(file_path, column_name, order='asc', limit=None):
+    # Spills the sorted runs of one partition, or returns its first limit rows
+    column_index = read_header(file_path).index(column_name)  # Find index of the column name
+    key = lambda row: order_value(row[column_index])
+    reverse = order.lower() == 'desc'
+    if limit is not None:
+        return list(external_sort(file_rows(file_path), key, reverse, limit))
+    return sorted_runs(file_rows(file_path), key, reverse, spill_last=True)[0]
+
+
+@timed_stage('sort')
+def order_data_partition(table_name, column_name, order='asc', limit=None):
+    file_paths = partition_files(table_name)
+    if not file_paths:
+        return
+    header = read_header(file_paths[0])  # Every partition starts with the same header
+    column_index = header.index(column_name)
+    key = lambda row: order_value(row[column_index])
+    reverse = order.lower() == 'desc'
+
+    if parallel_workers > 1:
+        # Every partition is sorted in a worker, then the sorted runs are merged here
+        results = map_partitions(sort_partition, file_paths, column_name, order, limit)
+        if limit is not None:
+            merged = external_sort((row for rows in results for row in rows), key, reverse, limit)
+        else:
+            runs = merge_runs([path for runs in results for path in runs], key, reverse)
+            merged = heapq.merge(*[read_run(path) for path in runs], key=key, reverse=reverse)
+    else:
+        merged = external_sort((row for file_path in file_paths for row in file_rows(file_path)), key, reverse,
+                               limit)
 
-        # Convert update column names to indices
-        update_indices = [(header.index(col_name), new_val) for col_name, new_val in updates]
+    # Print the sorted data
+    print(','.join(header))  # Print the header
+    for row in merged:
+        print(','.join(row))  # Print the sorted data rows
 
-        for line in file:
-            values = line.strip().split(',')
-            operator, condition_value = condition[1], condition[2]
-            if is_condition_met(float(values[condition_column_index]), operator, float(condition_value)):
-                for col_idx, new_val in update_indices:
-                    values[col_idx] = new_val
-            updated_lines.append(','.join(values))
 
-    with open(f"dbs/{file_name}.csv", 'w') as file:
-        file.write(','.join(header) + '\n')  # Write the header back
-        for line in updated_lines:
-            file.write(line + '\n')
+def update_data(file_name, condition, updates):
+    if is_columnar(file_name):
+        return update_data_columnar(file_name, condition, updates)
+    if is_fixed_width(file_name):
+        return update_data_fixed(file_name, condition, updates)
+    apply_view_deltas(update_rows(f"dbs/{file_name}.csv", condition, updates)[1])
+
+
+@timed_stage('sort')
+def order_data(file_name, column_name, order='asc', limit=None):
+    if is_columnar(file_name):
+        return order_data_columnar(file_name, column_name, order, limit)
+    if is_fixed_width(file_name):
+        return order_data_fixed(file_name, column_name, order, limit)
+    header = read_header(f"dbs/{file_name}.csv")  # Read the header
+    column_index = header.index(column_name)  # Find index of the column name
+    print(column_index)
+
+    # Sorting the data based on the specified column
+    data = external_sort(file_rows(f"dbs/{file_name}.csv"), lambda row: order_value(row[column_index]),
+                         reverse=(order.lower() == 'desc'), limit=limit)
 
+    # Print the sorted data
+    print(','.join(header))  # Print the header
+    for row in data:
+        print(','.join(row))  # Print the sorted data rows
+
+
+@timed_stage('sort')
+def order_data_columnar(table_name, column_name, order='asc', limit=None):
+    # Sorts row positions on the one mapped key column and only then fetches the other columns
+    schema = read_schema(table_name)
+    mapped = map_columns(table_name, schema)
+    columns = [mapped[name] for name, _ in schema]
+    key_column = mapped[column_name]
+    if limit is not None:
+        select = heapq.nlargest if order.lower() == 'desc' else heapq.nsmallest
+        positions = select(limit, range(len(key_column)), key=key_column.__getitem__)
+    else:
+        positions = sorted(range(len(key_column)), key=key_column.__getitem__, reverse=(order.lower() == 'desc'))
 
-def order_data(file_name, column_name, order='asc'):
-    with open(f"dbs/{file_name}.csv", 'r') as file:
-        header = next(file).strip().split(',')  # Read the header
-        column_index = header.index(column_name)  # Find index of the column name
-        print(column_index)
-        # Processing the data lines
-        data = [line.strip().split(',') for line in file.readlines()]
+    print(','.join(name for name, _ in schema))
+    for i in positions:
+        print(','.join(format_value(column[i]) for column in columns))
 
-        # Sorting the data based on the specified column
-        data.sort(key=lambda row: float(row[column_index]) if row[column_index].replace('.', '', 1).isdigit() else row[
-            column_index],
-                  reverse=(order.lower() == 'desc'))
 
-        # Print the sorted data
-        print(','.join(header))  # Print the header
-        for row in data:
-            print(','.join(row))  # Print the sorted data rows
+# Hash aggregation
+# "aggregate sum(salary),avg(salary) from <table> [by <column>]" keeps one running
+# (count, sum, min, max) state per group and aggregated column, so memory grows with the
+# number of groups rather than the number of rows.
+aggregate_functions = ('sum', 'count', 'min', 'max', 'avg')
 
 
-def aggregate_data(file_name, column_name, agg_function):
-    values = []
-    with open(f"dbs/{file_name}", 'r') as file:
-        header = next(file).strip().split(',')  # Read the header
-        column_index = header.index(column_name)  # Find index of the column name
+def parse_aggregates(spec, approximate=False):
+    # "sum(salary),count(id)" -> [('sum', 'salary'), ('count', 'id')]
+    aggregates = []
+    for part in spec.split(','):
+        match = re.fullmatch(r"(\w+)\((\w+)\)", part.strip())
+        if not match or not (match.group(1).lower() in aggregate_functions or is_sketch_function(match.group(1).lower())):
+            raise ValueError(f"Unknown aggregate: {part}")
+        if is_sketch_function(match.group(1).lower()) and not approximate:
+            raise ValueError(f"{match.group(1).lower()} is only computed by aggregate approx")
+        aggregates.append((match.group(1).lower(), match.group(2)))
+    return aggregates
 
-        for line in file:
-            row = line.strip().split(',')
-            values.append(float(row[column_index]))
 
+def finish_aggregate(state, agg_function):
+    count, total, minimum, maximum = state
     if agg_function == 'sum':
-        return sum(values)
+        return total
     elif agg_function == 'count':
-        return len(values)
+        return count
     elif agg_function == 'max':
-        return max(values)
+        return maximum
     elif agg_function == 'min':
-        return min(values)
+        return minimum
     elif agg_function == 'avg':
-        return sum(values) / len(values) if values else 0
+        return total / count if count else 0
+
+
+def accumulate_row(groups, key, values, numeric):
+    states = groups.get(key)
+    if states is None:
+        states = groups[key] = [[0, 0.0, None, None] for _ in values]
+    for state, value, is_numeric in zip(states, values, numeric):
+        state[0] += 1
+        if is_numeric:
+            value = float(value)
+            state[1] += value
+            if state[2] is None or value < state[2]:
+                state[2] = value
+            if state[3] is None or value > state[3]:
+                state[3] = value
+
+
+def aggregate_partition(data_file, columns, numeric, group_by_column=None):
+    # Partial aggregate states of one data file, merged by hash_aggregate
+    groups = {}
+    header = read_header(data_file)
+    positions = [header.index(name) for name in columns]
+    group_position = header.index(group_by_column) if group_by_column else None
+    for row in streamed_rows(data_file):
+        if len(row) < len(header):
+            continue  # Blank line
+        accumulate_row(groups, row[group_position] if group_by_column else None,
+                       [row[i] for i in positions], numeric)
+    return groups
+
+
+def merge_aggregate_states(groups, partial):
+    for key, states in partial.items():
+        current = groups.get(key)
+        if current is None:
+            groups[key] = states
+            continue
+        for state, other in zip(current, states):
+            state[0] += other[0]
+            state[1] += other[1]
+            if other[2] is not None and (state[2] is None or other[2] < state[2]):
+                state[2] = other[2]
+            if other[3] is not None and (state[3] is None or other[3] > state[3]):
+                state[3] = other[3]
+
+
+@timed_stage('aggregate')
+def hash_aggregate(table_name, aggregates, group_by_column=None):
+    """
+    Computes several aggregates per group in a single pass over every data file of a table.
 
+    :param table_name: Flat, partitioned, columnar or fixed-width table.
+    :param aggregates: List of (function, column name) pairs.
+    :param group_by_column: Column to group on, or None for one group over the whole table.
+    :return: Dict mapping each group key to the list of aggregate results.
+    """
+    view = matching_view(table_name, aggregates, group_by_column)
+    if view:
+        return finish_groups(view_groups(view), view['columns'], aggregates)
+    columns = list(dict.fromkeys(column_name for _, column_name in aggregates))
+    # Only columns feeding sum/min/max/avg are converted to numbers, count just counts
+    numeric = [any(f != 'count' and c == column_name for f, c in aggregates) for column_name in columns]
+    return finish_groups(aggregate_states(table_name, columns, numeric, group_by_column), columns, aggregates)
+
+
+def aggregate_states(table_name, columns, numeric, group_by_column=None):
+    # Running (count, sum, min, max) states of the columns per group, from one pass over the table
+    groups = {}
+    if group_by_column is None:
+        groups[None] = [[0, 0.0, None, None] for _ in columns]
+
+    if is_columnar(table_name):
+        schema = read_schema(table_name)
+        all_columns = map_columns(table_name, schema)
+        mapped = [all_columns[name] for name in columns]
+        group_column = all_columns[group_by_column] if group_by_column else None
+        for i in range(len(all_columns[schema[0][0]])):
+            accumulate_row(groups, format_value(group_column[i]) if group_column else None,
+                           [column[i] for column in mapped], numeric)
+    elif is_fixed_width(table_name):
+        schema, rows = fixed_rows(table_name)
+        names = [name for name, _ in schema]
+        positions = [names.index(name) for name in columns]
+        group_position = names.index(group_by_column) if group_by_column else None
+        for _, values in rows:
+            accumulate_row(groups, format_value(values[group_position]) if group_by_column else None,
+                           [values[i] for i in positions], numeric)
+    else:
+        for partial in map_partitions(aggregate_partition, table_data_files(table_name), columns, numeric,
+                                      group_by_column):
+            merge_aggregate_states(groups, partial)
+    return groups
 
-def join_tables(file_name1, file_name2, join_column_name, selected_columns=None):
-    with open(f"dbs/{file_name1}", 'r') as file1, open(f"dbs/{file_name2}", 'r') as file2:
-        header1 = next(file1).strip().split(',')
-        header2 = next(file2).strip().split(',')
-        join_column_index1 = header1.index(join_column_name)
-        join_column_index2 = header2.index(join_column_name)  # Assuming the same column name in both tables
 
-        data1 = [line.strip().split(',') for line in file1.readlines()]
-        data2 = [line.strip().split(',') for line in file2.readlines()]
+def finish_groups(groups, columns, aggregates):
+    column_positions = {name: i for i, name in enumerate(columns)}
+    return {key: [finish_aggregate(states[column_positions[column_name]], agg_function)
+                  for agg_function, column_name in aggregates]
+            for key, states in groups.items()}
 
-        dict2 = {row[join_column_index2]: row for row in data2}
 
-        joined_data = []
-        for row1 in data1:
-            key = row1[join_column_index1]
-            if key in dict2:
-                combined_row = row1 + dict2[key]
+@timed_stage('aggregate')
+def aggregate_data(file_name, column_name, agg_function):
+    if agg_function not in aggregate_functions:
+        raise ValueError(f"Unknown aggregate: {agg_function}")
+    table_name = os.path.splitext(file_name)[0]
+    return hash_aggregate(table_name, [(agg_function, column_name)])[None][0]
+
+
+# Materialized views
+# "new view <name> as aggregate sum(salary),avg(salary) from <table> [by <column>]" keeps the
+# running (count, sum, min, max) state of every group of a flat or partitioned table in
+# "dbs/<name>.view"; "dbs/<table>.views" lists the views of a table. put, load, remove and renew
+# fold the rows they add and drop into the states, so "show view <name>" and every aggregate /
+# aggregate_p the view can answer cost one pass over the groups. Dropping a row holding a group's
+# minimum or maximum marks the view stale, and the next read recomputes it from the table.
+def view_file_name(view_name):
+    return f"dbs/{view_name}.view"
+
+
+def table_views(table_name):
+    try:
+        with open(f"dbs/{table_name}.views", 'r') as file:
+            return [line.strip() for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def load_view(view_name):
+    with open(view_file_name(view_name), 'r') as file:
+        view = json.load(file)
+    view['groups'] = {key: states for key, states in view['groups']}
+    view['name'] = view_name
+    return view
+
+
+def save_view(view_name, view):
+    tmp_file = temporary_file_name(view_file_name(view_name))
+    with open(tmp_file, 'w') as file:
+        json.dump(dict(view, groups=list(view['groups'].items())), file)  # Keys may be None
+    os.replace(tmp_file, view_file_name(view_name))
+
+
+def create_view(view_name, table_name, aggregates, group_by_column=None):
+    if os.path.exists(view_file_name(view_name)):
+        print(f"View {view_name} already exists.")
+        return
+    if is_columnar(table_name) or is_fixed_width(table_name) or not table_data_files(table_name):
+        raise ValueError(f"Views are kept on flat and partitioned tables, {table_name} is not one")
+    columns = list(dict.fromkeys(column_name for _, column_name in aggregates))
+    numeric = [any(f != 'count' and c == column_name for f, c in aggregates) for column_name in columns]
+    view = {'table': table_name, 'aggregates': aggregates, 'columns': columns, 'numeric': numeric, 'group_by': group_by_column,
+            'stale': False, 'groups': aggregate_states(table_name, columns, numeric, group_by_column)}
+    save_view(view_name, view)
+    with open(f"dbs/{table_name}.views", 'a') as file:
+        file.write(view_name + '\n')
+    print(f"View {view_name} created.")
+
+
+def view_groups(view):
+    # Group states of a view, recomputed first when a dropped row may have held a minimum or maximum
+    if view['stale']:
+        view['groups'] = aggregate_states(view['table'], view['columns'], view['numeric'], view['group_by'])
+        view['stale'] = False
+        save_view(view['name'], view)
+    return view['groups']
+
+
+def matching_view(table_name, aggregates, group_by_column):
+    # A view of the table holding the states the aggregates need, or None
+    for view_name in table_views(table_name):
+        view = load_view(view_name)
+        numeric = dict(zip(view['columns'], view['numeric']))
+        kept = [tuple(aggregate) for aggregate in view['aggregates']]
+        # Sums and counts of every column are exact, minimums and maximums only where the view asks for them
+        if view['group_by'] == group_by_column and all(
+                (f == 'count' and c in numeric) or (f in ('sum', 'avg') and numeric.get(c)) or (f, c) in kept
+                for f, c in aggregates):
+            return view
+    return None
+
+
+def view_deltas(data_file, removed, added):
+    """
+    Aggregates the lines a mutation of a data file drops and adds, for every view of its table.
+    Computed before the mutation is written, so a value a view can not aggregate rejects the mutation.
 
-                if selected_columns:
-                    # Find indices for selected columns
-                    combined_indices = []
-                    for col in selected_columns:
-                        table_name, col_name = col.split('.')
-                        if table_name == file_name1.split('.')[0]:
-                            combined_indices.append(header1.index(col_name))
-                        else:
-                            combined_indices.append(len(header1) + header2.index(col_name))
-                    combined_row = [combined_row[i] for i in combined_indices]
+    :return: Dict mapping a view name to a pair of (removed, added) group states.
+    """
+    deltas = {}
+    view_names = table_views(table_name_of(data_file))
+    if not view_names:
+        return deltas
+    header = read_header(data_file)
+    for view_name in view_names:
+        view = load_view(view_name)
+        positions = [header.index(name) for name in view['columns']]
+        group_position = header.index(view['group_by']) if view['group_by'] else None
+        deltas[view_name] = ({}, {})
+        for groups, lines in zip(deltas[view_name], (removed, added)):
+            for line in lines:
+                values = line.strip().split(',')
+                accumulate_row(groups, values[group_position] if view['group_by'] else None,
+                               [values[i] for i in positions], view['numeric'])
+    return deltas
+
+
+def merge_view_deltas(deltas, partial):
+    for view_name, (removed, added) in partial.items():
+        if view_name not in deltas:
+            deltas[view_name] = ({}, {})
+        merge_aggregate_states(deltas[view_name][0], removed)
+        merge_aggregate_states(deltas[view_name][1], added)
+
+
+def apply_view_deltas(deltas):
+    for view_name, (removed, added) in deltas.items():
+        view = load_view(view_name)
+        groups = view['groups']
+        minimums = [any(f == 'min' and c == name for f, c in view['aggregates']) for name in view['columns']]
+        maximums = [any(f == 'max' and c == name for f, c in view['aggregates']) for name in view['columns']]
+        for key, states in removed.items():
+            if key not in groups:
+                view['stale'] = True  # Out of step with the table, recomputed on the next read
+                continue
+            for state, other, has_min, has_max in zip(groups[key], states, minimums, maximums):
+                state[0] -= other[0]
+                state[1] -= other[1]
+                if (has_min and other[2] <= state[2]) or (has_max and other[3] >= state[3]):
+                    view['stale'] = True  # The minimum or maximum may be gone
+            if groups[key][0][0] == 0 and view['group_by']:
+                del groups[key]
+        merge_aggregate_states(groups, added)
+        save_view(view_name, view)
+
+
+# Approximate aggregation
+# "aggregate approx avg(salary),count_distinct(name),median(salary),p90(salary) from <table> [by <column>]"
+# answers from a small sketch of every data file instead of its rows: the exact row count, a
+# reservoir sample of sample_size rows and HyperLogLog registers of the columns counted distinct.
+# The sketch of a file is kept in "dbs/<file>.sketch" and rebuilt with one pass over that file
+# alone once the file changes, so after a put only the partitions written are read again.
+# Every value comes with the half width of its 95% confidence interval: sums, counts and averages
+# are scaled up from the samples of all files (stratified sampling), medians and percentiles are
+# read off the merged weighted samples with the bound following from their rank error, and
+# count_distinct merges the registers. min and max are the extremes of the samples and carry no
+# bound. Files smaller than the sample are sampled whole, so their share of a result is exact.
+sample_size = int(os.environ.get('FILEDB_SAMPLE_SIZE', 10000))  # Rows sampled per data file
+hll_precision = int(os.environ.get('FILEDB_HLL_PRECISION', 14))  # 2^14 registers, 0.8% standard error
+sketch_cache_size = int(os.environ.get('FILEDB_SKETCH_CACHE', 256))  # Sketches kept in memory
+sketch_cache = OrderedDict()  # data file -> sketch of its current version
+confidence_z = 1.96
+
+
+def is_sketch_function(agg_function):
+    # count_distinct, median and percentiles p1 .. p99
+    return agg_function in ('count_distinct', 'median') or re.fullmatch(r'p[1-9]\d?', agg_function) is not None
+
+
+def sketch_file_name(data_file):
+    return os.path.splitext(data_file)[0] + '.sketch'
+
+
+def drop_sketch(data_file):
+    with cache_lock:
+        sketch_cache.pop(data_file, None)
+    if os.path.exists(sketch_file_name(data_file)):
+        os.remove(sketch_file_name(data_file))
+
+
+def hll_add(registers, value):
+    hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+    rest_bits = 64 - hll_precision
+    rank = rest_bits - (hashed & ((1 << rest_bits) - 1)).bit_length() + 1  # Leading zeros + 1
+    position = hashed >> rest_bits
+    if rank > registers[position]:
+        registers[position] = rank
+
+
+def hll_estimate(registers):
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)  # Linear counting while most registers are empty
+    return estimate
+
+
+def distinct_key(group_by_column, column_name):
+    return f"{group_by_column or ''}|{column_name}"
+
+
+def build_sketch(data_file, version, distinct_keys):
+    header = read_header(data_file)
+    counted = []
+    registers = {}
+    for key in distinct_keys:
+        group_by_column, column_name = key.split('|')
+        registers[key] = {}
+        counted.append((header.index(group_by_column) if group_by_column else None, header.index(column_name),
+                        registers[key]))
+
+    # Algorithm L: the position of the next row to keep is drawn ahead, not one random number per row
+    rng = random.Random(data_file)
+    sample, rows, next_kept, weight = [], 0, None, 1.0
+    for row in streamed_rows(data_file):
+        if len(row) < len(header):
+            continue  # Blank line
+        for group_position, position, groups in counted:
+            key = row[group_position] if group_position is not None else ''
+            group_registers = groups.get(key)
+            if group_registers is None:
+                group_registers = groups[key] = bytearray(1 << hll_precision)
+            hll_add(group_registers, row[position])
+        if rows < sample_size:
+            sample.append(row)
+        elif rows == next_kept:
+            sample[rng.randrange(sample_size)] = row
+        rows += 1
+        if rows >= sample_size and (next_kept is None or rows > next_kept):
+            weight *= math.exp(math.log(1.0 - rng.random()) / sample_size)
+            next_kept = rows + int(math.log(1.0 - rng.random()) / math.log1p(-weight))
+    count('sketches_built')
+    return {'version': version, 'header': header, 'rows': rows, 'sample': sample,
+            'distinct': {key: {group: group_registers.hex() for group, group_registers in groups.items()}
+                         for key, groups in registers.items()}}
+
+
+def partition_sketch(data_file, distinct_keys):
+    """
+    Returns the sketch of a data file, rebuilt when the file changed or lacks registers of a column.
 
-                joined_data.append(combined_row)
+    :param data_file: Path to the data file.
+    :param distinct_keys: "group column|column" keys of the registers needed.
+    :return: Tuple of (dict with the header, row count, sample rows and hex encoded registers per group,
+             whether it was rebuilt and has to be saved).
+    """
+    version = repr(file_version(data_file))
+    sketch = None
+    try:
+        with open(sketch_file_name(data_file), 'r') as file:
+            sketch = json.load(file)
+    except (FileNotFoundError, ValueError):
+        pass
+    if sketch and sketch['version'] == version and all(key in sketch['distinct'] for key in distinct_keys):
+        return sketch, False
+    if sketch and sketch['version'] == version:
+        distinct_keys = sorted(set(distinct_keys) | set(sketch['distinct']))  # Keep the registers built before
+    return build_sketch(data_file, version, distinct_keys), True
+
+
+def save_sketch(data_file, sketch):
+    tmp_file = temporary_file_name(sketch_file_name(data_file))
+    with open(tmp_file, 'w') as file:
+        json.dump(sketch, file)
+    os.replace(tmp_file, sketch_file_name(data_file))
+
+
+def table_sketches(table_name, distinct_keys):
+    # Sketches of every data file, building the missing or outdated ones in the worker pool
+    data_files = table_data_files(table_name)
+    sketches, missing = {}, []
+    for data_file in data_files:
+        with cache_lock:
+            sketch = sketch_cache.get(data_file)
+        if (sketch and sketch['version'] == repr(file_version(data_file))
+                and all(key in sketch['distinct'] for key in distinct_keys)):
+            sketches[data_file] = sketch
+        else:
+            missing.append(data_file)
+    for data_file, (sketch, rebuilt) in zip(missing, map_partitions(partition_sketch, missing, distinct_keys)):
+        if rebuilt:
+            save_sketch(data_file, sketch)  # Written here, the workers only build sketches
+        sketches[data_file] = sketch
+    with cache_lock:
+        for data_file in data_files:
+            sketch_cache[data_file] = sketches[data_file]
+            sketch_cache.move_to_end(data_file)
+        while len(sketch_cache) > sketch_cache_size:
+            sketch_cache.popitem(last=False)
+    return [sketches[data_file] for data_file in data_files]
+
+
+def sample_quantile(values, cumulative, q):
+    # Value at rank q of weighted values sorted in ascending order
+    position = bisect.bisect_left(cumulative, q * cumulative[-1])
+    return values[min(position, len(values) - 1)]
+
+
+@timed_stage('aggregate')
+def approximate_aggregate(table_name, aggregates, group_by_column=None):
+    """
+    Estimates aggregates per group from the sketches of the data files of a table.
 
-        for row in joined_data:
-            print(','.join(row))
+    :param table_name: Flat or partitioned table.
+    :param aggregates: List of (function, column name) pairs, functions may include count_distinct, median and pNN.
+    :param group_by_column: Column to group on, or None for one group over the whole table.
+    :return: Dict mapping each group key to a list of (estimate, 95% bound) pairs, the bound None when unknown.
+    """
+    if is_columnar(table_name) or is_fixed_width(table_name) or not table_data_files(table_name):
+        raise ValueError(f"Approximate aggregates run on flat and partitioned tables, {table_name} is not one")
+    if not any(is_sketch_function(f) for f, _ in aggregates):
+        view = matching_view(table_name, aggregates, group_by_column)
+        if view:  # Exact and cheaper than the sketches
+            return {key: [(value, 0.0) for value in values]
+                    for key, values in finish_groups(view_groups(view), view['columns'], aggregates).items()}
+
+    distinct_keys = sorted({distinct_key(group_by_column, c) for f, c in aggregates if f == 'count_distinct'})
+    sketches = table_sketches(table_name, distinct_keys)
+    header = sketches[0]['header']
+    group_position = header.index(group_by_column) if group_by_column else None
+    columns = list(dict.fromkeys(c for f, c in aggregates if f not in ('count', 'count_distinct')))
+    positions = [header.index(name) for name in columns]
+    exact = all(len(sketch['sample']) == sketch['rows'] for sketch in sketches)
+
+    # Per file and group: sampled rows and the sum and sum of squares of every column
+    strata = []
+    values = defaultdict(lambda: [[] for _ in columns])  # group -> per column (value, weight) pairs
+    for sketch in sketches:
+        sampled = len(sketch['sample'])
+        if not sampled:
+            continue
+        weight = sketch['rows'] / sampled
+        groups = {}
+        for row in sketch['sample']:
+            key = row[group_position] if group_by_column else None
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = [0, [[0.0, 0.0] for _ in columns]]
+            group[0] += 1
+            for sums, column_values, position in zip(group[1], values[key], positions):
+                value = float(row[position])
+                sums[0] += value
+                sums[1] += value * value
+                column_values.append((value, weight))
+        strata.append((sketch['rows'], sampled, groups))
+
+    keys = {None} if group_by_column is None else set(values)
+    for sketch in sketches:
+        for key in distinct_keys if group_by_column else []:
+            keys.update(sketch['distinct'][key])  # Groups too rare to be sampled
+
+    def scale(key, estimate):
+        # Stratified estimate of the total of estimate(sampled, in group, sum, sum of squares) and its variance
+        total, variance = 0.0, 0.0
+        for rows, sampled, groups in strata:
+            group = groups.get(key)
+            in_group, sums = (group[0], group[1]) if group else (0, None)
+            y, yy = estimate(in_group, sums)
+            total += rows / sampled * y
+            if sampled > 1:
+                variance += rows * rows * (1 - sampled / rows) / sampled * max(0.0, yy - y * y / sampled) / (sampled - 1)
+        return total, variance
+
+    results = {}
+    for key in keys:
+        row_count, count_variance = scale(key, lambda in_group, sums: (in_group, in_group))
+        results[key] = []
+        for agg_function, column_name in aggregates:
+            if agg_function == 'count':
+                results[key].append((row_count, confidence_z * math.sqrt(count_variance)))
+            elif agg_function == 'count_distinct':
+                merged = None
+                for sketch in sketches:
+                    registers = sketch['distinct'][distinct_key(group_by_column, column_name)].get(key if group_by_column else '')
+                    if registers is not None:
+                        registers = bytes.fromhex(registers)
+                        merged = registers if merged is None else bytes(map(max, merged, registers))
+                estimate = hll_estimate(merged) if merged else 0.0
+                results[key].append((estimate, confidence_z * 1.04 / math.sqrt(1 << hll_precision) * estimate))
+            else:
+                i = columns.index(column_name)
+                if agg_function in ('sum', 'avg'):
+                    total, variance = scale(key, lambda in_group, sums: (sums[i][0], sums[i][1]) if sums else (0.0, 0.0))
+                    if agg_function == 'sum':
+                        results[key].append((total, confidence_z * math.sqrt(variance)))
+                        continue
+                    average = total / row_count if row_count else 0
+                    # Ratio estimate, the variance taken from the residuals value - average of the group's rows
+                    _, variance = scale(key, lambda in_group, sums: (
+                        sums[i][0] - average * in_group,
+                        sums[i][1] - 2 * average * sums[i][0] + average * average * in_group) if sums else (0.0, 0.0))
+                    results[key].append((average, confidence_z * math.sqrt(variance) / row_count if row_count else 0.0))
+                    continue
+                weighted = sorted(values[key][i]) if key in values else []
+                if not weighted:
+                    results[key].append((None, None))
+                elif agg_function in ('min', 'max'):
+                    results[key].append((weighted[0][0] if agg_function == 'min' else weighted[-1][0],
+                                         0.0 if exact else None))
+                else:
+                    q = 0.5 if agg_function == 'median' else int(agg_function[1:]) / 100
+                    sorted_values = [value for value, _ in weighted]
+                    cumulative = list(accumulate(weight for _, weight in weighted))
+                    estimate = sample_quantile(sorted_values, cumulative, q)
+                    rank_error = 0.0 if exact else confidence_z * math.sqrt(q * (1 - q) / len(weighted))
+                    low = sample_quantile(sorted_values, cumulative, max(0.0, q - rank_error))
+                    high = sample_quantile(sorted_values, cumulative, min(1.0, q + rank_error))
+                    results[key].append((estimate, max(high - estimate, estimate - low)))
+    return results
+
+
+def approximate_value(value, bound):
+    # Rounded to two significant digits of the bound
+    if value is None or not bound:
+        return format_value(value)
+    digits = max(0, 1 - math.floor(math.log10(bound)))
+    return f"{value:.{digits}f}±{bound:.{digits}f}"
+
+
+# Join engine
+# Joins stream both tables through table_rows, so flat, partitioned and columnar tables can be on
+# either side and every matching pair is produced, duplicate keys included. Keys match when they are
+# the same number (1 and 1.0) or else the same text, with either strategy. When both tables are
+# stored in ascending key order (judged from their indexes) a sort-merge join is used. Otherwise a
+# hash table is built on the second table; if it grows past join_memory_limit bytes, both sides
+# are spilled into hash buckets on disk and joined bucket by bucket (grace hash join).
+join_memory_limit = int(os.environ.get('FILEDB_JOIN_MEMORY', 64 * 1024 * 1024))
+join_bucket_count = 16
+
+
+def table_header(table_name):
+    if is_columnar(table_name):
+        return [name for name, _ in read_schema(table_name)]
+    if is_fixed_width(table_name):
+        return [name for name, _ in read_fixed_schema(table_name)[0]]
+    return read_header(table_data_files(table_name)[0])
+
+
+def table_rows(table_name, condition=None, probe=None):
+    """
+    Yields the rows of a flat, partitioned, columnar or fixed-width table, in storage order.
 
+    :param table_name: Table to read.
+    :param condition: Optional (column name, operator, value) the rows must meet, answered by an index when possible.
+    :param probe: Optional (column name, keys): partitions whose Bloom filter holds none of the keys are skipped.
+    :return: Generator of rows (lists of values).
+    """
+    if is_columnar(table_name):
+        schema = read_schema(table_name)
+        mapped = map_columns(table_name, schema)
+        columns = [mapped[name] for name, _ in schema]
+        for i in columnar_matches(mapped, schema, condition):
+            yield [format_value(column[i]) for column in columns]
+        return
+    if is_fixed_width(table_name):
+        schema, rows = fixed_rows(table_name)
+        for _, values in fixed_matches(schema, rows, condition):
+            yield [format_value(value) for value in values]
+        return
+    partitioned = not os.path.exists(f"dbs/{table_name}.csv")
+    data_files = pruned_partition_files(table_name, condition) if partitioned else table_data_files(table_name)
+    if partitioned and probe and len(probe[1]) <= bloom_probe_keys:
+        hashed = [bloom_hash(key) for key in probe[1]]
+        kept = [data_file for data_file in data_files if bloom_may_contain(data_file, probe[0], hashed)]
+        count('partitions_skipped_by_bloom_filters', len(data_files) - len(kept))
+        data_files = kept
+    for data_file in data_files:
+        if condition:
+            for _, line in matching_rows(data_file, read_header(data_file), condition):
+                yield line.strip().split(',')
+        else:
+            yield from file_rows(data_file)
+
+
+def sorted_on(table_name, column_name):
+    # True when the table's rows are stored in ascending order of a numeric indexed column:
+    # every data file's index lists offsets in increasing order, and the files follow each other
+    if is_columnar(table_name) or is_fixed_width(table_name):
+        return False
+    data_files = table_data_files(table_name)
+    if not data_files or column_name not in [name for name, _ in data_file_indexes(data_files[0], table_header(table_name))]:
+        return False
+    previous = None
+    for data_file in data_files:
+        if any(line is not None for line in load_mutation_log(data_file).values()):
+            return False  # Updated values are not in the index yet
+        key_type, keys, offsets = load_index(data_file, column_name)
+        if key_type != 'float' or any(a > b for a, b in zip(offsets, offsets[1:])):
+            return False
+        if keys:
+            if previous is not None and keys[0] < previous:
+                return False
+            previous = keys[-1]
+    return True
+
+
+join_entry_memory = 128  # Per built row: its key, hash table entry and slot in the list of its key
+
+
+def join_key(value):
+    # Keys are equal when they are the same number, or else the same text, whichever strategy joins them
+    try:
+        number = float(value)
+    except ValueError:
+        return value
+    return number if number == number else value  # NaN equals nothing, its text still matches itself
+
+
+def spill_buckets(rows, key_index, depth):
+    # Writes rows into join_bucket_count temporary files by the hash of their key
+    files = [tempfile.NamedTemporaryFile('w', suffix='.run', delete=False) for _ in range(join_bucket_count)]
+    count('join_buckets_spilled', join_bucket_count)
+    for row in rows:
+        bucket = zlib.crc32(f"{depth}:{join_key(row[key_index])}".encode()) % join_bucket_count
+        files[bucket].write(','.join(row) + '\n')
+    for file in files:
+        file.close()
+    return [file.name for file in files]
+
+
+def probe_rows(rows, table, key_index):
+    for row in rows:
+        for match in table.get(join_key(row[key_index]), ()):
+            yield row + match
+
+
+def grace_join(left_rows, right_rows, left_key, right_key, depth):
+    right_buckets = spill_buckets(right_rows, right_key, depth)
+    left_buckets = spill_buckets(left_rows, left_key, depth)
+    for left_bucket, right_bucket in zip(left_buckets, right_buckets):
+        yield from hash_join(read_run(left_bucket), read_run(right_bucket), left_key, right_key, depth + 1)
+
+
+def hash_join(left_rows, right_rows, left_key, right_key, depth=0):
+    """
+    Joins two row streams on equal key values, building the hash table on the right side.
 
-def group_data(file_name, group_by_column, print_columns):
+    :param left_rows: Left rows, or a function of the built keys (None once spilled) returning them.
+    :param left_key: Position of the key in the left rows.
+    :param right_key: Position of the key in the right rows.
+    :param depth: Number of times the inputs were already split into buckets.
+    :return: Iterator over joined rows (left row followed by right row).
+    """
+    right_rows = iter(right_rows)
+    table = defaultdict(list)
+    size = 0
+    for row in right_rows:
+        table[join_key(row[right_key])].append(row)
+        size += row_memory(row) + join_entry_memory
+        # A bucket that is still too large after a few splits is mostly a single key, keep it in memory
+        if size > join_memory_limit and depth < 3:
+            built = (built_row for built_rows in table.values() for built_row in built_rows)
+            left_rows = left_rows(None) if callable(left_rows) else left_rows
+            return grace_join(left_rows, chain(built, right_rows), left_key, right_key, depth)
+    return probe_rows(left_rows(table.keys()) if callable(left_rows) else left_rows, table, left_key)
+
+
+def merge_join(left_rows, right_rows, left_key, right_key):
+    # Both inputs ascend on numeric keys; only the right rows sharing the current key are held
+    right_rows = iter(right_rows)
+    right = next(right_rows, None)
+    group, group_key = [], None
+    for row in left_rows:
+        key = float(row[left_key])
+        if key != group_key:
+            while right is not None and float(right[right_key]) < key:
+                right = next(right_rows, None)
+            group, group_key = [], key
+            while right is not None and float(right[right_key]) == key:
+                group.append(right)
+                right = next(right_rows, None)
+        for match in group:
+            yield row + match
+
+
+def join_strategy(table_name1, table_name2, join_column_name):
+    if sorted_on(table_name1, join_column_name) and sorted_on(table_name2, join_column_name):
+        return 'merge'
+    return 'hash'
+
+
+def join_rows(table_name1, table_name2, join_column_name, condition1=None, condition2=None):
+    """
+    Joins two tables on a column of the same name.
+
+    :param condition1: Optional condition on the first table, applied before joining.
+    :param condition2: Optional condition on the second table, applied before joining.
+    :return: Iterator over joined rows (row of the first table followed by row of the second).
+    """
+    key1 = table_header(table_name1).index(join_column_name)
+    key2 = table_header(table_name2).index(join_column_name)  # Assuming the same column name in both tables
+    rows2 = table_rows(table_name2, condition2)
+    if join_strategy(table_name1, table_name2, join_column_name) == 'merge':
+        return merge_join(table_rows(table_name1, condition1), rows2, key1, key2)
+    # The first table is only read once the keys of the second are known
+    return hash_join(lambda keys: table_rows(table_name1, condition1, None if keys is None else (join_column_name, keys)), rows2,
+                     key1, key2)
+
+
+def joined_column_index(column, table_name1, header1, header2):
+    # "table.column" picks that table's column, a bare name prefers the second table like a merged dict row
+    if '.' in column:
+        table_name, column_name = column.split('.', 1)
+        if table_name == table_name1:
+            return header1.index(column_name)
+        return len(header1) + header2.index(column_name)
+    if column in header2:
+        return len(header1) + header2.index(column)
+    return header1.index(column)
+
+
+@timed_stage('join')
+def join_tables(file_name1, file_name2, join_column_name, selected_columns=None):
+    table_name1, table_name2 = os.path.splitext(file_name1)[0], os.path.splitext(file_name2)[0]
+    header1, header2 = table_header(table_name1), table_header(table_name2)
+    combined_indices = None
+    if selected_columns:
+        # Find indices for selected columns
+        combined_indices = [joined_column_index(col, table_name1, header1, header2) for col in selected_columns]
+
+    for combined_row in join_rows(table_name1, table_name2, join_column_name):
+        if combined_indices:
+            combined_row = [combined_row[i] for i in combined_indices]
+        print(','.join(combined_row))
+
+
+def dict_rows(data_file, condition=None):
+    # Rows of a data file as dicts keyed by column name, through an index when there is one
+    header = read_header(data_file)
+    rows = indexed_rows(data_file, header, condition) if condition else None
+    if rows is not None:
+        return (dict(zip(header, line.strip().split(','))) for _, line in rows)
+    predicate = compile_condition(header, condition) if condition else None
+    return (dict(zip(header, values)) for values in pooled_rows(data_file) if not predicate or predicate(values))
+
+
+@timed_stage('group')
+def group_data(file_name, group_by_column, print_columns, condition=None):
     grouped_data = defaultdict(list)
-    with open(f"{file_name}", mode='r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            group_key = row[group_by_column]
-            grouped_data[group_key].append({col: row[col] for col in print_columns})
+    for row in dict_rows(file_name, condition):
+        group_key = row[group_by_column]
+        grouped_data[group_key].append({col: row[col] for col in print_columns})
 
     # Print grouped data
     # for group, rows in grouped_data.items():
@@ -376,16 +3550,22 @@ def group_data(file_name, group_by_column, print_columns):
     return grouped_data
 
 
-def group_data_partition(table_name, group_by_column, print_columns):
+def group_partition(file_path, group_by_column, print_columns, condition=None):
+    grouped_data = defaultdict(list)
+    for row in dict_rows(file_path, condition):
+        group_key = row[group_by_column]
+        grouped_data[group_key].append({col: row[col] for col in print_columns})
+    return grouped_data
+
+
+@timed_stage('group')
+def group_data_partition(table_name, group_by_column, print_columns, condition=None):
     grouped_data = defaultdict(list)
 
-    for file_name in os.listdir('dbs'):
-        if file_name.startswith(table_name):
-            with open(f"dbs/{file_name}", mode='r') as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    group_key = row[group_by_column]
-                    grouped_data[group_key].append({col: row[col] for col in print_columns})
+    for partial in map_partitions(group_partition, pruned_partition_files(table_name, condition), group_by_column,
+                                  print_columns, condition):
+        for group_key, rows in partial.items():
+            grouped_data[group_key].extend(rows)
 
     # Optionally, you can print the grouped data here
     # for group, rows in grouped_data.items():
@@ -397,283 +3577,876 @@ def group_data_partition(table_name, group_by_column, print_columns):
     return grouped_data
 
 
+@timed_stage('complex')
 def complex_query_execute(file_name1, file_name2, join_column_name, condition, selected_columns, order_column,
                           order='asc'):
-    # Join, filter, and order the data from two CSV files
-    with open(file_name1, mode='r') as file1, open(file_name2, mode='r') as file2:
-        reader1 = csv.DictReader(file1)
-        reader2 = csv.DictReader(file2)
-        data1 = [row for row in reader1]
-        data2 = {row[join_column_name]: row for row in reader2}
-
-        # Joining data
-        joined_data = []
-        for row1 in data1:
-            key = row1[join_column_name]
-            if key in data2:
-                joined_row = {**row1, **data2[key]}
-                joined_data.append(joined_row)
-
-        # Filtering data based on the condition
-        condition_column, operator, condition_value = condition
-        filtered_data = [row for row in joined_data if
-                         float(row[condition_column]) > float(condition_value)]  # Assuming '>'
-
-        # Sorting the data
-        ascending = order.lower() == 'asc'
-        filtered_data.sort(key=lambda x: float(x[order_column]), reverse=not ascending)
-
-        # Selecting and printing specified columns
-        for row in filtered_data:
-            selected_row = [row[col] for col in selected_columns]
-            print(', '.join(selected_row))
-
-
-def parse_and_execute(query):
-    commands = query.split(' ')
-    # new table employees
-    # the database will be read in chunks when reading the buffer limit.
-    if commands[0].lower() == 'new' and commands[1].lower() == 'table':
-        try:
-            table_name = commands[2]
-            headers = commands[3:]
-            create_table(table_name, headers)
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-    # insert into employees values 1 John 30
-
-    elif commands[0].lower() == 'new_p' and commands[1].lower() == 'table':
-        try:
-            table_name = commands[2]
-            headers = commands[3:]
-            create_table_partition(table_name, headers)  # Replaced create_table with create_table_partition
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-    elif commands[0].lower() == 'put':
-        try:
-            insert_data(commands[1], ','.join(commands[2:]))
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-    elif commands[0].lower() == 'put_p':
-        try:
-            insert_data_partition(commands[1], ','.join(commands[2:]))
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-    # delete from employees where age = 30
-    elif commands[0].lower() == 'remove':
-        try:
-            table_name = commands[2]
-            condition_parts = query.split(' where ')[1].split(' ')
-            condition = (condition_parts[0], condition_parts[1], condition_parts[2])
-            delete_data(f"{table_name}", condition)
-            print(f"Data deleted from {table_name}.")
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-        # delete from employees where age = 30
-    elif commands[0].lower() == 'remove_p':
-        try:
-            table_name = commands[2]
-            condition_parts = query.split(' where ')[1].split(' ')
-            condition = (condition_parts[0], condition_parts[1], condition_parts[2])
-            delete_data_partition(f"{table_name}", condition)
-            print(f"Data deleted from {table_name}.")
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-    # update employees set 1=John, 2=35 where col 0 = 1
-    elif commands[0].lower() == 'renew':
-        try:
-            table_name = commands[1]
-            set_clause = query.split(' put ')[1].split(' where ')[0]
-            where_clause = query.split(' where ')[1]
-
-            # Parsing the SET clause
-            updates = [(part.split('=')[0], part.split('=')[1]) for part in set_clause.split(',')]
-
-            # Parsing the WHERE clause
-            condition_parts = where_clause.split(' ')
-            condition_column_name = condition_parts[0]
-            operator = condition_parts[1]
-            condition_value = condition_parts[2]
-            condition = (condition_column_name, operator, condition_value)
-
-            # Call update_data
-            update_data(f"{table_name}", condition, updates)
-            print(f"Data updated in {table_name}.")
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-            # update employees set 1=John, 2=35 where col 0 = 1
-    elif commands[0].lower() == 'renew_p':
-        try:
-            table_name = commands[1]
-            set_clause = query.split(' put ')[1].split(' where ')[0]
-            where_clause = query.split(' where ')[1]
-
-            # Parsing the SET clause
-            updates = [(part.split('=')[0], part.split('=')[1]) for part in set_clause.split(',')]
-
-            # Parsing the WHERE clause
-            condition_parts = where_clause.split(' ')
-            condition_column_name = condition_parts[0]
-            operator = condition_parts[1]
-            condition_value = condition_parts[2]
-            condition = (condition_column_name, operator, condition_value)
-
-            # Call update_data
-            update_data_partition(f"{table_name}", condition, updates)
-            print(f"Data updated in {table_name}.")
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
-
-    elif commands[0].lower() == 'give':
-        try:
-            query_parts = query.split(' where ')
-            # give name,age from table employees where age >= 25
-
-            column_names = query_parts[0].split(' ')[1].split(',')
-            table_name = query_parts[0].split(' ')[-1]
-
-            condition = None
+    # Join, filter, and order the data from two tables
+    table_name1, table_name2 = table_name_of(file_name1), table_name_of(file_name2)
+    header1, header2 = table_header(table_name1), table_header(table_name2)
+
+    # Filtering the side that holds the condition column before joining, so an index on it can be used.
+    # The joined row takes the second table's value when both tables have the column.
+    condition1 = condition2 = None
+    if condition and condition[0] in header2:
+        condition2 = condition
+    elif condition:
+        condition1 = condition
+    joined_data = join_rows(table_name1, table_name2, join_column_name, condition1, condition2)
+
+    # Sorting the data
+    if order_column:
+        order_index = joined_column_index(order_column, table_name1, header1, header2)
+        joined_data = external_sort(joined_data, lambda row: float(row[order_index]),
+                                    reverse=(order or 'asc').lower() == 'desc')
+
+    # Selecting and printing specified columns
+    selected_indices = [joined_column_index(col, table_name1, header1, header2) for col in selected_columns]
+    for row in joined_data:
+        selected_row = [row[i] for i in selected_indices]
+        print(', '.join(selected_row))
+
+
+# explain / profile
+def log_stats(stats):
+    record = dict(stats, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    with stats_log_lock, open(stats_log_file, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+class CountingOutput:
+    # Passes output through, counting the lines
+    def __init__(self, output):
+        self.output = output
+        self.lines = 0
+
+    def write(self, text):
+        self.lines += text.count('\n')
+        return self.output.write(text)
+
+    def flush(self):
+        self.output.flush()
+
+
+def traced_peak_memory(query, output):
+    # Runs a query with tracemalloc on, returning the peak memory allocated while it ran
+    tracing = not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    try:
+        with captured_output(output):
+            execute_query(query, use_result_cache=False)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        if tracing:
+            tracemalloc.stop()
+
+
+def profile_query(query):
+    stats = current_stats() or query_stats(query)  # Shares the stats being logged, if any
+    output = CountingOutput(sys.stdout.target() if isinstance(sys.stdout, ThreadOutput) else sys.stdout)
+    query = normalize_query(query)
+    try:
+        plan = get_plan(query)
+    except Exception:
+        plan = None  # execute_query reports it
+    if plan and plan['command'] in cached_commands:
+        # Reads run twice: timed without tracemalloc, which slows every allocation, then traced for the
+        # peak memory with their output dropped. The traced run finds the caches the timed run filled.
+        with captured_output(output), collecting_stats(stats):
+            execute_query(query, use_result_cache=False)
+        with open(os.devnull, 'w') as discard, collecting_stats(query_stats(query)):
+            peak_memory = traced_peak_memory(query, discard)
+        overhead = ''
+    else:
+        # Writes must run once, so their stage times include the tracing overhead
+        with collecting_stats(stats):
+            peak_memory = traced_peak_memory(query, output)
+        overhead = ', including tracemalloc overhead'
+    stats['counters']['rows_returned'] = output.lines
+    stats['peak_memory'] = peak_memory
+
+    print(f"Profile of {stats['command'] or 'query'}{overhead}:")
+    for name, seconds in stats['stages'].items():
+        print(f"  {name}: {seconds * 1000:.3f} ms")
+    for name, value in sorted(stats['counters'].items()):
+        print(f"  {name.replace('_', ' ')}: {value}")
+    print(f"  peak memory: {peak_memory} bytes")
+
+
+def access_path(data_file, condition, byte_scan=False):
+    # How the rows of one data file meeting condition are found, byte_scan for readers using scans_bytes
+    header = read_header(data_file)
+    parts = []
+    indexed = [name for name, _ in data_file_indexes(data_file, header)]
+    if condition and condition[0] in indexed:
+        idx_file = index_file_name(data_file, condition[0])
+        if not os.path.exists(idx_file):
+            parts.append(f"index on {condition[0]}, built on first use")
+        else:
+            with open(idx_file, 'rb') as file:
+                key_type = file.readline().decode().split()[0]
+            if key_type == 'str' and condition[1] != '=':
+                parts.append(f"full scan, the {condition[0]} index only answers '='")
+            elif key_type == 'float' and not is_number(condition[2]):
+                parts.append(f"full scan, the {condition[0]} index holds numbers")
+            else:
+                parts.append(f"index on {condition[0]}")
+    else:
+        if in_buffer_pool(data_file):
+            parts.append('full scan from the buffer pool')
+        else:
+            parts.append('byte scan' if byte_scan and condition else 'full scan')
+    codec = data_file_codec(data_file)
+    if codec:
+        parts.append(f"{codec} blocks decompressed")
+    mutations = load_mutation_log(data_file)
+    if mutations:
+        parts.append(f"{len(mutations)} logged mutations merged")
+    return f"  {data_file}: {', '.join(parts)}"
+
+
+def explain_table(table_name, condition, byte_scan=False):
+    # Lines describing how the files of a table are read for a condition
+    if is_columnar(table_name):
+        return [f"  {table_name}: columnar, memory-mapped columns"
+                + (f", condition compared on column {condition[0]}" if condition else '')]
+    if is_fixed_width(table_name):
+        return [f"  {table_name}: fixed-width records, native values"
+                + (f", condition compared on column {condition[0]}" if condition else '')]
+    if os.path.exists(f"dbs/{table_name}.csv"):
+        return [access_path(f"dbs/{table_name}.csv", condition, byte_scan)]
+    all_files = partition_files(table_name)
+    if not all_files:
+        return [f"  {table_name}: no such table"]
+    file_paths = pruned_partition_files(table_name, condition)
+    scheme = load_partitioning(table_name)
+    lines = [f"  {table_name}: {len(file_paths)} of {len(all_files)} partitions"
+             f" ({len(all_files) - len(file_paths)} pruned by zone maps and Bloom filters)"
+             + (f", {parallel_workers} worker processes" if parallel_workers > 1 and len(file_paths) > 1 else '')
+             + (f", {scheme['method']} partitioned on {scheme['column']}" if scheme else '')]
+    return lines + ['  ' + access_path(file_path, condition, byte_scan) for file_path in file_paths]
+
+
+def explain_sort(limit):
+    if limit is not None:
+        return f"  sort: top-{limit} heap"
+    return f"  sort: external merge sort, runs of up to {sort_memory_limit} bytes spilled to disk"
+
+
+def explain_query(query):
+    plan = parse_query(normalize_query(query))
+    if plan is None:
+        print("Invalid query")
+        return
+    command = plan['command']
+    lines = [f"Plan of {command}:"]
+    condition = plan.get('condition')
+    if command in ('put', 'put_p'):
+        lines.append(f"  insert into {plan['table']}: buffered, committed in groups of {buffer_limit} rows")
+    elif command in ('give', 'give_p', 'remove', 'remove_p', 'renew', 'renew_p'):
+        if condition:
+            lines.append(f"  condition: {' '.join(condition)}")
+        lines += explain_table(plan['table'], condition, byte_scan=command.startswith('give'))
+        if command.startswith(('remove', 'renew')):
+            lines.append('  changes: rewritten columns swapped in' if is_columnar(plan['table'])
+                         else '  changes: records overwritten in place' if is_fixed_width(plan['table'])
+                         else '  changes: appended to the mutation log')
+    elif command in ('order', 'order_p'):
+        lines += explain_table(plan['table'], None)
+        lines.append('  sort: positions sorted on the mapped key column' if is_columnar(plan['table'])
+                     else '  sort: native values sorted in memory' if is_fixed_width(plan['table'])
+                     else explain_sort(plan['limit']))
+    elif command in ('aggregate', 'aggregate_p'):
+        aggregates = plan.get('aggregates') or [(plan['function'], plan['column'])]
+        view = matching_view(plan['table'], aggregates, plan.get('group_by'))
+        if plan.get('approx') and (not view or any(is_sketch_function(f) for f, _ in aggregates)):
+            lines.append(f"  aggregate: approximate, from sketches of {len(table_data_files(plan['table']))} data files "
+                         f"({sample_size}-row samples), rebuilt for the files changed since they were taken")
+        elif view:
+            lines.append(f"  aggregate: read from view {view['name']}" + (', recomputed first' if view['stale'] else ''))
+        else:
+            lines += explain_table(plan['table'], None)
+            lines.append(f"  aggregate: hash aggregation"
+                         + (f" grouped by {plan['group_by']}" if plan.get('group_by') else ''))
+    elif command in ('group', 'group_p'):
+        if condition:
+            lines.append(f"  condition: {' '.join(condition)}")
+        lines += explain_table(plan['table'], condition)
+        lines.append(f"  group: hash table on {plan['column']}")
+    elif command in ('join', 'complex'):
+        table_name1, table_name2 = plan['tables']
+        if condition:
+            lines.append(f"  condition: {' '.join(condition)}")
+        condition2 = condition if condition and condition[0] in table_header(table_name2) else None
+        lines += explain_table(table_name1, None if condition2 else condition)
+        lines += explain_table(table_name2, condition2)
+        if join_strategy(table_name1, table_name2, plan['column']) == 'merge':
+            lines.append(f"  join: merge join on {plan['column']}, both tables are stored in {plan['column']} order")
+        else:
+            lines.append(f"  join: hash join on {plan['column']}, turning into a grace hash join of "
+                         f"{join_bucket_count} buckets past {join_memory_limit} bytes")
+        if plan.get('order_by'):
+            lines.append(explain_sort(None))
+    else:
+        lines.append(f"  {command}: runs directly")
+    if command in cached_commands:
+        entry = result_cache.get(normalize_query(query))
+        versions = tuple(table_versions[table_name] for table_name in plan_tables(plan))
+        lines.append('  result cache: hit' if entry and entry[0] == versions else '  result cache: miss')
+    print('\n'.join(lines))
 
-            # If there is a where condition.
-            if 'where' in query:
-                condition_parts = query_parts[1].split(' ')
-                condition_column_name = condition_parts[0]
-                operator = condition_parts[1]
-                condition_value = condition_parts[2]
-                condition = (condition_column_name, operator, condition_value)
 
-            query_data(f"{table_name}.csv", column_names, condition)
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
+# Query front end
+# Every command is parsed once into a plan, a dict holding the command and its parsed arguments,
+# and execute_plan hands the plan to the storage functions above. Plans of read and maintenance
+# commands are kept in an LRU cache keyed by the whitespace-normalized query text, so a repeated
+# query skips parsing. put / put_p plans carry their row and are not cached.
+plan_cache = OrderedDict()
+plan_cache_size = int(os.environ.get('FILEDB_PLAN_CACHE', 256))
 
 
-    elif commands[0].lower() == 'give_p':
-        try:
-            query_parts = query.split(' where ')
-            # give name,age from table employees where age >= 25
+def normalize_query(query):
+    return ' '.join(query.split())
 
-            column_names = query_parts[0].split(' ')[1].split(',')
-            table_name = query_parts[0].split(' ')[-1]
 
-            condition = None
+def parse_condition(text):
+    # "age >= 25" -> ('age', '>=', '25')
+    parts = text.split(' ')
+    if len(parts) != 3 or parts[1] not in condition_operators:
+        raise ValueError(f"Invalid condition: {text}")
+    return tuple(parts)
 
-            # If there is a where condition.
-            if 'where' in query:
-                condition_parts = query_parts[1].split(' ')
-                condition_column_name = condition_parts[0]
-                operator = condition_parts[1]
-                condition_value = condition_parts[2]
-                condition = (condition_column_name, operator, condition_value)
 
-            query_data_partition(f"{table_name}.csv", column_names, condition)
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
+def parse_updates(text):
+    # "name=John,age=35" -> [('name', 'John'), ('age', '35')]
+    return [(part.split('=')[0], part.split('=')[1]) for part in text.split(',')]
 
 
-    # aggregate sum|max|min|avg|count from employees on age
-    elif commands[0].lower() == 'aggregate_p':
-        try:
-            agg_function = commands[1].lower()
-            table_name = commands[3]
-            column_name = commands[5]  # Extract the column name instead of index
+def parse_query(query):
+    """
+    Parses one command into a plan.
 
-            result = aggregate_data(f"{table_name}.csv", column_name, agg_function)
-            print(f"Aggregate {agg_function}: {result}")
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
+    :param query: Whitespace-normalized command text.
+    :return: Plan dict with a 'command' key, or None if the command is unknown.
+    """
+    commands = query.split(' ')
+    command = commands[0].lower()
+    # new index on employees age
+    if command == 'new' and commands[1].lower() == 'index':
+        return {'command': 'new_index', 'table': commands[3], 'column': commands[4]}
+
+    # new view salary_by_department as aggregate sum(salary),avg(salary) from employees by department
+    elif command == 'new' and commands[1].lower() == 'view':
+        if len(commands) < 5 or commands[3].lower() != 'as' or commands[4].lower() != 'aggregate':
+            raise ValueError("Expected new view <name> as aggregate <aggregates> from <table> [by <column>]")
+        plan = parse_query(' '.join(commands[4:]))
+        return {'command': 'new_view', 'view': commands[2], 'table': plan['table'], 'aggregates': plan['aggregates'],
+                'group_by': plan['group_by']}
+
+    # new table employees id:int name age:int using columnar
+    # new table employees id name age using zlib
+    # new table employees id:int name:str32 salary:float
+    elif command == 'new' and commands[1].lower() == 'table':
+        headers, storage = commands[3:], None
+        if len(headers) > 2 and headers[-2] == 'using':
+            headers, storage = headers[:-2], headers[-1]
+        if storage == 'columnar':
+            return {'command': 'new_table', 'table': commands[2], 'headers': headers, 'format': 'columnar'}
+        if storage and storage not in codecs:
+            raise ValueError(f"Unknown storage: {storage}")
+        if any(':' in header for header in headers):
+            if storage:
+                raise ValueError("Typed columns are stored fixed-width, they can not be compressed")
+            parse_fixed_schema(headers)
+            return {'command': 'new_table', 'table': commands[2], 'headers': headers, 'format': 'fixed'}
+        return {'command': 'new_table', 'table': commands[2], 'headers': headers, 'format': 'rows', 'codec': storage}
+
+    # new_p table employees id name age partition by hash name count 8 size 50000 using zlib
+    elif command == 'new_p' and commands[1].lower() == 'table':
+        headers, codec = commands[3:], None
+        if len(headers) > 2 and headers[-2] == 'using':
+            headers, codec = headers[:-2], headers[-1]
+            if codec not in codecs:
+                raise ValueError(f"Unknown codec: {codec}")
+        partitioning = None
+        if 'partition' in headers:
+            options = headers[headers.index('partition'):]
+            headers = headers[:headers.index('partition')]
+            if len(options) < 4 or options[1] != 'by' or options[2] not in partition_methods \
+                    or options[3] not in headers:
+                raise ValueError("Expected partition by range|hash <column> [count <n>] [size <rows>]")
+            settings = dict(zip(options[4::2], map(int, options[5::2])))
+            if len(options) % 2 or set(settings) - {'count', 'size'} or (options[2] == 'range' and 'count' in settings):
+                raise ValueError("Range partitions take a size, hash partitions a count and a size")
+            partitioning = {'method': options[2], 'column_name': options[3], 'size': settings.get('size'),
+                            'partition_count': settings.get('count')}
+        return {'command': 'new_p_table', 'table': commands[2], 'headers': headers, 'codec': codec,
+                'partitioning': partitioning}
+
+    # put employees 1 John 30
+    elif command in ('put', 'put_p'):
+        if command == 'put_p' and not load_partitioning(commands[1]):
+            int(commands[2])  # Partitioning on id ranges needs an integer id
+        return {'command': command, 'table': commands[1], 'data': ','.join(commands[2:])}
+
+    # load company_employee_details from company_employee_details.csv
+    elif command == 'load':
+        return {'command': 'load', 'table': commands[1], 'source': commands[3]}
+
+    # remove from employees where age = 30
+    elif command in ('remove', 'remove_p'):
+        return {'command': command, 'table': commands[2], 'condition': parse_condition(query.split(' where ')[1])}
+
+    # renew employees put name=John,age=35 where id = 1
+    elif command in ('renew', 'renew_p'):
+        set_clause = query.split(' put ')[1].split(' where ')[0]
+        return {'command': command, 'table': commands[1], 'updates': parse_updates(set_clause),
+                'condition': parse_condition(query.split(' where ')[1])}
+
+    # give name,age from table employees where age >= 25
+    elif command in ('give', 'give_p'):
+        query_parts = query.split(' where ')
+        condition = parse_condition(query_parts[1]) if len(query_parts) > 1 else None
+        return {'command': command, 'table': query_parts[0].split(' ')[-1],
+                'columns': query_parts[0].split(' ')[1].split(','), 'condition': condition}
+
+    # aggregate_p sum from employees by age
+    # aggregate_p approx median from employees by age
+    elif command == 'aggregate_p':
+        if commands[1].lower() == 'approx':
+            (function, column_name), = parse_aggregates(f"{commands[2]}({commands[6]})", approximate=True)
+            return {'command': 'aggregate_p', 'function': function, 'table': commands[4], 'column': column_name,
+                    'approx': True}
+        return {'command': 'aggregate_p', 'function': commands[1].lower(), 'table': commands[3],
+                'column': commands[5]}
+
+    # aggregate sum(salary),avg(salary) from company_employees_salaries by department
+    # aggregate approx avg(salary),count_distinct(id),p90(salary) from company_employees_salaries by department
+    # aggregate sum from employees by age (the README form, same as aggregate_p sum from employees by age)
+    elif command == 'aggregate':
+        if '(' not in commands[2 if commands[1].lower() == 'approx' else 1]:
+            return parse_query('aggregate_p' + query[len(command):])
+        approximate = commands[1].lower() == 'approx'
+        if approximate:
+            commands = commands[:1] + commands[2:]
+        group_by_column = commands[5] if len(commands) > 5 and commands[4].lower() == 'by' else None
+        plan = {'command': 'aggregate', 'aggregates': parse_aggregates(commands[1], approximate), 'table': commands[3],
+                'group_by': group_by_column}
+        if approximate:
+            plan['approx'] = True
+        return plan
+
+    # order employees by id asc limit 10
+    elif command in ('order', 'order_p'):
+        order = commands[4] if len(commands) > 4 and commands[4].lower() != 'limit' else 'asc'
+        limit = int(commands[commands.index('limit') + 1]) if 'limit' in commands else None
+        return {'command': command, 'table': commands[1], 'column': commands[3], 'order': order, 'limit': limit}
+
+    # join employees and salaries id print employees.name,salaries.salary
+    elif command == 'join':
+        selected_columns = None
+        if 'print' in commands:
+            print_columns = query.split(' print ')[1].strip().split(',')
+            selected_columns = [col.strip() for col in print_columns]  # List of 'table.column' strings
+        return {'command': 'join', 'tables': (commands[1], commands[3]), 'column': commands[4],
+                'selected': selected_columns}
+
+    # compact employees
+    elif command == 'compact':
+        return {'command': 'compact', 'table': commands[1]}
+
+    # rebalance employees
+    elif command == 'rebalance':
+        return {'command': 'rebalance', 'table': commands[1]}
+
+    # explain give name from table employees where age > 30 / profile ...
+    elif command in ('explain', 'profile') and len(commands) > 1:
+        return {'command': command, 'query': query.split(' ', 1)[1]}
+
+    # show cache
+    elif command == 'show' and commands[1].lower() == 'cache':
+        return {'command': 'show_cache'}
+
+    # show view salary_by_department
+    elif command == 'show' and commands[1].lower() == 'view':
+        return {'command': 'show_view', 'view': commands[2]}
+
+    # set workers 8 / set sort_memory 1048576 / set buffer_pool 67108864
+    elif command == 'set' and commands[1].lower() in ('workers', 'sort_memory', 'buffer_pool'):
+        return {'command': 'set', 'setting': commands[1].lower(), 'value': int(commands[2])}
+
+    # group age from employees where department = Sales print name age
+    elif command in ('group', 'group_p'):
+        condition = None
+        if 'where' in commands:
+            where_index = commands.index('where')
+            condition = parse_condition(' '.join(commands[where_index + 1:where_index + 4]))
+        return {'command': command, 'column': commands[1], 'table': commands[commands.index('from') + 1],
+                'print': commands[commands.index('print') + 1:], 'condition': condition}
+
+    # complex company_employee_details.company,company_employees_salaries.salary from table company_employee_details join company_employees_salaries where years_in_company > 5 order by salary asc
+    elif command == 'complex':
+        match = re.fullmatch(r"complex (\S+) from table (\S+) join (\S+)(?: on (\S+))?"
+                             r"(?: where (\S+ \S+ \S+))?(?: order by (\S+)(?: (asc|desc))?)?", query, re.I)
+        if not match:
+            raise ValueError("Expected complex <columns> from table <table> join <table> [on <column>] "
+                             "[where <condition>] [order by <column> [asc|desc]]")
+        columns, table1, table2, join_column, condition, order_column, order_direction = match.groups()
+        return {'command': 'complex', 'tables': (table1, table2), 'column': join_column or 'id',
+                'condition': parse_condition(condition) if condition else None, 'selected': columns.split(','),
+                'order_by': order_column, 'order': order_direction or 'asc'}
+    return None
+
+
+def get_plan(query):
+    with cache_lock:
+        plan = plan_cache.get(query)
+        if plan is not None:
+            plan_cache.move_to_end(query)
+            return plan
+    plan = parse_query(query)
+    if plan is not None and plan['command'] not in ('put', 'put_p'):
+        with cache_lock:
+            plan_cache[query] = plan
+            if len(plan_cache) > plan_cache_size:
+                plan_cache.popitem(last=False)  # Evict the least recently used plan
+    return plan
+
+
+def print_aggregates(results, aggregates, group_by_column):
+    print(','.join(([group_by_column] if group_by_column else []) + [f"{f}({c})" for f, c in aggregates]))
+    for key, values in results.items():
+        print(','.join(([key] if group_by_column else []) + [format_value(value) for value in values]))
+
+
+def print_groups(grouped_data):
+    for key, rows in grouped_data.items():
+        print(f"Group: {key}")
+        for row in rows:
+            print(', '.join([f"{col}: {row[col]}" for col in row]))
+
+
+def execute_plan(plan):
+    command = plan['command']
+    if command == 'new_index':
+        create_index(plan['table'], plan['column'])
+
+    elif command == 'new_view':
+        create_view(plan['view'], plan['table'], plan['aggregates'], plan['group_by'])
+
+    elif command == 'new_table':
+        if plan['format'] == 'columnar':
+            create_table_columnar(plan['table'], plan['headers'])
+        elif plan['format'] == 'fixed':
+            create_table_fixed(plan['table'], plan['headers'])
+        else:
+            create_table(plan['table'], plan['headers'], plan['codec'])
+
+    elif command == 'new_p_table':
+        create_table_partition(plan['table'], plan['headers'], plan['codec'], plan['partitioning'])
+
+    elif command in ('put', 'put_p'):
+        validate_row(plan['table'], plan['data'], partitioned=(command == 'put_p'))
+        if insert_data_buffered(plan['table'], plan['data'], partitioned=(command == 'put_p')):
+            print(f"Data inserted into {plan['table']}.")
+        else:
+            print(f"Data buffered for {plan['table']}.")
+
+    elif command == 'load':
+        loaded = load_data(plan['table'], plan['source'])
+        print(f"Loaded {loaded} rows into {plan['table']}.")
+
+    elif command == 'remove':
+        delete_data(plan['table'], plan['condition'])
+        print(f"Data deleted from {plan['table']}.")
+
+    elif command == 'remove_p':
+        delete_data_partition(plan['table'], plan['condition'])
+        print(f"Data deleted from {plan['table']}.")
+
+    elif command == 'renew':
+        update_data(plan['table'], plan['condition'], plan['updates'])
+        print(f"Data updated in {plan['table']}.")
+
+    elif command == 'renew_p':
+        update_data_partition(plan['table'], plan['condition'], plan['updates'])
+        print(f"Data updated in {plan['table']}.")
+
+    elif command == 'give':
+        query_data(f"{plan['table']}.csv", plan['columns'], plan['condition'])
+
+    elif command == 'give_p':
+        query_data_partition(plan['table'], plan['columns'], plan['condition'])
+
+    elif command == 'aggregate_p' and plan.get('approx'):
+        (value, bound), = approximate_aggregate(plan['table'], [(plan['function'], plan['column'])])[None]
+        print(f"Aggregate {plan['function']} (approximate): {approximate_value(value, bound)}")
+
+    elif command == 'aggregate_p':
+        result = aggregate_data(f"{plan['table']}.csv", plan['column'], plan['function'])
+        print(f"Aggregate {plan['function']}: {result}")
+
+    elif command == 'aggregate' and plan.get('approx'):
+        results = approximate_aggregate(plan['table'], plan['aggregates'], plan['group_by'])
+        print_aggregates({key: [approximate_value(value, bound) for value, bound in values]
+                          for key, values in results.items()}, plan['aggregates'], plan['group_by'])
+
+    elif command == 'aggregate':
+        print_aggregates(hash_aggregate(plan['table'], plan['aggregates'], plan['group_by']), plan['aggregates'],
+                         plan['group_by'])
+
+    elif command == 'show_view':
+        if not os.path.exists(view_file_name(plan['view'])):
+            print(f"View {plan['view']} does not exist.")
+            return
+        view = load_view(plan['view'])
+        aggregates = view['aggregates']
+        print_aggregates(finish_groups(view_groups(view), view['columns'], aggregates), aggregates, view['group_by'])
+
+    elif command == 'order':
+        order_data(plan['table'], plan['column'], plan['order'], plan['limit'])
+
+    elif command == 'order_p':
+        order_data_partition(plan['table'], plan['column'], plan['order'], plan['limit'])
+
+    elif command == 'join':
+        table_name1, table_name2 = plan['tables']
+        join_tables(f"{table_name1}.csv", f"{table_name2}.csv", plan['column'], plan['selected'])
+
+    elif command == 'compact':
+        compact_table(plan['table'])
+        print(f"Table {plan['table']} compacted.")
+
+    elif command == 'rebalance':
+        rebalance_table(plan['table'])
+
+    elif command == 'explain':
+        explain_query(plan['query'])
+
+    elif command == 'profile':
+        profile_query(plan['query'])
+
+    elif command == 'show_cache':
+        print(f"Result cache: {result_cache_stats['hits']} hits, {result_cache_stats['misses']} misses, "
+              f"{len(result_cache)} entries.")
+
+    elif command == 'set' and plan['setting'] == 'workers':
+        set_parallel_workers(plan['value'])
+        print(f"Using {parallel_workers} worker processes.")
+
+    elif command == 'set' and plan['setting'] == 'sort_memory':
+        set_sort_memory(plan['value'])
+        print(f"Sorting with {sort_memory_limit} bytes of memory.")
+
+    elif command == 'set' and plan['setting'] == 'buffer_pool':
+        set_buffer_pool(plan['value'])
+        print(f"Caching up to {buffer_pool_limit} bytes of table data.")
+
+    elif command == 'group':
+        print_groups(group_data(f"dbs/{plan['table']}.csv", plan['column'], plan['print'], plan['condition']))
+
+    elif command == 'group_p':
+        print_groups(group_data_partition(plan['table'], plan['column'], plan['print'], plan['condition']))
+
+    elif command == 'complex':
+        table_name1, table_name2 = plan['tables']
+        complex_query_execute(f"dbs/{table_name1}.csv", f"dbs/{table_name2}.csv", plan['column'],
+                              plan['condition'], plan['selected'], plan['order_by'], plan['order'])
+
+
+# Result cache
+# The printed output of read commands is kept per normalized query, together with the version of
+# every table the query reads. Each command that writes a table bumps that table's version, so a
+# cached result is served only while none of its tables has been written since. Versions count
+# the writes of this process only, files changed by other processes are not noticed. A result
+# streams out while the query runs, a copy is kept only while it is within result_cache_entry_limit.
+result_cache = OrderedDict()  # query -> (table versions, output)
+result_cache_size = int(os.environ.get('FILEDB_RESULT_CACHE', 128))
+result_cache_entry_limit = 1024 * 1024  # Larger outputs are not kept
+result_cache_stats = {'hits': 0, 'misses': 0}
+table_versions = defaultdict(int)
+cached_commands = ('give', 'give_p', 'aggregate', 'aggregate_p', 'order', 'order_p', 'group', 'group_p', 'join',
+                   'complex')
+write_commands = ('new_table', 'new_p_table', 'put', 'put_p', 'load', 'remove', 'remove_p', 'renew', 'renew_p',
+                  'rebalance')
+
+
+def plan_tables(plan):
+    return plan['tables'] if 'tables' in plan else (plan['table'],)
+
+
+class ResultTee:
+    # Passes the output of a query on as it is printed, keeping a copy for the result cache until the
+    # copy grows past limit characters, when the result is no longer kept
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+
+    def write(self, text):
+        if self.parts is not None:
+            self.size += len(text)
+            if self.size > self.limit:
+                self.parts = None
+            else:
+                self.parts.append(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def getvalue(self):
+        return None if self.parts is None else ''.join(self.parts)
+
+
+def cached_execute(query, plan):
+    with cache_lock:
+        # Read before the tables are, so a result never outlives a write it may have missed
+        versions = tuple(table_versions[table_name] for table_name in plan_tables(plan))
+        entry = result_cache.get(query)
+        if entry and entry[0] == versions:
+            result_cache.move_to_end(query)
+            result_cache_stats['hits'] += 1
+        else:
+            entry = None
+            result_cache_stats['misses'] += 1
+    if entry:
+        sys.stdout.write(entry[1])
+        return
+
+    output = ResultTee(sys.stdout.target() if isinstance(sys.stdout, ThreadOutput) else sys.stdout,
+                       result_cache_entry_limit)
+    with captured_output(output):
+        execute_plan(plan)
+    result = output.getvalue()
+    if result is not None:
+        with cache_lock:
+            result_cache[query] = (versions, result)
+            result_cache.move_to_end(query)
+            if len(result_cache) > result_cache_size:
+                result_cache.popitem(last=False)
+
+
+class ThreadOutput:
+    # Stands in for sys.stdout when several threads run queries: the prints of each thread go to
+    # the output registered for it, everything else to the real stdout
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, 'output', None) or self.stdout
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+
+@contextlib.contextmanager
+def captured_output(output):
+    # Sends the prints of the current thread to output
+    if not isinstance(sys.stdout, ThreadOutput):
+        with contextlib.redirect_stdout(output):
+            yield
+        return
+    previous = getattr(sys.stdout.local, 'output', None)
+    sys.stdout.local.output = output
+    try:
+        yield
+    finally:
+        sys.stdout.local.output = previous
 
-    # order employees by id asc
-    elif commands[0].lower() == 'order':
-        try:
-            table_name = commands[1]
-            column_index = commands[3]
-            order = commands[4] if len(commands) > 4 else 'asc'
-            order_data(f"{table_name}", column_index, order)
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
 
-        # order employees by id asc
-    elif commands[0].lower() == 'order_p':
+def parse_and_execute(query):
+    query = normalize_query(query)
+    stats = query_stats(query) if stats_log_file else None
+    with collecting_stats(stats):
+        execute_query(query)
+    if stats is not None:
+        log_stats(stats)
+
+
+def execute_query(query, use_result_cache=True):
+    try:
+        with stage('parse'):
+            plan = get_plan(query)
+    except Exception as e:
+        print(f"Error processing complex query: {e}")
+        return
+    if plan is None:
+        print("Invalid query")
+        return
+    if current_stats() is not None:
+        current_stats()['command'] = plan['command']
+
+    try:
+        if plan['command'] not in ('put', 'put_p'):
+            with stage('flush'):
+                flush_all_buffers()  # Every other command sees the rows put before it
+        with stage('execute'), pinned_partitions():
+            if plan['command'] in cached_commands and use_result_cache:
+                cached_execute(query, plan)
+            elif plan['command'] in write_commands or plan['command'] in ('new_index', 'new_view', 'compact'):
+                with table_write_lock(plan['table']):
+                    execute_plan(plan)
+            else:
+                execute_plan(plan)
+    except Exception as e:
+        print(f"Error processing complex query: {e}")
+    finally:
+        if plan['command'] in write_commands:
+            with cache_lock:
+                table_versions[plan['table']] += 1
+
+
+# Batch scripts
+# "python main.py -f script.fdb" (or "-f -" to read standard input) runs a script of queries, one
+# per line, without the prompt; blank lines and lines starting with # are skipped. The whole script
+# is parsed first. Consecutive put / put_p of a table are then committed with one write, and
+# consecutive remove / renew (or remove_p / renew_p) of a table with one pass over its data files.
+# A write to one table is held back past statements on other tables, but every statement touching
+# a table runs after the writes to it that come before it in the script, and statements without a
+# table (set, explain, show ...) wait for all of them, so each sees what it would have seen line by
+# line. The time of every statement, or of every batch of statements run together, goes to stderr.
+def write_batch_kind(plan):
+    # Writes of the same kind to the same table run together
+    if not isinstance(plan, dict):
+        return None
+    if plan['command'] in ('put', 'put_p'):
+        return plan['command']
+    if plan['command'] in ('remove', 'renew'):
+        return 'mutate'
+    if plan['command'] in ('remove_p', 'renew_p'):
+        return 'mutate_p'
+    return None
+
+
+def parse_script(lines):
+    # (line number, query, plan) per statement, the plan None or the error where the line does not parse
+    statements = []
+    for number, line in enumerate(lines, 1):
+        query = normalize_query(line)
+        if not query or query.startswith('#'):
+            continue
+        if query.lower() == 'exit':
+            break
         try:
-            table_name = commands[1]
-            column_index = commands[3]
-            order = commands[4] if len(commands) > 4 else 'asc'
-            order_data_partition(f"{table_name}", column_index, order)
+            plan = get_plan(query)
         except Exception as e:
-            print(f"Error processing complex query: {e}")
+            plan = e
+        statements.append((number, query, plan))
+    return statements
 
-    # join employees and salaries id and print employees.name
-    elif commands[0].lower() == 'join':
-        try:
-            file_name1 = commands[1]
-            file_name2 = commands[3]
-            join_column_name = commands[4]
-            selected_columns = None
-            if 'print' in query:
-                print_columns = query.split('print')[1].strip().split(',')
-                selected_columns = [col.strip() for col in print_columns]  # List of 'table.column' strings
-            join_tables(f"{file_name1}.csv", f"{file_name2}.csv", join_column_name, selected_columns)
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
 
-    elif commands[0].lower() == 'group':
-        try:
-            group_by_column = commands[1]
-            table_name_index = commands.index('from') + 1
-            table_name = commands[table_name_index]
-            print_columns_index = commands.index('print') + 1
-            print_columns = commands[print_columns_index:]
-
-            grouped_data = group_data(f"dbs/{table_name}.csv", group_by_column, print_columns)
-
-            for key, rows in grouped_data.items():
-                print(f"Group: {key}")
-                for row in rows:
-                    print(', '.join([f"{col}: {row[col]}" for col in row]))
-        except Exception as e:
-            print(f"Error processing complex query: {e}")
+def schedule_script(statements):
+    """
+    Groups the statements of a script into batches and orders them so that every statement still
+    runs after the writes it depends on.
 
-    # complex company_employee_details.company,company_employee_details.department,company_employees_salaries.salary from table company_employee_details join company_employees_salaries where years_in_company > 5 order by salary asc
-    elif commands[0].lower() == "complex":
-        try:
-            parts = query.split(' ', 4)  # Splitting only first four words to handle complex queries
-            selected_columns = parts[2].split(',')
-            table1, join_op, table2 = parts[4].split(' join ')
-            join_column = join_op.split(' ')[-1]
-            where_clause = ' '.join(parts[4].split(' where ')[1:])
-
-            # Check if 'order by' exists in the clause
-            if ' order by ' in where_clause:
-                condition_str, order_clause = where_clause.split(' order by ')
-                order_column, order_direction = order_clause.split(' ')
+    :param statements: List of (line number, query, plan) triples.
+    :return: List of batches, each a list of statements run together.
+    """
+    batches = []
+    open_batches = {}  # table -> writes still taking more statements of their kind
+
+    def close(table_name):
+        if table_name in open_batches:
+            batches.append(open_batches.pop(table_name))
+
+    for statement in statements:
+        plan = statement[2]
+        kind = write_batch_kind(plan)
+        if kind:
+            batch = open_batches.get(plan['table'])
+            if batch and write_batch_kind(batch[0][2]) == kind:
+                batch.append(statement)
+                continue
+            close(plan['table'])
+            open_batches[plan['table']] = [statement]
+            continue
+        has_tables = isinstance(plan, dict) and ('table' in plan or 'tables' in plan)
+        for table_name in plan_tables(plan) if has_tables else list(open_batches):
+            close(table_name)
+        batches.append([statement])
+    batches += open_batches.values()
+    return batches
+
+
+def run_batch(batch):
+    plan = batch[0][2]
+    kind = write_batch_kind(plan)
+    if kind is None:
+        execute_query(batch[0][1])
+        return
+    table_name = plan['table']
+    plans = [plan for _, _, plan in batch]
+    try:
+        with table_write_lock(table_name):
+            if kind in ('put', 'put_p'):
+                rows = []
+                for plan in plans:
+                    try:
+                        validate_row(table_name, plan['data'], partitioned=(kind == 'put_p'))
+                    except ValueError as e:
+                        print(f"Error processing complex query: {e}")  # Rejected when run on its own too
+                        continue
+                    rows.append(plan['data'])
+                inserted = commit_rows(table_name, rows, partitioned=(kind == 'put_p')) if rows else 0
+                print(f"Data inserted into {table_name} ({inserted} rows).")
+            elif kind == 'mutate' and (is_columnar(table_name) or is_fixed_width(table_name)):
+                for _, query, _ in batch:
+                    execute_query(query)  # Their files are changed in place, statement by statement
             else:
-                condition_str = where_clause
-                order_column, order_direction = None, None
-
-            # Debug prints
-            print("Condition String:", condition_str)
-            print("Order Column:", order_column)
-            print("Order Direction:", order_direction)
-
-            # Correcting file paths
-            file1 = f"dbs/{table1}.csv"
-            file2 = f"dbs/{table2}.csv"
-
-            # Parsing condition string
-            condition_column, operator, condition_value = condition_str.split(' ')
-            condition = (condition_column.strip(), operator.strip(), condition_value.strip())
+                header = read_header(f"dbs/{table_name}.csv" if kind == 'mutate' else table_data_files(table_name)[0])
+                statements = []
+                for plan in plans:
+                    try:
+                        compile_condition(header, plan['condition'])
+                        for col_name, _ in plan.get('updates') or []:
+                            header.index(col_name)
+                    except ValueError as e:
+                        print(f"Error processing complex query: {e}")  # Had no effect when run on its own either
+                        continue
+                    statements.append((plan['condition'], plan.get('updates')))
+                deleted, updated = mutate_data(table_name, statements, partitioned=(kind == 'mutate_p'))
+                print(f"Data changed in {table_name} ({len(plans)} statements, {deleted} rows deleted, "
+                      f"{updated} rows updated).")
+    except Exception as e:
+        print(f"Error processing complex query: {e}")
+    finally:
+        with cache_lock:
+            table_versions[table_name] += 1
+
+
+def run_script(lines):
+    """
+    Runs a script of queries in batches, reporting the time of every batch on stderr.
 
-            complex_query_execute(file1, file2, join_column, condition, selected_columns, order_column, order_direction)
-        except ValueError as e:
-            print(f"Error processing complex query: {e}")
-    else:
-        print("Invalid query")
+    :param lines: Lines of the script.
+    """
+    flush_all_buffers()
+    started = time.perf_counter()
+    statements = parse_script(lines)
+    batches = schedule_script(statements)
+    print(f"Parsed {len(statements)} statements into {len(batches)} batches in "
+          f"{time.perf_counter() - started:.3f} s", file=sys.stderr)
+    for batch in batches:
+        start = time.perf_counter()
+        run_batch(batch)
+        sys.stdout.flush()
+        seconds = time.perf_counter() - start
+        if len(batch) == 1:
+            print(f"line {batch[0][0]}: {seconds:.4f} s  {batch[0][1]}", file=sys.stderr)
+        else:
+            commands = '/'.join(dict.fromkeys(plan['command'] for _, _, plan in batch))
+            print(f"lines {batch[0][0]}-{batch[-1][0]}: {seconds:.4f} s  {len(batch)} x {commands} "
+                  f"{batch[0][2]['table']}", file=sys.stderr)
+    print(f"Ran {len(statements)} statements in {time.perf_counter() - started:.3f} s", file=sys.stderr)
 
 
 class FileDBCLI(cmd.Cmd):
@@ -682,6 +4455,8 @@ class FileDBCLI(cmd.Cmd):
     def do_exit(self, inp):
         '''Exit the application.'''
         print("Exiting...")
+        flush_all_buffers()
+        shutdown_worker_pool()
         return True
 
     def default(self, inp):
@@ -691,4 +4466,13 @@ class FileDBCLI(cmd.Cmd):
 
 
 if __name__ == '__main__':
-    FileDBCLI().cmdloop()
+    atexit.register(flush_all_buffers)  # Also when the session ends without "exit"
+    if len(sys.argv) == 3 and sys.argv[1] == '-f':
+        # python main.py -f script.fdb, or -f - for a script on stdin
+        script = sys.stdin if sys.argv[2] == '-' else open(sys.argv[2], 'r')
+        lines = script.read().splitlines()
+        script.close()
+        run_script(lines)
+        shutdown_worker_pool()
+    else:
+        FileDBCLI().cmdloop()
@@ -0,0 +1,109 @@
+import os
+import sys
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+# FileDB network server
+# Clients send one query per line, in the same language as the CLI. The server answers with the
+# lines the query prints, streamed back in batches while the query runs, followed by a line holding
+# only END_OF_RESULT. Queries run on a pool of engine threads, so the event loop keeps serving the
+# other connections while files are read and written. Readers run side by side on snapshots, writers
+# of the same table take turns (see "Concurrency control" in main.py).
+END_OF_RESULT = '\0'
+batch_size = int(os.environ.get('FILEDB_SERVER_BATCH', 64 * 1024))  # Bytes of output per message
+engine = ThreadPoolExecutor(max_workers=int(os.environ.get('FILEDB_SERVER_THREADS', 8)),
+                            thread_name_prefix='filedb-engine')
+
+
+class ResultStream:
+    # Collects the output of one query and hands it to the event loop in batches of batch_size bytes
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= batch_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, ''.join(self.pending))
+            self.pending, self.pending_size = [], 0
+
+    def close(self):
+        self.flush()
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+
+def run_query(query, stream):
+    try:
+        with main.captured_output(stream):
+            main.parse_and_execute(query)
+    finally:
+        stream.close()
+
+
+async def handle_client(reader, writer):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            query = line.decode().strip()
+            if not query:
+                continue
+            if query.lower() == 'exit':
+                break
+
+            queue = asyncio.Queue()
+            loop.run_in_executor(engine, run_query, query, ResultStream(loop, queue))
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                writer.write(batch.encode())
+                await writer.drain()
+            writer.write(f"{END_OF_RESULT}\n".encode())
+            await writer.drain()
+    except ConnectionError:
+        pass  # The client went away, a query it started still runs to the end
+    finally:
+        writer.close()
+
+
+def shutdown_engine():
+    # Commit the rows still buffered by put / put_p before the process ends
+    engine.shutdown()
+    main.flush_all_buffers()
+    main.shutdown_worker_pool()
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(handle_client, host, port)
+    print(f"FileDB listening on {', '.join(str(s.getsockname()) for s in server.sockets)}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve FileDB queries over TCP.')
+    parser.add_argument('--host', default=os.environ.get('FILEDB_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('FILEDB_PORT', 5511)))
+    arguments = parser.parse_args()
+
+    sys.stdout = main.ThreadOutput(sys.stdout)
+    try:
+        asyncio.run(serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_engine()
@@ -0,0 +1,33 @@
+import io
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def run(query):
+    # Runs one query and returns the lines it printed
+    output = io.StringIO()
+    with main.captured_output(output):
+        main.parse_and_execute(query)
+    return output.getvalue().splitlines()
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # An empty dbs/ directory in a fresh working directory, with the in-memory caches cleared
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('dbs')
+    for cache in (main.index_cache, main.mutation_log_cache, main.table_codecs, main.block_index_cache,
+                  main.buffer_pool, main.sketch_cache, main.plan_cache, main.result_cache,
+                  main.data_buffers, main.row_shapes):
+        cache.clear()
+    monkeypatch.setattr(main, 'buffer_pool_bytes', 0)
+    monkeypatch.setattr(main, 'result_cache_size', 0)
+    yield run
+    main.flush_all_buffers()
+    main.shutdown_worker_pool()  # Its workers run in this test's directory
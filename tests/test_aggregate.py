@@ -0,0 +1,9 @@
+import main
+
+
+def test_readme_form_aggregates_the_by_column(db):
+    db("new table employees id name age")
+    main.commit_rows('employees', [f"{i},n{i},{20 + i % 10}" for i in range(100)])
+    assert db("aggregate sum from employees by age") == db("aggregate_p sum from employees by age")
+    assert db("aggregate avg from employees by age") == [f"Aggregate avg: {24.5}"]
+    assert db("aggregate sum(age) from employees")[-1].endswith('2450.0')
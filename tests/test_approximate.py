@@ -0,0 +1,56 @@
+import random
+import statistics
+
+import pytest
+
+import main
+
+
+def make_table(db, rows=30000):
+    rng = random.Random(7)
+    db("new_p table t id dept salary partition by hash id count 2")
+    model = [(f"d{i % 10}", rng.randint(1000, 9000)) for i in range(rows)]
+    main.commit_rows('t', [f"{i},{dept},{salary}" for i, (dept, salary) in enumerate(model)], True)
+    return model
+
+
+def exact(salaries):
+    ordered = sorted(salaries)
+    return {'sum': sum(salaries), 'avg': sum(salaries) / len(salaries), 'count': len(salaries),
+            'count_distinct': len(set(salaries)), 'median': statistics.median(salaries),
+            'p90': ordered[int(0.9 * (len(ordered) - 1))]}
+
+
+def estimates(lines, functions):
+    # {group: {function: (value, bound)}} from the lines of an approximate aggregate
+    assert lines[0] == 'dept,' + ','.join(f"{function}(salary)" for function in functions)
+    results = {}
+    for line in lines[1:]:
+        group, *values = line.split(',')
+        results[group] = {function: (float(value.split('±')[0]), float(value.split('±')[1]) if '±' in value else 0.0)
+                          for function, value in zip(functions, values)}
+    return results
+
+
+def test_error_bounds_contain_the_exact_values(db):
+    model = make_table(db)  # Partitions larger than sample_size, set for the workers too
+    functions = ['sum', 'avg', 'count', 'count_distinct', 'median', 'p90']
+    lines = db("aggregate approx " + ','.join(f"{function}(salary)" for function in functions) + " from t by dept")
+    results = estimates(lines, functions)
+    assert sorted(results) == [f"d{i}" for i in range(10)]
+    errors = []
+    for group, estimated in results.items():
+        expected = exact([salary for dept, salary in model if dept == group])
+        for function, (value, bound) in estimated.items():
+            assert 0 < bound < 0.05 * expected[function], function  # Sampled, not read whole
+            errors.append(abs(value - expected[function]) / bound)
+    # The bounds are 95% confidence intervals, about one exact value in twenty lies outside its interval
+    assert sum(error <= 1 for error in errors) >= 0.9 * len(errors) and max(errors) <= 1.5, errors
+
+
+def test_files_smaller_than_the_sample_are_exact(db):
+    model = make_table(db, rows=300)
+    lines = db("aggregate approx sum(salary),avg(salary) from t by dept")
+    for group, estimated in estimates(lines, ['sum', 'avg']).items():
+        expected = exact([salary for dept, salary in model if dept == group])
+        assert estimated['sum'] == (expected['sum'], 0) and estimated['avg'] == (pytest.approx(expected['avg']), 0)
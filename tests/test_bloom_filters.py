@@ -0,0 +1,83 @@
+import io
+import json
+
+import main
+
+
+def make_table(db):
+    db("new_p table t id company age")
+    main.commit_rows('t', [f"{i},c{i % 50},{20 + i % 40}" for i in range(5000)], True)
+
+
+def run_counted(db, query):
+    stats, output = main.query_stats(query), io.StringIO()
+    with main.collecting_stats(stats), main.captured_output(output):
+        main.execute_query(query)
+    return output.getvalue().splitlines(), stats['counters']
+
+
+def test_filters_cover_every_column(db):
+    make_table(db)
+    with open(main.bloom_file_name('dbs/t_part_0.csv'), 'rb') as file:
+        assert json.loads(file.readline())['columns'] == ['id', 'company', 'age']
+
+
+def test_text_equality_without_an_index_skips_partitions(db):
+    make_table(db)
+    main.commit_rows('t', ["5000,zeta,30"], True)
+    lines, counters = run_counted(db, "give_p id from table t where company = zeta")
+    assert lines == ['5000'] and counters['partitions_skipped_by_bloom_filters'] == 5
+    lines, _ = run_counted(db, "give_p id,age from table t where company = c7")
+    assert sorted(lines, key=lambda line: int(line.split(',')[0])) == [f"{i},{20 + i % 40}" for i in range(7, 5000, 50)]
+    db("remove_p of t where company = c7")
+    assert db("give_p id from table t where company = c7") == []
+    assert db("give_p id from table t where id = abc") == []
+
+
+def test_text_equality_on_a_plain_table(db):
+    db("new table s id company age")
+    main.commit_rows('s', ["1,google,30", "2,acme,40", "3,google,50"])
+    assert db("give company,age from table s where company = google") == ['google,30', 'google,50']
+    db("renew s put age=31 where company = google")
+    assert db("give id,age from table s where company = google") == ['1,31', '3,31']
+    assert db("give id from table s where company > google") == [
+        "Error processing complex query: Operator > needs a number, got google"]
+
+
+def test_equality_lookups_skip_partitions_without_false_negatives(db):
+    make_table(db)
+    db("new index on t company")
+    main.commit_rows('t', ["5000,zeta,30"], True)
+    for i in range(0, 5001, 7):
+        lines, counters = run_counted(db, f"give_p id from table t where id = {i}")
+        assert lines == [str(i)]
+    db("new index on t age")
+    lines, counters = run_counted(db, "give_p id from table t where age = 30.5")  # Within every zone map
+    assert lines == [] and counters['partitions_skipped_by_bloom_filters'] == 5
+    lines, _ = run_counted(db, "give_p id from table t where age = 3e1")
+    assert sorted(map(int, lines)) == [i for i in range(5001) if (20 + i % 40 if i < 5000 else 30) == 30]
+
+    lines, counters = run_counted(db, "give_p id from table t where company = zeta")
+    assert lines == ['5000'] and counters['partitions_skipped_by_bloom_filters'] == 5
+    lines, _ = run_counted(db, "give_p id from table t where company = c7")
+    assert sorted(map(int, lines)) == list(range(7, 5000, 50))
+
+
+def test_renewed_values_are_found(db):
+    make_table(db)
+    db("renew_p t put id=99999 where id = 1234")
+    assert db("give_p id,company from table t where id = 99999") == ['99999,c34']
+
+
+def test_filters_of_other_hashes_are_not_trusted(db):
+    make_table(db)
+    file_name = main.bloom_file_name('dbs/t_part_0.csv')
+    with open(file_name, 'rb') as file:
+        meta = json.loads(file.readline())
+        filters = file.read()
+    meta.pop('version')
+    with open(file_name, 'wb') as file:
+        file.write(json.dumps(meta).encode() + b'\n' + bytes(len(filters)))  # No bits set
+    assert db("give_p id from table t where id = 10") == ['10']
+    main.commit_rows("t", ["500,c0,20"], True)
+    assert main.has_bloom_filter('dbs/t_part_0.csv') or not main.os.path.exists(file_name)
@@ -0,0 +1,61 @@
+import main
+
+
+def make_table(db, rows=500):
+    db("new table t id name age")
+    for i in range(rows):
+        db(f"put t {i} name{i % 13} {20 + i % 40}")
+    main.flush_all_buffers()
+
+
+def test_pool_charges_the_memory_of_the_rows(db):
+    make_table(db)
+    rows = main.pooled_rows('dbs/t.csv')
+    assert main.buffer_pool_bytes >= sum(map(main.row_memory, rows))
+    assert main.buffer_pool_bytes > main.os.path.getsize('dbs/t.csv')
+
+
+def test_file_larger_than_the_pool_in_memory_is_streamed(db, monkeypatch):
+    make_table(db)
+    monkeypatch.setattr(main, 'buffer_pool_limit', main.os.path.getsize('dbs/t.csv') + 1)
+    rows = list(main.pooled_rows('dbs/t.csv'))
+    assert len(rows) == 500
+    assert not main.buffer_pool and main.buffer_pool_bytes == 0
+
+
+def test_sort_join_and_aggregate_do_not_load_the_pool(db):
+    make_table(db)
+    assert db("order t by age desc limit 1")[-1].endswith(',59')
+    db("aggregate sum(age) from t by name")
+    db("join t and t id")
+    assert not main.buffer_pool
+
+
+def test_byte_scan_matches_the_pool_scan(db):
+    make_table(db)
+    db("remove of t where age = 30")
+    db("renew t put name=renewed,age=31 where id < 50")
+    queries = ["give id,name from table t where age = 31", "give name from table t where age > 50",
+               "give id,age from table t where age != 25", "give id from table t where age <= 21"]
+    scanned = [db(query) for query in queries]
+    for _ in range(2):
+        assert "  dbs/t.csv: byte scan, 62 logged mutations merged" in db("explain give id from table t where age = 31")
+        assert [db(query) for query in queries] == scanned  # Repeated reads keep scanning the bytes
+    assert not main.buffer_pool
+    main.pooled_rows('dbs/t.csv')  # Loaded by another command
+    assert "  dbs/t.csv: full scan from the buffer pool, 62 logged mutations merged" in db(
+        "explain give id from table t where age = 31")
+    assert [db(query) for query in queries] == scanned
+    assert all(scanned)
+
+
+def test_lazy_reads_scan_the_bytes_a_row_at_a_time(db):
+    make_table(db)
+    stats = main.query_stats("give id from table t where age = 31")
+    with main.collecting_stats(stats):
+        rows = main.query_data_lazy('t.csv', ['id', 'name'], ('age', '=', '31'))
+        assert next(rows) == '11,name11'
+        assert 'rows_decoded' not in stats['counters']  # Counted once the scan ends
+        assert list(rows) == [f"{i},name{i % 13}" for i in range(51, 500, 40)]
+    assert stats['counters']['rows_decoded'] == 13 and stats['counters']['rows_scanned'] == 500
+    assert not main.buffer_pool
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+import main
+
+
+def rows_of(db, give):
+    return sorted(db(f"{give} id,name,age from table t where id >= 0"), key=lambda line: int(line.split(',')[0]))
+
+
+def expected_rows(model):
+    return [f"{i},{name},{age}" for i, (name, age) in sorted(model.items())]
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+@pytest.mark.parametrize('create, partitioned', [
+    ("new table t id name age using {}", False),
+    ("new_p table t id name age partition by hash id count 3 size 400 using {}", True),
+])
+def test_compressed_table_round_trip(db, monkeypatch, codec, create, partitioned):
+    monkeypatch.setattr(main, 'block_size', 1024)  # Several blocks per file
+    suffix = '_p' if partitioned else ''
+    db(create.format(codec))
+    model = {i: [f"company{i % 7}", str(20 + i % 40)] for i in range(900)}
+    main.commit_rows('t', [f"{i},{name},{age}" for i, (name, age) in model.items()], partitioned)
+    for data_file in main.table_data_files('t'):
+        with open(data_file, 'rb') as file:
+            file.readline()
+            assert b'company' not in file.read()  # Only the header is plain text
+    assert rows_of(db, f"give{suffix}") == expected_rows(model)
+
+    db(f"put{suffix} t 900 late 33")
+    main.flush_all_buffers()
+    model[900] = ['late', '33']
+    db(f"remove{suffix} of t where age = 30")
+    db(f"renew{suffix} t put name=renewed,age=31 where id < 50")
+    model = {i: (['renewed', '31'] if i < 50 else row) for i, row in model.items() if row[1] != '30'}
+    assert rows_of(db, f"give{suffix}") == expected_rows(model)
+    assert db(f"give{suffix} name from table t where id = 77") == [model[77][0]]  # Decompresses one block
+
+    db("compact t")
+    assert not any(os.path.exists(main.log_file_name(data_file)) for data_file in main.table_data_files('t'))
+    assert rows_of(db, f"give{suffix}") == expected_rows(model)
+    assert sorted(map(int, db(f"give{suffix} id from table t where name = renewed"))) == \
+        [i for i, (name, _) in sorted(model.items()) if name == 'renewed']
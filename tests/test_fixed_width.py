@@ -0,0 +1,45 @@
+import os
+
+import main
+
+
+def make_table(db):
+    db("new table t id:int name:str8 salary:float")
+    main.commit_rows('t', [f"{i},n{i % 5},{(i - 10) * 1.5}" for i in range(40)])
+
+
+def record_at(number):
+    schema, header_size, record = main.read_fixed_schema('t')
+    with open(main.fixed_file('t'), 'rb') as file:
+        file.seek(header_size + number * record.size)
+        return record.unpack(file.read(record.size))
+
+
+def test_renew_and_remove_change_records_in_place(db):
+    make_table(db)
+    size, inode = os.path.getsize(main.fixed_file('t')), os.stat(main.fixed_file('t')).st_ino
+    db("renew t put name=renewed,salary=-0.5 where id = 7")
+    db("remove of t where name = n3")
+    assert os.path.getsize(main.fixed_file('t')) == size and os.stat(main.fixed_file('t')).st_ino == inode
+    assert record_at(7) == (True, 7, b'renewed\0', -0.5)
+    assert record_at(8) == (False, 8, b'n3\0\0\0\0\0\0', -3.0)  # Only the live flag is cleared
+    assert db("give name,salary from table t where id = 7") == ['renewed,-0.5']
+    assert sorted(map(int, db("give id from table t where salary < 0"))) == \
+        [i for i in range(10) if i % 5 != 3]
+
+
+def test_compact_drops_removed_records(db):
+    make_table(db)
+    db("remove of t where name = n3")
+    _, header_size, record = main.read_fixed_schema('t')
+    db("compact t")
+    assert os.path.getsize(main.fixed_file('t')) == header_size + 32 * record.size
+    assert sorted(map(int, db("give id from table t where id >= 0"))) == [i for i in range(40) if i % 5 != 3]
+    assert record_at(3) == (True, 4, b'n4\0\0\0\0\0\0', -9.0)
+
+
+def test_order_compares_native_values(db):
+    make_table(db)
+    lines = db("order t by salary asc limit 3")
+    assert lines[-3:] == ['0,n0,-15.0', '1,n1,-13.5', '2,n2,-12.0']  # Negative numbers in numeric order
+    assert db("put t 99 toolongname 1.0")[0].startswith("Error")
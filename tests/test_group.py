@@ -0,0 +1,16 @@
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize('command', ['group', 'group_p'])
+def test_group_honors_where(db, command):
+    if command == 'group_p':
+        db("new_p table emp id name age partition by range id size 50")
+        main.commit_rows('emp', [f"{i},n{i},{20 + i % 10}" for i in range(300)], True)
+    else:
+        db("new table emp id name age")
+        main.commit_rows('emp', [f"{i},n{i},{20 + i % 10}" for i in range(300)])
+    lines = db(f"{command} age from emp where age = 25 print name")
+    assert [line for line in lines if line.startswith('Group:')] == ['Group: 25']
+    assert sorted(lines[1:]) == sorted(f"name: n{i}" for i in range(300) if i % 10 == 5)
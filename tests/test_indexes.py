@@ -0,0 +1,69 @@
+import random
+
+import main
+
+
+def load_rows(db, rows):
+    db("new table t id name age")
+    for row in rows:
+        db(f"put t {' '.join(map(str, row))}")
+    main.flush_all_buffers()
+
+
+def give(db, condition):
+    return sorted(db(f"give id,name,age from table t where {condition}"))
+
+
+def expected(rows, predicate):
+    return sorted(','.join(map(str, row)) for row in rows if predicate(row))
+
+
+def test_lookup_matches_rows_after_puts_and_removes(db):
+    rng = random.Random(1)
+    rows = [[i, f"n{rng.randint(0, 9)}", rng.randint(18, 70)] for i in range(300)]
+    load_rows(db, rows)
+    assert give(db, "id = 150") == expected(rows, lambda row: row[0] == 150)
+
+    new_rows = [[i, 'late', 40] for i in range(1000, 1000 + main.index_insert_limit + 50)]
+    for row in new_rows[:5]:  # Merged into the loaded index one by one
+        db(f"put t {' '.join(map(str, row))}")
+        main.flush_all_buffers()
+        assert give(db, f"id = {row[0]}") == [','.join(map(str, row))]
+    for row in new_rows[5:]:  # More than index_insert_limit new entries, merged in one pass
+        db(f"put t {' '.join(map(str, row))}")
+    main.flush_all_buffers()
+    rows += new_rows
+    for condition, predicate in (("id >= 1040", lambda row: row[0] >= 1040),
+                                 ("id < 20", lambda row: row[0] < 20),
+                                 ("id = 1500", lambda row: row[0] == 1500)):
+        assert give(db, condition) == expected(rows, predicate)
+
+    db("remove of t where id < 100")
+    db("renew t put id=5000 where id = 200")
+    rows = [[5000, *row[1:]] if row[0] == 200 else row for row in rows if row[0] >= 100]
+    for condition, predicate in (("id < 150", lambda row: row[0] < 150),
+                                 ("id = 5000", lambda row: row[0] == 5000),
+                                 ("id = 200", lambda row: row[0] == 200)):
+        assert give(db, condition) == expected(rows, predicate)
+
+    db("compact t")
+    main.index_cache.clear()  # Loaded again from the sidecar
+    assert give(db, "id >= 0") == expected(rows, lambda row: True)
+
+
+def test_secondary_index_matches_rows(db):
+    rows = [[i, f"n{i % 7}", 20 + i % 30] for i in range(200)]
+    load_rows(db, rows)
+    db("new index on t age")
+    db("put t 500 extra 33")
+    main.flush_all_buffers()
+    rows.append([500, 'extra', 33])
+    assert give(db, "age = 33") == expected(rows, lambda row: row[2] == 33)
+    assert give(db, "age > 45") == expected(rows, lambda row: row[2] > 45)
+
+
+def test_index_in_the_text_format_is_rebuilt(db):
+    load_rows(db, [[i, 'a', i] for i in range(10)])
+    with open('dbs/t.id.idx', 'w') as file:
+        file.write('float\n' + ''.join(f"{float(i)!r},0\n" for i in range(10)))
+    assert give(db, "id = 4") == ['4,a,4']
@@ -0,0 +1,81 @@
+import os
+import random
+import tracemalloc
+
+import pytest
+
+import main
+
+
+def load(db, table_name, header, rows, partitioned=False):
+    if partitioned:
+        db(f"new_p table {table_name} {' '.join(header)} partition by hash {header[0]} size 100")
+    else:
+        db(f"new table {table_name} {' '.join(header)}")
+    main.commit_rows(table_name, [','.join(row) for row in rows], partitioned)
+
+
+def nested_loop_join(left, right, left_key, right_key):
+    # Keys are compared as numbers, so 7 and 7.0 match
+    return sorted(','.join(a + b) for a in left for b in right if float(a[left_key]) == float(b[right_key]))
+
+
+def make_tables(db, sort=False, partitioned=False):
+    rng = random.Random(7)
+    left = [[rng.choice(['{}', '{}.0']).format(rng.randrange(300)), f"l{i}", str(rng.randrange(50))]
+            for i in range(600)]
+    right = [[str(rng.randrange(0, 400, 3)), f"r{i}"] for i in range(400)]  # Duplicates, and keys with no match
+    if sort:
+        left.sort(key=lambda row: float(row[0]))
+        right.sort(key=lambda row: float(row[0]))
+    load(db, 'a', ['id', 'name', 'age'], left, partitioned)  # Probed with the keys of b
+    load(db, 'b', ['id', 'tag'], right)
+    return left, right
+
+
+@pytest.mark.parametrize('memory', [64 * 1024 * 1024, 256])
+def test_hash_join_matches_nested_loop(db, monkeypatch, memory):
+    monkeypatch.setattr(main, 'join_memory_limit', memory)  # 256 bytes spills the grace join buckets
+    left, right = make_tables(db)
+    assert main.join_strategy('a', 'b', 'id') == 'hash'
+    assert sorted(db("join a and b id")) == nested_loop_join(left, right, 0, 0)
+
+
+def test_merge_join_matches_nested_loop(db):
+    left, right = make_tables(db, sort=True)
+    db("new index on a id")
+    db("new index on b id")
+    assert main.join_strategy('a', 'b', 'id') == 'merge'
+    assert sorted(db("join a and b id")) == nested_loop_join(left, right, 0, 0)
+
+
+def test_join_of_a_partitioned_table_matches_nested_loop(db):
+    left, right = make_tables(db, partitioned=True)
+    assert len(main.partition_files('a')) > 1
+    assert sorted(db("join a and b id")) == nested_loop_join(left, right, 0, 0)
+
+
+def test_complex_matches_nested_loop(db):
+    left, right = make_tables(db)
+    expected = [(float(a[2]), f"{a[1]}, {b[1]}") for a in left for b in right
+                if float(a[0]) == float(b[0]) and int(a[2]) > 25]
+    lines = db("complex a.name,b.tag from table a join b where age > 25 order by age desc")
+    assert sorted(lines) == sorted(line for _, line in expected)
+    ages = {row[1]: float(row[2]) for row in left}
+    assert [ages[line.split(', ')[0]] for line in lines] == sorted((age for age, _ in expected), reverse=True)
+
+
+def test_hash_join_stays_within_its_memory_budget(db, monkeypatch):
+    db("new table t id v name")
+    main.commit_rows('t', [f"{i},{(i * 7919) % 10007},name{i}" for i in range(30000)])
+    budget = 256 * 1024
+    monkeypatch.setattr(main, 'join_memory_limit', budget)
+    monkeypatch.setattr(main, 'buffer_pool_limit', 0)
+    with open(os.devnull, 'w') as discard, main.captured_output(discard):
+        tracemalloc.start()
+        try:
+            main.execute_query("join t and t v", use_result_cache=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert peak < 3 * budget
@@ -0,0 +1,70 @@
+import sys
+import threading
+
+import pytest
+
+import main
+
+
+def make_table(db, method, rows=1500):
+    db(f"new_p table t id v partition by {method} id size 200")
+    main.commit_rows('t', [f"{i},{i % 97}" for i in range(rows)], True)
+
+
+def ids(db):
+    return sorted(int(line) for line in db("give_p id from table t where v >= 0"))
+
+
+@pytest.mark.parametrize('method', ['range', 'hash'])
+def test_splits_keep_every_row(db, method):
+    make_table(db, method)
+    assert len(main.partition_files('t')) > 1
+    assert ids(db) == list(range(1500))
+    assert set(main.list_partition_files('t')) == set(main.partition_files('t'))
+
+
+@pytest.mark.parametrize('method', ['range', 'hash'])
+def test_rebalance_keeps_rows_for_concurrent_readers(db, method, monkeypatch):
+    monkeypatch.setattr(sys, 'stdout', main.ThreadOutput(sys.stdout))  # As in server.py
+    make_table(db, method)
+    counts, done = [], threading.Event()
+
+    def read():
+        while not done.is_set():
+            counts.append(len(db("give_p id from table t where v >= 0")))
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for _ in range(10):
+        db("rebalance t")
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert counts and set(counts) == {1500}
+    assert ids(db) == list(range(1500))
+    assert not main.retired_files and not main.pinned_epochs
+    assert set(main.list_partition_files('t')) == set(main.partition_files('t'))
+
+
+def test_negative_ids_get_their_own_partition(db):
+    db("new_p table t id name")  # Partitioned on id ranges of 1000
+    db("put_p t -3 x")
+    db("put_p t 5 y")
+    assert sorted(db("give_p id,name from table t where id < 10")) == ['-3,x', '5,y']
+    assert main.partition_files('t') == ['dbs/t_part_-1.csv', 'dbs/t_part_0.csv']
+    assert main.list_partition_files('t') == main.partition_files('t')
+    assert main.table_name_of('dbs/t_part_-1.csv') == 't'
+
+
+def test_range_partitions_on_a_text_column(db):
+    db("new_p table t id name partition by range name size 50")
+    names = [f"n{i % 120}" for i in range(300)] + [str(i) for i in range(0, 60, 2)]  # Text and numbers
+    for i, name in enumerate(names):
+        assert db(f"put_p t {i} {name}") in (["Data buffered for t."], ["Data inserted into t."])
+    main.flush_all_buffers()
+    assert len(main.partition_files('t')) > 1
+    assert sorted(db("give_p id from table t where name = n7"), key=int) == ['7', '127', '247']
+    db("rebalance t")
+    assert sorted(db("give_p name from table t where id >= 0")) == sorted(names)
+    assert sorted(db("give_p id from table t where name = n100"), key=int) == ['100', '220']
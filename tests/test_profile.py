@@ -0,0 +1,21 @@
+import main
+
+
+def test_reads_are_timed_without_tracing(db, monkeypatch):
+    db("new table t id name age")
+    main.commit_rows('t', [f"{i},n{i},{20 + i % 10}" for i in range(100)])
+    tracing = []
+    execute_query = main.execute_query
+    monkeypatch.setattr(main, 'execute_query', lambda *args, **kwargs: (
+        tracing.append(main.tracemalloc.is_tracing()), execute_query(*args, **kwargs)))
+
+    lines = db("profile give id from table t where age = 25")
+    assert tracing == [False, False, True]  # The profile command, the timed run, the traced run
+    assert lines[:10] == [str(i) for i in range(5, 100, 10)] and lines[10] == "Profile of give:"
+    assert "  rows returned: 10" in lines and int(lines[-1].split()[2]) > 0
+
+    tracing.clear()
+    lines = db("profile remove of t where age = 25")
+    assert tracing == [False, True]  # A write runs once
+    assert "Profile of remove, including tracemalloc overhead:" in lines
+    assert db("give id from table t where age = 25") == []
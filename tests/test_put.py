@@ -0,0 +1,58 @@
+import io
+
+import pytest
+
+import main
+
+
+def run_script(lines):
+    output = io.StringIO()
+    with main.captured_output(output):
+        main.run_script(lines)
+    return output.getvalue().splitlines()
+
+
+@pytest.mark.parametrize('table, put, give, bad_row', [
+    ('new table t id name age', 'put', 'give', '3 c'),
+    ('new_p table t id name age partition by range id size 50', 'put_p', 'give_p', '3 c 31 x'),
+    ('new table t id:int name age:int using columnar', 'put', 'give', '3 c x'),
+])
+def test_put_rejects_bad_rows_when_run(db, table, put, give, bad_row):
+    db(table)
+    assert db(f"{put} t 1 a 30") == ["Data buffered for t."]
+    assert db(f"{put} t 2 b")[0].startswith("Error")
+    assert db(f"{put} t {bad_row}")[0].startswith("Error")
+    assert db(f"{give} id from table t where id >= 0") == ['1']  # The flush reports nothing
+
+
+def test_batch_counts_committed_rows(db):
+    db("new table t id name age")
+    lines = run_script(["put t 1 a 30", "put t 2 b", "put t 3 c 32"])
+    assert lines == ["Error processing complex query: Expected 3 values, got 2", "Data inserted into t (2 rows)."]
+    assert db("give id from table t where age >= 0") == ['1', '3']
+
+
+def test_failed_flush_keeps_the_rows(db, monkeypatch):
+    db("new table t id name age")
+    for i in range(5):
+        db(f"put t {i} n{i} {20 + i}")
+    insert_rows, failures = main.insert_rows, [OSError("disk full")] * 2
+
+    def failing_insert(file_name, rows):
+        if failures:
+            raise failures.pop()
+        insert_rows(file_name, rows)
+
+    monkeypatch.setattr(main, 'insert_rows', failing_insert)
+    lines = db("give id from table t where age >= 0")
+    assert lines == ["Error inserting into t, 5 rows kept to retry: disk full"]  # The give still ran
+    assert main.data_buffers[('t', False)] == [f"{i},n{i},{20 + i}" for i in range(5)]
+    assert db("give id from table t where age >= 0") == [str(i) for i in range(5)]
+
+
+def test_put_filling_the_buffer_writes_it(db, monkeypatch):
+    monkeypatch.setattr(main, 'buffer_limit', 3)
+    db("new table t id name age")
+    assert [db(f"put t {i} n{i} 30") for i in range(4)] == [["Data buffered for t."]] * 2 + [
+        ["Data inserted into t."], ["Data buffered for t."]]
+    assert main.data_buffers[('t', False)] == ["3,n3,30"]
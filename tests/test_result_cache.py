@@ -0,0 +1,45 @@
+import io
+
+import main
+
+
+def make_table(db, rows):
+    db("new table t id name v")
+    main.commit_rows('t', [f"{i},n{i},{i}" for i in range(rows)])
+
+
+def test_results_are_cached_until_a_write(db, monkeypatch):
+    monkeypatch.setattr(main, 'result_cache_size', 8)
+    make_table(db, 10)
+    first = db("give id,name from table t where id >= 5")
+    assert db("give id,name from table t where id >= 5") == first
+    assert main.result_cache_stats['hits'] >= 1
+    db("put t 11 n11 11")
+    assert db("give id,name from table t where id >= 5") == first + ['11,n11']
+
+
+def test_results_stream_while_the_query_runs(db, monkeypatch):
+    monkeypatch.setattr(main, 'result_cache_size', 8)
+    make_table(db, 10)
+    output, seen = io.StringIO(), []
+    scan = main.scan_selected
+
+    def watched_scan(*args):
+        for row in scan(*args):
+            seen.append(output.getvalue())  # Printed so far, before the next row is produced
+            yield row
+
+    monkeypatch.setattr(main, 'scan_selected', watched_scan)
+    with main.captured_output(output):
+        main.parse_and_execute("give id from table t where v >= 0")
+    assert seen[-1].splitlines() == [str(i) for i in range(9)]
+
+
+def test_results_over_the_limit_are_not_kept(db, monkeypatch):
+    monkeypatch.setattr(main, 'result_cache_size', 8)
+    monkeypatch.setattr(main, 'result_cache_entry_limit', 100)
+    make_table(db, 100)
+    assert len(db("give id,name from table t where id >= 0")) == 100
+    assert "give id,name from table t where id >= 0" not in main.result_cache
+    assert len(db("give id from table t where id < 5")) == 5
+    assert "give id from table t where id < 5" in main.result_cache
@@ -0,0 +1,44 @@
+import io
+import sys
+import asyncio
+
+import client
+import main
+import server
+
+
+async def result_lines(reader):
+    # The lines of one result, up to the end-of-result line
+    lines = []
+    while True:
+        line = (await reader.readline()).decode()
+        assert line.endswith('\n'), "Connection closed before the end of the result"
+        if line == f"{server.END_OF_RESULT}\n":
+            return lines
+        lines.append(line.rstrip('\n'))
+
+
+async def round_trip(output):
+    listener = await asyncio.start_server(server.handle_client, '127.0.0.1', 0)
+    async with listener:
+        reader, writer = await asyncio.open_connection(*listener.sockets[0].getsockname()[:2])
+        writer.write(b"new table t id name age\n\nput t 500 late 40\n")  # Blank lines get no result
+        assert await result_lines(reader) == ["Table t created."]
+        assert await result_lines(reader) == ["Data buffered for t."]
+        main.commit_rows('t', [f"{i},name{i},{20 + i % 40}" for i in range(300)])
+
+        writer.write(b"give id,name from table t where age = 25\n")
+        assert await result_lines(reader) == [f"{i},name{i}" for i in range(5, 300, 40)]
+        await client.send_query(reader, writer, "give id from table t where id = 500")  # Flushed by the give
+        assert output.getvalue() == "500\n"
+
+        writer.write(b"exit\n")
+        assert await reader.read() == b''  # The server closes the connection
+        writer.close()
+
+
+def test_queries_round_trip_with_an_end_of_result_line(db, monkeypatch):
+    output = io.StringIO()
+    monkeypatch.setattr(sys, 'stdout', main.ThreadOutput(output))  # As in server.py
+    monkeypatch.setattr(server, 'batch_size', 16)  # Results span several batches
+    asyncio.run(round_trip(output))
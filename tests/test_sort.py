@@ -0,0 +1,23 @@
+import os
+import tracemalloc
+
+import main
+
+
+def test_sort_stays_within_its_memory_budget(db, monkeypatch):
+    db("new table t id v name")
+    main.commit_rows('t', [f"{i},{(i * 7919) % 10007},name{i}" for i in range(40000)])
+    budget = 256 * 1024
+    monkeypatch.setattr(main, 'sort_memory_limit', budget)
+    monkeypatch.setattr(main, 'buffer_pool_limit', 0)
+    with open(os.devnull, 'w') as discard, main.captured_output(discard):
+        tracemalloc.start()
+        try:
+            main.execute_query("order t by v asc", use_result_cache=False)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    assert peak < 3 * budget
+    lines = db("order t by v asc")[2:]
+    values = [int(line.split(',')[1]) for line in lines]
+    assert len(values) == 40000 and values == sorted(values)
@@ -0,0 +1,22 @@
+import main
+
+
+def test_partition_writes_stay_in_the_parent(db, monkeypatch):
+    # Workers import main afresh, so only writes made by this process are recorded
+    monkeypatch.setattr(main, 'parallel_workers', 2)
+    db("new_p table t id v partition by range id size 100")
+    main.commit_rows('t', [f"{i},{i % 7}" for i in range(400)], True)
+    written, compacted = [], []
+    append_mutations, compact_data_file = main.append_mutations, main.compact_data_file
+    monkeypatch.setattr(main, 'append_mutations', lambda data_file, mutations: (
+        written.append(data_file), append_mutations(data_file, mutations)))
+    monkeypatch.setattr(main, 'compact_data_file', lambda data_file: (
+        compacted.append(data_file), compact_data_file(data_file)))
+
+    db("remove_p of t where v = 0")
+    db("renew_p t put v=9 where v = 1")
+    assert len(set(written)) == len(main.partition_files('t')) > 1
+    db("compact t")
+    assert sorted(compacted) == sorted(main.partition_files('t'))
+    assert sorted(map(int, db("give_p id from table t where v = 9"))) == [i for i in range(400) if i % 7 == 1]
+    assert len(db("give_p id from table t where v >= 0")) == 400 - len(range(0, 400, 7))